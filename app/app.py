@@ -1,11 +1,22 @@
 """ This module contains the FastAPI application. It's responsible for
     creating the FastAPI application and including the routers."""
-from fastapi import FastAPI
+import asyncio
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
+from app.dependencies import llm_clients
+from app.middleware.session_middleware import redis_pool, SessionMiddleware
+from app.middleware.deadline_middleware import DeadlineMiddleware
+from app.middleware.admission_middleware import AdmissionMiddleware
+from app.utils.deadline_utils import DeadlineExceeded
+from app.utils.session_utils import run_session_sweeper, run_invalidation_listener
+from app.utils.run_utils import run_status_listener
 # Import routers
 from app.routes.chat_routes import router as chat_routes
 from app.routes.image_routes import router as image_routes
 from app.routes.extraction_routes import router as extraction_routes
+from app.routes.metrics_routes import router as metrics_routes
 
 DESCRIPTION = """
 # BakespaceAI FastAPI
@@ -77,7 +88,25 @@ To install these dependencies, use 'pip', the Python package installer:
 pip install -r requirements.txt
 """
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """ Open the shared LLM client and Redis pools and start the session and run status
+    background tasks on startup; stop them on shutdown. """
+    app.state.llm_clients = llm_clients.start()
+    app.state.redis_pool = redis_pool.start()
+    tasks = [
+        asyncio.create_task(run_session_sweeper()),
+        asyncio.create_task(run_invalidation_listener()),
+        asyncio.create_task(run_status_listener()),
+    ]
+    yield
+    for task in tasks:
+        task.cancel()
+    await llm_clients.close()
+    await redis_pool.close()
+
 app = FastAPI(
+    lifespan=lifespan,
     title="BakeSpace AI",
     description=DESCRIPTION,
     version="0.1",
@@ -95,6 +124,20 @@ app = FastAPI(
     }
 )
 
+@app.exception_handler(DeadlineExceeded)
+async def deadline_exceeded_handler(request: Request, exc: DeadlineExceeded):
+    """ A downstream call found the request out of time. """
+    return JSONResponse({"detail": str(exc)}, status_code=504)
+
+# Queue the LLM-bound requests for their endpoint and provider slots, within the deadline
+app.add_middleware(AdmissionMiddleware)
+
+# Give each request the deadline budget of its endpoint
+app.add_middleware(DeadlineMiddleware)
+
+# Issue and echo the Session-ID header
+app.add_middleware(SessionMiddleware)
+
 # Allow CORS for your front end
 app.add_middleware(
     CORSMiddleware,
@@ -102,10 +145,11 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Session-ID", "ETag"],
 )
 
 
 # Include routers
-routers = [chat_routes, image_routes, extraction_routes]
+routers = [chat_routes, image_routes, extraction_routes, metrics_routes]
 for router in routers:
     app.include_router(router)
@@ -1,14 +1,21 @@
 """ This file contains all the dependencies for the app. """
 import os
 import json
+import logging
+from typing import Optional
+import httpx
 from google.oauth2 import service_account
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
 import anthropic
+from app.utils.deadline_utils import with_deadline
+from app.utils.ratelimit_utils import rate_limits
 
 # Load environment variables
 load_dotenv()
 
+logger = logging.getLogger("main")
+
 
 def get_openai_api_key():
     """ Function to get the OpenAI API key. """
@@ -18,6 +25,10 @@ def get_openai_org():
     """ Function to get the OpenAI organization. """
     return os.getenv("OPENAI_ORG")
 
+def get_anthropic_api_key():
+    """ Function to get the Anthropic API key. """
+    return os.getenv("ANTHROPIC_KEY")
+
 '''def get_google_vision_credentials():
     """ Function to get the Google Vision credentials from an environment variable. """
     try:
@@ -38,16 +49,82 @@ def get_stability_api_key():
     """ Get the stability API key from the environment. """
     return os.getenv("STABLE_DIFFUSION_API_KEY")
 
-def get_openai_client():
-    """ Get the OpenAI client. """
-    return OpenAI(api_key=get_openai_api_key(), organization=get_openai_org(), max_retries=3, timeout=55)
+def get_llm_pool_limits() -> httpx.Limits:
+    """ Get the connection pool limits used for each LLM provider. """
+    return httpx.Limits(
+        max_connections=int(os.getenv("LLM_MAX_CONNECTIONS", "100")),
+        max_keepalive_connections=int(os.getenv("LLM_MAX_KEEPALIVE_CONNECTIONS", "20")),
+        keepalive_expiry=float(os.getenv("LLM_KEEPALIVE_EXPIRY", "30")),
+    )
+
+def get_llm_http2() -> bool:
+    """ Whether to negotiate HTTP/2 with the LLM providers.  Requires the h2 package. """
+    if os.getenv("LLM_HTTP2", "true").lower() not in ["1", "true", "yes"]:
+        return False
+    try:
+        import h2  # noqa: F401 pylint: disable=import-outside-toplevel,unused-import
+    except ImportError:
+        logger.warning("h2 is not installed, falling back to HTTP/1.1 for the LLM clients")
+        return False
+    return True
+
+class LLMClients:
+    """ Registry of the async LLM clients shared by every service.  Each provider gets a
+    single pooled HTTP client that is opened and closed with the app lifespan.  Every
+    response is passed to the rate limiters so their budgets track the provider's. """
+    def __init__(self):
+        self.openai: Optional[AsyncOpenAI] = None
+        self.anthropic: Optional[anthropic.AsyncAnthropic] = None
+
+    def start(self):
+        """ Create the provider clients and their connection pools. """
+        if self.openai is None:
+            self.openai = AsyncOpenAI(
+                api_key=get_openai_api_key(), organization=get_openai_org(), max_retries=3, timeout=55,
+                http_client=DefaultAsyncHttpxClient(
+                    limits=get_llm_pool_limits(), http2=get_llm_http2(),
+                    event_hooks={"response": [rate_limits.observe_response]}
+                )
+            )
+        if self.anthropic is None:
+            self.anthropic = anthropic.AsyncAnthropic(
+                api_key=get_anthropic_api_key(), max_retries=3, timeout=35,
+                http_client=anthropic.DefaultAsyncHttpxClient(
+                    limits=get_llm_pool_limits(), http2=get_llm_http2(),
+                    event_hooks={"response": [rate_limits.observe_response]}
+                )
+            )
+        logger.info("LLM clients started")
+        return self
+
+    async def close(self):
+        """ Close the provider clients and release their connections. """
+        if self.openai is not None:
+            await self.openai.close()
+            self.openai = None
+        if self.anthropic is not None:
+            await self.anthropic.close()
+            self.anthropic = None
+        logger.info("LLM clients closed")
+
+# The registry is started and closed by the app lifespan in app/app.py
+llm_clients = LLMClients()
 
-def get_query_filter_client():
-    """ Get the Query Filter client. """
-    return OpenAI(api_key=get_openai_api_key(), organization=get_openai_org(), max_retries=1, timeout=25)
+def get_openai_client() -> AsyncOpenAI:
+    """ Get the shared async OpenAI client, fitted into the request deadline. """
+    if llm_clients.openai is None:
+        llm_clients.start()
+    return with_deadline(llm_clients.openai)
 
-def get_anthropic_client():
-    anthropic_client = anthropic.Client(
-        api_key=os.getenv("ANTHROPIC_KEY"), max_retries=3, timeout=35)
+def get_query_filter_client() -> AsyncOpenAI:
+    """ Get the Query Filter client.  Shares the OpenAI connection pool
+    with tighter retry and timeout settings. """
+    if llm_clients.openai is None:
+        llm_clients.start()
+    return with_deadline(llm_clients.openai.with_options(max_retries=1, timeout=25))
 
-    return anthropic_client
+def get_anthropic_client() -> anthropic.AsyncAnthropic:
+    """ Get the shared async Anthropic client, fitted into the request deadline. """
+    if llm_clients.anthropic is None:
+        llm_clients.start()
+    return with_deadline(llm_clients.anthropic)
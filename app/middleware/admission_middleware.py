@@ -0,0 +1,34 @@
+""" This module contains the AdmissionMiddleware class """
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Receive, Scope, Send
+from app.utils.admission_utils import AdmissionRejected, admission
+from app.utils.deadline_utils import DeadlineExceeded
+
+class AdmissionMiddleware:
+    """ Pure ASGI middleware that admits requests to the LLM-bound endpoints through the
+    admission scheduler.  The slots are held until the response, including a streamed
+    one, has been sent; a request that cannot be admitted gets a 429 with Retry-After. """
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or scope["method"] != "POST":
+            await self.app(scope, receive, send)
+            return
+
+        try:
+            pools = await admission.acquire(scope["path"])
+        except AdmissionRejected as e:
+            response = JSONResponse(
+                {"detail": str(e)}, status_code=429, headers={"Retry-After": str(e.retry_after)}
+            )
+            await response(scope, receive, send)
+            return
+        except DeadlineExceeded as e:
+            await JSONResponse({"detail": str(e)}, status_code=504)(scope, receive, send)
+            return
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            admission.release(pools)
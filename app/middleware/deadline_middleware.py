@@ -0,0 +1,60 @@
+""" This module contains the DeadlineMiddleware class """
+import asyncio
+import logging
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from app.utils.deadline_utils import get_endpoint_deadline, start_deadline, request_deadline
+from app.utils.metrics_utils import metrics
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger("main")
+
+class DeadlineMiddleware:
+    """ Pure ASGI middleware that gives every request the deadline budget of its
+    endpoint.  The deadline is kept in a context variable that the downstream calls
+    size their timeouts from, and a request that has not started its response when
+    the budget runs out is cancelled and answered with a 504.  Once the response has
+    started the deadline is lifted, so that a streamed body can run past it. """
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        budget = get_endpoint_deadline(scope["path"])
+        token = start_deadline(budget)
+        started = asyncio.Event()
+
+        async def send_with_deadline(message: Message):
+            if message["type"] == "http.response.start":
+                started.set()
+                # Sent from the task that goes on to send the body, e.g. a streamed one
+                request_deadline.set(None)
+            await send(message)
+
+        # The app runs in a task of its own so that it can be cancelled at the deadline
+        handler = asyncio.ensure_future(self.app(scope, receive, send_with_deadline))
+        response_started = asyncio.ensure_future(started.wait())
+        try:
+            await asyncio.wait({handler, response_started}, timeout=budget, return_when=asyncio.FIRST_COMPLETED)
+            if handler.done() or started.is_set():
+                # Once the response has started it finishes on its own
+                await handler
+                return
+            handler.cancel()
+            try:
+                await handler
+            except asyncio.CancelledError:
+                pass
+            logger.warning(f"Request to {scope['path']} exceeded its {budget}s deadline")
+            metrics.increment("requests.deadline_exceeded")
+            if not started.is_set():
+                response = JSONResponse({"detail": "The request deadline was exceeded."}, status_code=504)
+                await response(scope, receive, send)
+        finally:
+            response_started.cancel()
+            if not handler.done():
+                handler.cancel()
+            request_deadline.reset(token)
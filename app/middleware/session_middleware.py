@@ -1,10 +1,13 @@
 """ This module contains the SessionMiddleware class and RedisStore class """
-# import uuid
 import os
+import re
+import uuid
+from typing import Optional
 from dotenv import load_dotenv
-from starlette.middleware.base import BaseHTTPMiddleware, RequestResponseEndpoint
-from fastapi import FastAPI, Request, Response
-import redis
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from fastapi import Request
+import redis.asyncio as aioredis
 import logging
 
 load_dotenv()
@@ -12,46 +15,112 @@ load_dotenv()
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger("main")
 
-redis_password = os.getenv('REDIS_PASSWORD')
+def get_redis_host() -> str:
+    """ Get the Redis host from the environment. """
+    return os.getenv("REDIS_HOST", "redis-11565.c124.us-central1-1.gce.cloud.redislabs.com")
 
-r = redis.Redis(
-    host = 'redis-11565.c124.us-central1-1.gce.cloud.redislabs.com',
-    port = 11565,
-    password = redis_password)
+def get_redis_port() -> int:
+    """ Get the Redis port from the environment. """
+    return int(os.getenv("REDIS_PORT", "11565"))
 
-session_id = None
-class SessionMiddleware(BaseHTTPMiddleware):
-    """ SessionMiddleware is a class that represents a middleware for sessions """
-    async def dispatch(
-        self, request: Request, call_next: RequestResponseEndpoint
-    ) -> Response:
-        session_id = request.headers.get("Session-ID")  # Using hyphenated header field
-        logger.debug(f"Received Session-ID: {session_id}")
+def get_redis_password() -> Optional[str]:
+    """ Get the Redis password from the environment. """
+    return os.getenv("REDIS_PASSWORD")
 
-        # Optional: Validate session_id here
+def get_redis_pool_settings() -> dict:
+    """ Get the connection pool settings for Redis. """
+    return {
+        "max_connections": int(os.getenv("REDIS_MAX_CONNECTIONS", "50")),
+        "socket_timeout": float(os.getenv("REDIS_SOCKET_TIMEOUT", "5")),
+        "socket_connect_timeout": float(os.getenv("REDIS_SOCKET_CONNECT_TIMEOUT", "5")),
+        "health_check_interval": int(os.getenv("REDIS_HEALTH_CHECK_INTERVAL", "30")),
+    }
 
-        response = await call_next(request)
+class RedisPool:
+    """ The async Redis client shared by every request, backed by a single connection
+    pool that is opened and closed with the app lifespan. """
+    def __init__(self):
+        self.pool: Optional[aioredis.ConnectionPool] = None
+        self.client: Optional[aioredis.Redis] = None
 
-        if session_id:  # Only set the session_id header if it's not None
-            response.headers["Session-ID"] = session_id  # Ensuring header field consistency
-            logger.debug(f"Set Session-ID in response headers: {session_id}")
+    def start(self):
+        """ Create the connection pool and the client. """
+        if self.client is None:
+            self.pool = aioredis.ConnectionPool(
+                host=get_redis_host(), port=get_redis_port(), password=get_redis_password(),
+                **get_redis_pool_settings()
+            )
+            self.client = aioredis.Redis(connection_pool=self.pool)
+            logger.info("Redis connection pool started")
+        return self
 
-        return response
+    async def close(self):
+        """ Close the client and disconnect the pooled connections. """
+        if self.client is not None:
+            await self.client.aclose()
+            await self.pool.disconnect()
+            self.client = None
+            self.pool = None
+            logger.info("Redis connection pool closed")
+
+# The pool is started and closed by the app lifespan in app/app.py
+redis_pool = RedisPool()
+
+def get_redis() -> aioredis.Redis:
+    """ Get the shared async Redis client. """
+    if redis_pool.client is None:
+        redis_pool.start()
+    return redis_pool.client
+
+# Session ids become part of the Redis keys, so only allow characters that cannot
+# collide with the {session_id}:{field} key layout
+SESSION_ID_PATTERN = re.compile(r"^[A-Za-z0-9_.-]{1,128}$")
+
+def is_valid_session_id(session_id: Optional[str]) -> bool:
+    """ Whether a client supplied session id can be used as is. """
+    return bool(session_id) and SESSION_ID_PATTERN.match(session_id) is not None
 
 class RedisStore:
-    """ RedisStore is a class that represents a Redis store for a session """
+    """ RedisStore is a class that represents a Redis store for a session.  Creating
+    it does no I/O; the session is only loaded when a service reads from it. """
     def __init__(self, session_id: str):
-        self.redis = r
+        self.redis = get_redis()
         self.session_id = session_id
         logger.debug(f"Initialized RedisStore with Session-ID: {session_id}")
 
+class SessionMiddleware:
+    """ Pure ASGI session middleware.  Reads the Session-ID request header, issuing a
+    new id if it is missing or invalid, attaches a RedisStore for the session to
+    request.state.session and sets the Session-ID response header.  The response body
+    is passed through untouched, so streaming responses are not buffered. """
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        session_id = Headers(scope=scope).get("Session-ID")  # Using hyphenated header field
+        if not is_valid_session_id(session_id):
+            session_id = uuid.uuid4().hex
+            logger.debug(f"Issued Session-ID: {session_id}")
+            # Rewrite the request header so that handlers reading it see the issued id
+            MutableHeaders(scope=scope)["Session-ID"] = session_id
+        scope.setdefault("state", {})["session"] = RedisStore(session_id)
+
+        async def send_with_session(message: Message):
+            if message["type"] == "http.response.start":
+                MutableHeaders(scope=message)["Session-ID"] = session_id  # Ensuring header field consistency
+            await send(message)
+
+        await self.app(scope, receive, send_with_session)
+
 def get_redis_store(request: Request) -> RedisStore:
     """ get_redis_store is a function that returns a RedisStore object """
-    session_id = request.headers.get("Session-ID")  # Ensuring header field consistency
-    logger.debug(f"Getting RedisStore with Session-ID: {session_id}")
-    return RedisStore(session_id)
-
-# Initialize FastAPI app and add middleware
-app = FastAPI()
-app.add_middleware(SessionMiddleware)
-logger.debug("Added SessionMiddleware to FastAPI app")
+    store = getattr(request.state, "session", None)
+    if store is None:
+        # The middleware is not installed, e.g. in a bare test app
+        store = RedisStore(request.headers.get("Session-ID"))
+    logger.debug(f"Getting RedisStore with Session-ID: {store.session_id}")
+    return store
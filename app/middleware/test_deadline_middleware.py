@@ -0,0 +1,49 @@
+""" Tests for the request deadline middleware """
+import asyncio
+import os
+import unittest
+from unittest import mock
+from starlette.applications import Starlette
+from starlette.responses import StreamingResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+from app.middleware.deadline_middleware import DeadlineMiddleware
+from app.utils.deadline_utils import check_deadline
+
+async def slow(request):
+    """ An endpoint that does not answer within the budget. """
+    await asyncio.sleep(0.3)
+
+async def stream(request):
+    """ An endpoint that starts its stream in time and finishes it after the budget. """
+    async def body():
+        yield "started\n"
+        await asyncio.sleep(0.3)
+        # The calls made after the budget, e.g. creating the recipe's thread, still run
+        check_deadline()
+        yield "finished\n"
+    return StreamingResponse(body())
+
+class TestDeadlineMiddleware(unittest.TestCase):
+    """ Tests for cancelling requests at their deadline. """
+    def setUp(self):
+        patcher = mock.patch.dict(os.environ, {"REQUEST_DEADLINE": "0.1"})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        app = Starlette(routes=[Route("/slow", slow), Route("/stream", stream)])
+        app.add_middleware(DeadlineMiddleware)
+        self.client = TestClient(app)
+
+    def test_unstarted_response_times_out(self):
+        """ A request that has not started its response by the deadline gets a 504. """
+        response = self.client.get("/slow")
+        self.assertEqual(response.status_code, 504)
+
+    def test_started_stream_outlives_the_deadline(self):
+        """ A stream that started in time is sent in full, past the deadline. """
+        response = self.client.get("/stream")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.text, "started\nfinished\n")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -58,6 +58,7 @@ class FormatRecipeTextRequest(BaseModel):
     """ Define the request model for the format recipe text endpoint. """
     recipe_text: str = Field(..., description="The raw recipe text.")
     thread_id: Optional[str] = Field(None, description="The thread_id.")
+    fresh: Optional[bool] = Field(False, description="Skip the recipe cache and format the text again.")
 
 class CreateRecipeRequest(BaseModel):
     """ Request body for creating a new recipe """
@@ -65,6 +66,7 @@ class CreateRecipeRequest(BaseModel):
     serving_size: Optional[str] = Field("4-6", description="The serving size for the recipe.")
     chef_type: Optional[str] = Field("home_cook", description="The type of chef creating the recipe.")
     thread_id: Optional[str] = Field(None, description="The thread id for the chat session.")
+    fresh: Optional[bool] = Field(False, description="Skip the recipe cache and generate a new variation.")
 
 class CreateRecipeResponse(BaseModel):
     recipe: Recipe = Field(..., description="The recipe object.")
@@ -78,3 +80,4 @@ class IngredientsRecipeRequest(BaseModel):
     serving_size: Optional[str] = Field("4-6", description="The serving size for the recipe.")
     chef_type: Optional[str] = Field("home_cook", description="The type of chef creating the recipe.")
     thread_id: Optional[str] = Field(None, description="The thread id for the chat session.")
+    fresh: Optional[bool] = Field(False, description="Skip the recipe cache and generate a new variation.")
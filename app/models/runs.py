@@ -35,8 +35,10 @@ class ClearChatResponse(BaseModel):
 
 class ViewChatResponse(BaseModel):
   """ Return class for the view_chat_history endpoint """
-  chat_history: List[dict] = Field(..., description="The chat history for the chat session.")
+  chat_history: List[dict] = Field(..., description="The chat history for the chat session.  Each\
+  message has an 'id' that can be passed as the before / after cursor.")
   session_id: str = Field(..., description="The session id for the chat session.")
+  has_more: bool = Field(False, description="Whether there are more messages past this page.")
 
 class InitializeChatResponse(BaseModel):
   """ Return class for the initialize_chat endpoint """
@@ -47,6 +49,7 @@ class InitializeChatResponse(BaseModel):
 class GetChefRequestResponse(BaseModel):
   """ Return class for the get_chef_response endpoint """
   chef_response: ResponseMessage = Field(..., description="The response message from the chef.")
-  thread_id: str = Field(..., description="The thread id for the chat session.")
+  thread_id: Optional[str] = Field(None, description="The thread id for the chat session.  Not set when\
+  the chef answers with the completions engine and the session has no Assistants thread.")
   session_id: Union[str, None] = Field(..., description="The session id for the chat session.")
   adjusted_recipe: Optional[Recipe] = Field(None, description="The adjusted recipe object.")
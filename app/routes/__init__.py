@@ -6,16 +6,19 @@ from fastapi import APIRouter
 from app.routes.chat_routes import router as chat_routes
 from app.routes.image_routes import router as image_routes
 from app.routes.extraction_routes import router as extraction_routes
+from app.routes.metrics_routes import router as metrics_routes
 
 # Create instances of APIRouter for each router
 router_chat = APIRouter()
 router_image = APIRouter()
 router_extraction = APIRouter()
+router_metrics = APIRouter()
 
 # Register the routers to the corresponding instances
 router_chat.include_router(chat_routes)
 router_image.include_router(image_routes)
 router_extraction.include_router(extraction_routes)
+router_metrics.include_router(metrics_routes)
 
 # Export the routers as a list for convenience
-routers = [router_chat, router_image, router_extraction]
+routers = [router_chat, router_image, router_extraction, router_metrics]
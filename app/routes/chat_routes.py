@@ -1,26 +1,42 @@
 """ This module defines the chat routes for the API. """
-from typing import List, Union, Optional
+from typing import AsyncIterator, List, Union, Optional
+import asyncio
 import logging
-import json
 import markdown
-from openai import OpenAIError
-from fastapi import APIRouter, Depends, HTTPException, Request
+from openai import AsyncOpenAI, OpenAIError
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
 from pydantic import BaseModel, Field
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 from app.utils.assistant_utils import (
-    poll_run_status, get_assistant_id, create_thread
+    run_turn, wait_for_run_result, get_assistant_id, create_thread, stream_run_events,
+    save_recipe_instructions, save_recipe_tools, save_recipe_message
 )
+from app.utils.completions_utils import (
+    get_chat_engine, build_chat_messages, complete_chat, stream_completion_events, COMPLETIONS_ENGINE
+)
+from app.utils.disconnect_utils import cancel_on_disconnect
+from app.utils.context_utils import get_context_window, get_run_context_options
+from app.utils.run_utils import (
+    ThreadRunLock, ThreadBusyError, get_run_request_key, release_after
+)
+from app.utils.stream_utils import format_sse, SSE_HEADERS
+from app.utils.cache_utils import get_recipe_cache_stats
 from app.models.runs import (
     CreateThreadRequest, GetChefResponse, ClearChatResponse,
     ViewChatResponse, InitializeChatResponse, GetChefRequestResponse
 )
-from app.middleware.session_middleware import RedisStore
+from app.middleware.session_middleware import get_redis_store
 from app.dependencies import get_openai_client
 from app.services.chat_service import ChatService
 from app.services.recipe_service import (
-    create_recipe, claude_recipe, claude_ingredients_recipe
+    claude_recipe, claude_ingredients_recipe, filter_query, hedged_recipe,
+    stream_claude_recipe, get_claude_recipe_messages, claude_system_message,
+    serving_size_dict, get_speculative_generation
 )
+from app.utils.filter_utils import classify_food_query
 from app.models.recipe import (
-    CreateRecipeRequest, CreateRecipeResponse, IngredientsRecipeRequest
+    CreateRecipeRequest, CreateRecipeResponse, IngredientsRecipeRequest, Recipe
 )
 from app.models.chat import ResponseMessage
 
@@ -34,7 +50,8 @@ router = APIRouter()
 class StatusCallResponse(BaseModel):
   """ Return class for the status call endpoint """
   session_id: Union[str, None] = Field(description="The session id for the chat session.")
-  chat_history: List[dict] = Field(..., description="The chat history for the chat session.")
+  chat_history: Optional[List[dict]] = Field(None, description="The chat history for the chat session,\
+  omitted when include_history is false.")
   thread_id: Union[str, None] = Field(None, description="The thread id for the chat session.")
   chef_type: str = Field("home_cook", description="The type of chef that the user wants to talk to.")
 
@@ -57,20 +74,48 @@ def get_session_id(request: Request) -> str:
     session_id = request.headers.get("Session-ID")
     return session_id
 
-def get_chat_service(request: Request) -> ChatService:
-    """ Define a function to get the chat service. """
-    session_id = get_session_id(request)
-    redis_store = RedisStore(session_id)
-    return ChatService(store=redis_store)
+async def get_chat_service(request: Request) -> AsyncIterator[ChatService]:
+    """ Define a function to get the chat service.  The session changes made
+    by the endpoint are written back in one transaction when it returns. """
+    redis_store = get_redis_store(request)
+    chat_service = await ChatService.create(store=redis_store)
+    try:
+        yield chat_service
+    finally:
+        await chat_service.commit()
+
+async def get_thread_run_lock(chef_response: GetChefResponse, chat_service: ChatService = Depends(get_chat_service)
+                              ) -> AsyncIterator[Optional[ThreadRunLock]]:
+    """ Hold the request's thread while its run is made, so that runs on a thread are
+    made one at a time.  A double submit of the request being answered shares its run. """
+    thread_id = chef_response.thread_id or await chat_service.get_thread_id()
+    if not thread_id or get_chat_engine(chef_response.chef_type) == COMPLETIONS_ENGINE:
+        yield None
+        return
+    run_lock = ThreadRunLock(
+        thread_id, get_run_request_key(chef_response.message_content, chef_response.save_recipe)
+    )
+    try:
+        # The adjusted recipe is only returned to the request that ran the tool
+        await run_lock.acquire(coalesce=not chef_response.save_recipe)
+    except ThreadBusyError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    try:
+        yield run_lock
+    finally:
+        # Land the session writes before the next run on the thread can start
+        await chat_service.commit()
+        await run_lock.release()
 
 @router.get(
     "/status_call", response_description="The session id, chat history and thread id\
     of the current chat session.", response_model=StatusCallResponse
 )
-async def status_call(chat_service: ChatService = Depends(get_chat_service)):
+async def status_call(include_history: bool = Query(True, description="Whether to return the chat history."),
+                      chat_service: ChatService = Depends(get_chat_service)):
     logger.info("Status call endpoint hit")
     try:
-        status = chat_service.check_status()
+        status = await chat_service.check_status(include_history)
         # logger.debug(f"Status call response: {status}")
         return status
     except Exception as e:
@@ -86,7 +131,7 @@ async def initialize_general_chat(context: CreateThreadRequest, chat_service=Dep
 
     try:
         # Add user message to chat service
-        chat_service.add_user_message(message=context.message_content)
+        await chat_service.add_user_message(message=context.message_content)
         logger.info("User message added to chat service")
 
         # Construct message content
@@ -94,11 +139,12 @@ async def initialize_general_chat(context: CreateThreadRequest, chat_service=Dep
         logger.info(f"Formed message content: {message_content}")
 
         # Create message thread
-        thread_id = create_thread(role="user", content=message_content)
+        thread_id = await create_thread(role="user", content=message_content)
         logger.info(f"Chat successfully initialized with message thread: {thread_id}")
 
-        # Set the thread_id in the store and prepare response
-        chat_service.set_thread_id(thread_id)
+        # Set the thread_id and the context in the store and prepare response
+        await chat_service.set_thread_id(thread_id)
+        await chat_service.set_context(message_content)
         session_id = chat_service.session_id
         # chat_history = chat_service.load_chat_history()
 
@@ -125,10 +171,11 @@ async def initialize_general_chat(context: CreateThreadRequest, chat_service=Dep
     },
     response_model=GetChefRequestResponse
 )
-async def get_chef_response(chef_response: GetChefResponse, chat_service:
-                            ChatService = Depends(get_chat_service)):
+async def get_chef_response(chef_response: GetChefResponse, request: Request, chat_service:
+                            ChatService = Depends(get_chat_service),
+                            client: AsyncOpenAI = Depends(get_openai_client),
+                            run_lock: Optional[ThreadRunLock] = Depends(get_thread_run_lock)):
     """ Endpoint to get a response from the chatbot to a user's question. """
-    client = get_openai_client()
 
     # Get the assistant id based on the chef type
     assistant_id = get_assistant_id(chef_response.chef_type)
@@ -139,142 +186,163 @@ async def get_chef_response(chef_response: GetChefResponse, chat_service:
       thread_id = chef_response.thread_id
       logger.info(f"Chef response thread ID: {thread_id}")
     else:
-      thread_id = chat_service.get_thread_id()
+      thread_id = await chat_service.get_thread_id()
       logger.info(f"Chat service thread ID: {thread_id}")
 
+    if run_lock and run_lock.coalesced_run_id:
+        # A double submit of the request already being answered, share its answer
+        logger.info(f"Sharing run {run_lock.coalesced_run_id} with a repeated request on thread {thread_id}")
+        response = await cancel_on_disconnect(request, wait_for_run_result(thread_id, run_lock.coalesced_run_id))
+        if response is None:
+            raise HTTPException(status_code=500, detail="The run answering this request failed.")
+        return {
+            "chef_response" : ResponseMessage(
+                content=response["message"], role="ai", thread_id=thread_id,
+                html=markdown.markdown(response["message"])
+            ),
+            "thread_id" : thread_id,
+            "session_id": chat_service.session_id
+        }
+
     # Add the user message to the chat history
-    chat_service.add_user_message(message=chef_response.message_content, thread_id=thread_id)
+    await chat_service.add_user_message(message=chef_response.message_content, thread_id=thread_id)
     logger.info(f"User message added to chat history: {chef_response.message_content}")
 
-    message_content = chef_response.message_content
+    if get_chat_engine(chef_response.chef_type) == COMPLETIONS_ENGINE:
+        return await cancel_on_disconnect(
+            request, get_completions_chef_response(chef_response, chat_service, thread_id)
+        )
 
+    message = {
+        "role": "user", "content": chef_response.message_content, "metadata": chef_response.message_metadata
+    }
+    run_options = get_run_context_options()
     if chef_response.save_recipe:
-        message_content = "I am ready to save my recipe!  Please use the 'adjust_recipe' tool\
-        to make any necessary changes based on the original recipe and our ensuing conversation."
-        instructions = "Use the adjust_recipe tool to make any necessary changes to the original recipe\
-            based on the user's requests.  Just use the tool,\
-            do not return a message to the user. This is just to\
-            save the recipe in the database.  Thanks!"
-        tools = [
-            {
-                "type": "function",
-                "function": {
-                    "name": "adjust_recipe",
-                    "description": (
-                        "Adjust an existing recipe based on the original recipe object and"
-                        " the user specifications and interactions to conform to the recipe"
-                        " object schema."
-                    ),
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "adjusted_recipe": {
-                                "type": "object",
-                                "description": (
-                                    "The adjusted recipe object following the specified"
-                                    " Pydantic schema."
-                                ),
-                                "properties": {
-                                    "recipe_name": {"type": "string"},
-                                    "ingredients": {"type": "array", "items": {"type": "string"}},
-                                    "directions": {"type": "array", "items": {"type": "string"}},
-                                    "prep_time": {"type": ["integer", "string"]},
-                                    "cook_time": {"type": ["string", "integer"], "nullable": True},
-                                    "serving_size": {"type": ["string", "integer"], "nullable": True},
-                                    "calories": {"type": ["string", "integer"], "nullable": True},
-                                    "fun_fact": {"type": "string"},
-                                    "pairs_with": {"type": "string"}
-                                },
-                                "required": [
-                                    "recipe_name", "ingredients", "directions", "fun_fact", "pairs_with",
-                                    "prep_time", "cook_time", "serving_size", "calories"
-                                ]
-                            },
-                        },
-                        "required": ["adjusted_recipe"]
-                    }
-                }
-            }
-        ]
-
-        # Create and send the message
-        message = client.beta.threads.messages.create(
-            thread_id,
-            content=message_content,
-            role="user",
-            metadata=chef_response.message_metadata,
-        )
-        # Log the message
-        logger.info(f"Message {message.content} added to thread {thread_id}")
+        message["content"] = save_recipe_message
+        run_options.update(instructions=save_recipe_instructions, tools=save_recipe_tools, model="gpt-4o")
 
-        # Create the run
-        run = client.beta.threads.runs.create(
+    # The message is sent with the run and the answer is read from the run's stream,
+    # rather than adding the message, polling the run and listing the thread after it
+    if thread_id:
+        queued_messages = await chat_service.load_thread_messages(thread_id)
+        run_stream = await client.beta.threads.runs.create(
             assistant_id=assistant_id,
             thread_id=thread_id,
-            instructions=instructions,
-            tools=tools,
-            model="gpt-4o",
-            timeout=6000,
+            additional_messages=queued_messages + [message],
+            stream=True,
+            **run_options
         )
-        # Poll the run status
-        response = await poll_run_status(run_id=run.id, thread_id=run.thread_id)
-
-        if response:      # Add the chef response to the chat history
-            # chat_service.add_chef_message(response["message"])
-            logger.info(f"Tool outputs: {response['tool_return_values']}")
-
-            return {
-                "chef_response" : ResponseMessage(
-                    content=response["message"], role="ai", thread_id=run.thread_id
-                ),
-                "thread_id" : run.thread_id,
-                "adjusted_recipe" : response["tool_return_values"],
-                "session_id": chat_service.session_id
-            }
-
-    if thread_id:
-        # Create and send the message
-        message = client.beta.threads.messages.create(
-            thread_id,
-            content=message_content,
-            role="user",
-            metadata=chef_response.message_metadata,
+        if queued_messages:
+            await chat_service.clear_thread_messages()
+    else:
+        run_stream = await client.beta.threads.create_and_run(
+            assistant_id=assistant_id,
+            thread={"messages": [message]},
+            stream=True,
+            **run_options
         )
-        # Log the message
-        logger.info(f"Message {message.content} added to thread {thread_id}")
+    # If the client leaves, the turn is cancelled and its run with it
+    response = await cancel_on_disconnect(
+        request, run_turn(run_stream, thread_id, on_run_created=run_lock.set_run if run_lock else None)
+    )
+    if response is None:
+        raise HTTPException(status_code=500, detail="The chef run failed.")
 
-        # Create the run
-        run = client.beta.threads.runs.create(
-            assistant_id=assistant_id,
-            thread_id=thread_id,
+    if response["thread_id"] != thread_id:
+        # Set the thread_id in the store
+        await chat_service.set_thread_id(response["thread_id"])
+        logger.info(f"Thread ID set in chat service: {response['thread_id']}")
+
+    if chef_response.save_recipe:
+        logger.info(f"Tool outputs: {response['tool_return_values']}")
+        return {
+            "chef_response" : ResponseMessage(
+                content=response["message"], role="ai", thread_id=response["thread_id"]
+            ),
+            "thread_id" : response["thread_id"],
+            "adjusted_recipe" : response["tool_return_values"],
+            "session_id": chat_service.session_id
+        }
+
+    # Add the chef response to the chat history
+    await chat_service.add_chef_message(message=response["message"], thread_id=response["thread_id"])
+    logger.info(f"Chef response added to chat history: {response['message']}")
+
+    # Response HMTL conversion
+    try:
+        response_html = markdown.markdown(response["message"])
+    except Exception as e:
+        response_html = response["message"]
+        logger.error(f"Error in converting response to HTML: {e}")
+
+    return {
+        "chef_response" : ResponseMessage(
+            content=response["message"], role="ai", thread_id=response["thread_id"],
+            html = response_html
+        ),
+        "thread_id" : response["thread_id"],
+        "session_id": chat_service.session_id
+    }
+
+@router.post(
+    "/get_chef_response/stream",
+    response_description="A stream of server-sent events with the chef response.",
+    summary="Stream a response from the chef to the user's question.",
+    description="""Streams the chef response as server-sent events.  'thread' carries the thread id,
+    'delta' carries each chunk of message text as it is generated, 'tool' carries tool outputs
+    and 'done' carries the final GetChefRequestResponse.  'error' is sent if the run fails.""",
+    tags=["Chat Endpoints"],
+)
+async def stream_chef_response(chef_response: GetChefResponse, chat_service:
+                               ChatService = Depends(get_chat_service),
+                               client: AsyncOpenAI = Depends(get_openai_client)):
+    """ Endpoint to stream a response from the chatbot to a user's question. """
+    assistant_id = get_assistant_id(chef_response.chef_type)
+    thread_id = chef_response.thread_id or await chat_service.get_thread_id()
+    logger.info(f"Streaming chef response for thread ID: {thread_id}")
+
+    await chat_service.add_user_message(message=chef_response.message_content, thread_id=thread_id)
+
+    if get_chat_engine(chef_response.chef_type) == COMPLETIONS_ENGINE:
+        return StreamingResponse(
+            stream_completions_chef_response(chef_response, chat_service, thread_id),
+            media_type="text/event-stream", headers=SSE_HEADERS
         )
-        # Poll the run status
-        response = await poll_run_status(run_id=run.id, thread_id=run.thread_id)
 
-        if response:      # Add the chef response to the chat history
-            chat_service.add_chef_message(
-                message=response["message"], thread_id=run.thread_id
-            )
-            logger.info(f"Chef response added to chat history: {response['message']}")
-
-            # Response HMTL conversion
-            try:
-                response_html = markdown.markdown(response["message"])
-            except Exception as e:
-                response_html = response["message"]
-                logger.error(f"Error in converting response to HTML: {e}")
-
-            return {
-                "chef_response" : ResponseMessage(
-                    content=response["message"], role="ai", thread_id=run.thread_id,
-                    html = response_html
-                ),
-                "thread_id" : run.thread_id,
-                "session_id": chat_service.session_id
-            }
+    run_options = get_run_context_options()
+    message_content = chef_response.message_content
+    if chef_response.save_recipe:
+        message_content = save_recipe_message
+        run_options.update(instructions=save_recipe_instructions, tools=save_recipe_tools, model="gpt-4o")
 
+    run_lock = None
+    if thread_id:
+        # Runs on a thread are made one at a time; the lock is held until the stream ends
+        run_lock = ThreadRunLock(
+            thread_id, get_run_request_key(chef_response.message_content, chef_response.save_recipe)
+        )
+        try:
+            await run_lock.acquire(coalesce=False)
+        except ThreadBusyError as e:
+            raise HTTPException(status_code=409, detail=str(e))
+        try:
+            queued_messages = await chat_service.load_thread_messages(thread_id)
+            run_stream = await client.beta.threads.runs.create(
+                assistant_id=assistant_id,
+                thread_id=thread_id,
+                additional_messages=queued_messages + [{
+                    "role": "user", "content": message_content, "metadata": chef_response.message_metadata
+                }],
+                stream=True,
+                **run_options
+            )
+            if queued_messages:
+                await chat_service.clear_thread_messages()
+        except BaseException:
+            await run_lock.release()
+            raise
     else:
-        run = client.beta.threads.create_and_run(
+        run_stream = await client.beta.threads.create_and_run(
             assistant_id=assistant_id,
             thread={
                 "messages": [
@@ -282,16 +350,131 @@ async def get_chef_response(chef_response: GetChefResponse, chat_service:
                         "role" : "user",
                         "content" : message_content,
                         "metadata" : chef_response.message_metadata
-                    }]}
+                    }]},
+            stream=True,
+            **run_options
         )
-        # Poll the run status
-        response = await poll_run_status(run_id=run.id, thread_id=run.thread_id)
-        # Set the thread_id in the store
-        chat_service.set_thread_id(run.thread_id)
-        logger.info(f"Thread ID set in chat service: {run.thread_id}")
-        response = json.dumps(response)
 
-        return response
+    async def event_stream():
+        run_thread_id = thread_id
+        message = ""
+        adjusted_recipe = None
+        async for event in stream_run_events(run_stream, thread_id):
+            if event["event"] == "thread":
+                if event["data"] != run_thread_id:
+                    run_thread_id = event["data"]
+                    await chat_service.set_thread_id(run_thread_id)
+                    # Save the new thread right away in case the client disconnects
+                    await chat_service.commit()
+            elif event["event"] == "message":
+                message = event["data"]
+            elif event["event"] == "tool" and event["data"]["tool_name"] == "adjust_recipe":
+                adjusted_recipe = event["data"]["output"]
+            yield format_sse(event["event"], event["data"])
+
+        if message and not chef_response.save_recipe:
+            await chat_service.add_chef_message(message=message, thread_id=run_thread_id)
+            logger.info(f"Chef response added to chat history: {message}")
+
+        try:
+            message_html = markdown.markdown(message)
+        except Exception as e:
+            message_html = message
+            logger.error(f"Error in converting response to HTML: {e}")
+
+        yield format_sse("done", {
+            "chef_response": ResponseMessage(
+                content=message, role="ai", thread_id=run_thread_id, html=message_html
+            ).model_dump(),
+            "thread_id": run_thread_id,
+            "adjusted_recipe": adjusted_recipe,
+            "session_id": chat_service.session_id
+        })
+        # The dependency has already committed by the time the response streams
+        await chat_service.commit()
+
+    if run_lock is not None:
+        # Renewed again once the body starts; until then the lock only lives out its TTL
+        run_lock.stop_renewal()
+    return StreamingResponse(
+        release_after(run_lock, event_stream()), media_type="text/event-stream", headers=SSE_HEADERS,
+        background=BackgroundTask(run_lock.release) if run_lock is not None else None
+    )
+
+async def get_completions_request(chef_response: GetChefResponse, chat_service: ChatService) -> dict:
+    """ The messages and tool options for answering the chef request with the completions engine. """
+    summary, chat_history = await get_context_window(chat_service)
+    context = await chat_service.load_context()
+    if chef_response.save_recipe:
+        messages = build_chat_messages(
+            chef_response.chef_type, chat_history, context, save_recipe_instructions, summary
+        ) + [{"role": "user", "content": save_recipe_message}]
+        return {
+            "messages": messages, "tools": save_recipe_tools, "answer_after_tools": False,
+            "tool_choice": {"type": "function", "function": {"name": "adjust_recipe"}},
+        }
+    return {"messages": build_chat_messages(chef_response.chef_type, chat_history, context, summary=summary)}
+
+async def get_completions_chef_response(chef_response: GetChefResponse, chat_service: ChatService,
+                                        thread_id: Optional[str]) -> dict:
+    """ Answer the chef request with a single chat completion over the session's history. """
+    result = await complete_chat(**await get_completions_request(chef_response, chat_service))
+    if result["error"]:
+        raise HTTPException(status_code=500, detail=result["error"])
+    message = result["message"]
+
+    adjusted_recipe = None
+    if chef_response.save_recipe:
+        adjusted_recipe = result["tool_return_values"][0]["output"] if result["tool_return_values"] else None
+    elif message:
+        await chat_service.add_chef_message(message=message, thread_id=thread_id)
+        logger.info(f"Chef response added to chat history: {message}")
+
+    try:
+        message_html = markdown.markdown(message)
+    except Exception as e:
+        message_html = message
+        logger.error(f"Error in converting response to HTML: {e}")
+
+    return {
+        "chef_response": ResponseMessage(content=message, role="ai", thread_id=thread_id, html=message_html),
+        "thread_id": thread_id,
+        "adjusted_recipe": adjusted_recipe,
+        "session_id": chat_service.session_id
+    }
+
+async def stream_completions_chef_response(chef_response: GetChefResponse, chat_service: ChatService,
+                                           thread_id: Optional[str]):
+    """ Stream the answer to the chef request from the completions engine as server-sent events. """
+    message = ""
+    adjusted_recipe = None
+    async for event in stream_completion_events(**await get_completions_request(chef_response, chat_service)):
+        if event["event"] == "message":
+            message = event["data"]
+        elif event["event"] == "tool" and event["data"]["tool_name"] == "adjust_recipe":
+            adjusted_recipe = event["data"]["output"]
+        yield format_sse(event["event"], event["data"])
+
+    if message and not chef_response.save_recipe:
+        await chat_service.add_chef_message(message=message, thread_id=thread_id)
+        logger.info(f"Chef response added to chat history: {message}")
+
+    try:
+        message_html = markdown.markdown(message)
+    except Exception as e:
+        message_html = message
+        logger.error(f"Error in converting response to HTML: {e}")
+
+    yield format_sse("done", {
+        "chef_response": ResponseMessage(
+            content=message, role="ai", thread_id=thread_id, html=message_html
+        ).model_dump(),
+        "thread_id": thread_id,
+        "adjusted_recipe": adjusted_recipe,
+        "session_id": chat_service.session_id
+    })
+    # The dependency has already committed by the time the response streams
+    await chat_service.commit()
 
 @router.post(
     "/clear-chat-history",
@@ -303,21 +486,74 @@ async def get_chef_response(chef_response: GetChefResponse, chat_service:
 )
 async def clear_chat_history(chat_service: ChatService = Depends(get_chat_service)):
     # Clear the chat history
-    response = chat_service.clear_chat_history()
+    response = await chat_service.clear_chat_history()
     return response
 
 @router.get(
     "/view-chat-history", response_description="The chat history, session id and current thread id.",
     summary="View the chat history.", response_model=ViewChatResponse,
+    description="""Returns the whole chat history, or a page of it when limit, before or after
+    is given.  The response carries an ETag; send it back in If-None-Match to get a 304 when
+    the history has not changed.""",
+    responses={304: {"description": "The chat history has not changed."}},
     tags=["Chat Endpoints"]
 )
 async def view_chat_history(
+        request: Request, response: Response,
+        limit: Optional[int] = Query(None, ge=1, le=500, description="The maximum number of messages."),
+        before: Optional[int] = Query(None, ge=0, description="Return the messages before this message id."),
+        after: Optional[int] = Query(None, ge=0, description="Return the messages after this message id."),
         chat_service: ChatService = Depends(get_chat_service)):
     """ Endpoint to view the chat history. """
+    if before is not None and after is not None:
+        raise HTTPException(status_code=400, detail="Only one of before and after may be given.")
+    etag = await chat_service.chat_history_etag()
+    if etag is not None:
+        if request.headers.get("If-None-Match") == etag:
+            return Response(status_code=304, headers={"ETag": etag})
+        response.headers["ETag"] = etag
     # Get the chat history from the store
-    chat_history = chat_service.view_chat_history()
+    chat_history = await chat_service.view_chat_history(limit, before, after)
     return chat_history
 
+def get_recipe_thread_message(recipe, recipe_request: CreateRecipeRequest) -> str:
+    """ The message that gives the chef the context of a newly created recipe. """
+    return f"""Your task is to assist a user with their recipe {recipe},
+    which was created based on their initial specifications {recipe_request.specifications}
+    and serving size {recipe_request.serving_size}. Users may have queries about
+    the recipe or wish to modify it. Your role is to engage in a natural,
+    sous-chef style conversation, providing expert advice and suggestions
+    tailored to their needs. When users request changes or have questions,
+    clarify their requirements through engaging dialogue. Once changes are confirmed,
+    display the updated format clearly and concisely in the same format as the original
+    recipe {recipe} so that they can make sure it looks correct before saving.
+    They may also want to ask you about wine pairings, general cooking questions,
+    etc.  Graciously answer those questions as well. Remember,
+    your role is crucial in ensuring clarity,
+    offering culinary expertise, and confirming the changes during the interaction.
+    Although your role is listed as 'user' due to API constraints.
+    Keep the conversation flowing
+    until it is clear that the user is satisfied with the recipe.  In other words,
+    you are the AI sous chef in this conversation."""
+
+async def add_recipe_to_thread(recipe, recipe_request: CreateRecipeRequest,
+                               chat_service: ChatService, client: AsyncOpenAI) -> str:
+    """ Add the recipe context to the session's thread, creating the thread if
+    the session does not have one yet.  Returns the thread id. """
+    content = get_recipe_thread_message(recipe, recipe_request)
+    # Keep the recipe with the session too, for the completions chat engine
+    await chat_service.set_context(content)
+    thread_id = await chat_service.get_thread_id()
+    if thread_id:
+        # Sent with the thread's next run rather than in a call of its own
+        await chat_service.queue_thread_message(thread_id, content)
+        logger.info(f"Recipe message queued for thread {thread_id}")
+    else:
+        thread_id = await create_thread(role="user", content=content)
+        await chat_service.set_thread_id(thread_id)
+        logger.info(f"Thread ID set in chat service: {thread_id} for recipe message with recipe {recipe}")
+    return thread_id
+
 # Create an endpoint to generate a recipe
 @router.post(
     "/create-recipe",
@@ -333,85 +569,114 @@ async def view_chat_history(
     },
     response_model=CreateRecipeResponse
 )
-async def create_new_recipe(recipe_request: CreateRecipeRequest,
-                            chat_service: ChatService = Depends(get_chat_service)):
+async def create_new_recipe(recipe_request: CreateRecipeRequest, request: Request,
+                            chat_service: ChatService = Depends(get_chat_service),
+                            client: AsyncOpenAI = Depends(get_openai_client)):
     """ Endpoint to get a response from the chatbot to a user's question. """
     try:
-        recipe = await claude_recipe(
-            specifications = recipe_request.specifications, serving_size = recipe_request.serving_size
-        )
-        logger.info(f"Recipe created: {recipe}")
-    except Exception as e:
-        logger.error(f"Error creating recipe: {e} with Claude, retrying with GPT")
-        recipe = await create_recipe(
-            specifications = recipe_request.specifications, serving_size = recipe_request.serving_size
+        recipe = await cancel_on_disconnect(request, hedged_recipe(
+            specifications = recipe_request.specifications, serving_size = recipe_request.serving_size,
+            fresh = recipe_request.fresh
+        ))
+    except ValueError as e:
+        logger.error(f"Error creating recipe: {e}")
+        raise HTTPException(status_code=400, detail=str(e))
+    if recipe is None:
+        logger.error("Error creating recipe: both Claude and GPT failed")
+        raise HTTPException(status_code=500, detail="The recipe could not be generated.")
+    logger.info(f"Recipe created: {recipe}")
+
+    thread_id = await add_recipe_to_thread(recipe, recipe_request, chat_service, client)
+    return {
+        "recipe": recipe, "session_id": chat_service.session_id,
+        "thread_id": thread_id
+    }
+
+@router.post(
+    "/create-recipe/stream",
+    response_description="A stream of server-sent events with the recipe fields as they are generated.",
+    summary="Stream a new recipe as it is generated.",
+    description="""Streams the recipe as server-sent events.  'field' is sent for each completed
+    top-level field (recipe_name, prep_time, ...), 'item' for each ingredient and direction, and
+    'done' carries the validated recipe with the session and thread ids.  'error' is sent if the
+    recipe could not be generated.""",
+    tags=["Recipe Endpoints"],
+)
+async def stream_new_recipe(recipe_request: CreateRecipeRequest,
+                            chat_service: ChatService = Depends(get_chat_service),
+                            client: AsyncOpenAI = Depends(get_openai_client)):
+    """ Endpoint to stream a new recipe field by field.  Cached recipes are
+    sent as a single 'done' event. """
+    if not recipe_request.fresh:
+        recipe = await claude_recipe.get_cached(
+            specifications=recipe_request.specifications, serving_size=recipe_request.serving_size
         )
-    thread_id = chat_service.get_thread_id()
-    if thread_id:
-      client = get_openai_client()
-      message = client.beta.threads.messages.create(
-          thread_id,
-          content=f"""Your task is to assist a user with their recipe {recipe},
-          which was created based on their initial specifications {recipe_request.specifications}
-          and serving size {recipe_request.serving_size}. Users may have queries about
-          the recipe or wish to modify it. Your role is to engage in a natural,
-          sous-chef style conversation, providing expert advice and suggestions
-          tailored to their needs. When users request changes or have questions,
-          clarify their requirements through engaging dialogue. Once changes are confirmed,
-          display the updated format clearly and concisely in the same format as the original
-          recipe {recipe} so that they can make sure it looks correct before saving.
-          They may also want to ask you about wine pairings, general cooking questions,
-          etc.  Graciously answer those questions as well. Remember,
-          your role is crucial in ensuring clarity,
-          offering culinary expertise, and confirming the changes during the interaction.
-          Although your role is listed as 'user' due to API constraints.
-          Keep the conversation flowing
-          until it is clear that the user is satisfied with the recipe.  In other words,
-          you are the AI sous chef in this conversation.""",
-          role="user",
-          metadata={},
-      )
-      # Log the message
-      logger.info(f"Message {message.content} added to thread {thread_id}")
-      # Check to see if the recipe is already a JSON object
-      if isinstance(recipe, dict):
-          return {
-              "recipe": json.dumps(recipe), "session_id": chat_service.session_id,
-              "thread_id": thread_id
-          }
-      else:
-          return {
-              "recipe": recipe, "session_id": chat_service.session_id,
-              "thread_id": thread_id
-          }
+        if recipe is not None:
+            async def cached_stream():
+                thread_id = await add_recipe_to_thread(recipe, recipe_request, chat_service, client)
+                await chat_service.commit()
+                yield format_sse("done", {
+                    "recipe": recipe.model_dump(), "session_id": chat_service.session_id,
+                    "thread_id": thread_id
+                })
+            return StreamingResponse(cached_stream(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+    query = recipe_request.specifications + recipe_request.serving_size
+    is_food = classify_food_query(query)
+    filter_task = None
+    if is_food is None and get_speculative_generation():
+        # Start streaming while the LLM filter runs; nothing is sent until it passes
+        filter_task = asyncio.create_task(filter_query(query))
     else:
-      thread_id = create_thread(role="user", content=f"""
-      Your task is to assist a user with their recipe {recipe},
-      which was created based on their initial specifications {recipe_request.specifications}
-      and serving size {recipe_request.serving_size}. Users may have queries about
-      the recipe or wish to modify it. Your role is to engage in a natural,
-      sous-chef style conversation, providing expert advice and suggestions
-      tailored to their needs. When users request changes or have questions,
-      clarify their requirements through engaging dialogue. Once changes are confirmed,
-      display the updated format clearly and concisely in the same format as the original
-      recipe {recipe} so that they can make sure it looks correct before saving.
-      They may also want to ask you about wine pairings, general cooking questions,
-      etc.  Graciously answer those questions as well. Remember,
-      your role is crucial in ensuring clarity,
-      offering culinary expertise, and confirming the changes during the interaction.
-      Although your role is listed as 'user' due to API constraints.
-      Keep the conversation flowing
-      until it is clear that the user is satisfied with the recipe.  In other words,
-      you are the AI sous chef in this conversation.
-      """)
-      chat_service.set_thread_id(thread_id)
-      logger.info(f"Thread ID set in chat service: {thread_id} for recipe message with recipe {recipe}")
-      return {
-          "recipe": recipe, "session_id": chat_service.session_id,
-          "thread_id": thread_id
-      }
-
+        if is_food is None:
+            is_food = await filter_query(query)
+        if not is_food:
+            logger.debug(f"Query {recipe_request.specifications} is not related to food.")
+            raise HTTPException(status_code=400, detail="Query is not related to food.")
+
+    serving_size = serving_size_dict.get(recipe_request.serving_size, recipe_request.serving_size)
+    messages = get_claude_recipe_messages(recipe_request.specifications, serving_size)
+
+    async def event_stream():
+        recipe_stream = stream_claude_recipe(messages, system=claude_system_message)
+        try:
+            async for event in recipe_stream:
+                # The generation starts immediately, the filter verdict gates what is sent
+                if filter_task is not None and not await filter_task:
+                    logger.debug(f"Query {recipe_request.specifications} is not related to food.")
+                    yield format_sse("error", "Query is not related to food.")
+                    return
+                if event["event"] != "recipe":
+                    yield format_sse(event["event"], event["data"])
+                    continue
+                recipe = Recipe(**event["data"])
+                if not recipe_request.fresh:
+                    await claude_recipe.set_cached(
+                        recipe, specifications=recipe_request.specifications,
+                        serving_size=recipe_request.serving_size
+                    )
+                thread_id = await add_recipe_to_thread(recipe, recipe_request, chat_service, client)
+                await chat_service.commit()
+                yield format_sse("done", {
+                    "recipe": event["data"], "session_id": chat_service.session_id,
+                    "thread_id": thread_id
+                })
+        finally:
+            if filter_task is not None:
+                filter_task.cancel()
+            await recipe_stream.aclose()
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers=SSE_HEADERS)
 
+@router.get(
+    "/recipe-cache-stats",
+    response_description="The number of cached recipes and the lookups, hits and misses per function.",
+    summary="View the recipe cache statistics.",
+    tags=["Recipe Endpoints"]
+)
+async def recipe_cache_stats():
+    """ Endpoint to view the recipe cache statistics. """
+    return await get_recipe_cache_stats()
 
 @router.post(
     "/add-message-to-thread",
@@ -419,12 +684,12 @@ async def create_new_recipe(recipe_request: CreateRecipeRequest,
     description="Add a message to a thread.  Pass the thread id and message content in the body.",
     response_model=AddMessageResponse, tags=["Chat Endpoints"]
 )
-async def add_message_to_thread(message_request: AddMessageToThread):
+async def add_message_to_thread(message_request: AddMessageToThread,
+                                client: AsyncOpenAI = Depends(get_openai_client)):
     """ Endpoint to add a message to a thread. """
     # Add the message to the thread
-    client = get_openai_client()
     try:
-        message = client.beta.threads.messages.create(
+        message = await client.beta.threads.messages.create(
             message_request.thread_id,
             content=message_request.message_content,
             role="user",
@@ -445,7 +710,8 @@ async def add_message_to_thread(message_request: AddMessageToThread):
 async def create_recipe_test(recipe_request: CreateRecipeRequest):
     """ Endpoint to create a recipe. """
     recipe = await claude_recipe(
-        specifications = recipe_request.specifications, serving_size = recipe_request.serving_size
+        specifications = recipe_request.specifications, serving_size = recipe_request.serving_size,
+        fresh = recipe_request.fresh
     )
     return recipe
 
@@ -461,6 +727,6 @@ async def create_ingredients_recipe_test(recipe_request: IngredientsRecipeReques
     )
     recipe = await claude_ingredients_recipe(
         specifications = recipe_request.specifications, serving_size = recipe_request.serving_size,
-        ingredients_list=recipe_request.ingredients
+        ingredients_list=recipe_request.ingredients, fresh=recipe_request.fresh
     )
     return recipe
@@ -2,14 +2,14 @@
 import base64
 import logging
 import json
-from typing import List
+from typing import AsyncIterator, List
 from pathlib import Path
 from fastapi import (
     APIRouter, UploadFile,
     HTTPException, Request, Depends, File
 )
 # import google.cloud.vision as vision  # pylint: disable=no-member
-from app.dependencies import get_google_vision_credentials, get_openai_client
+from app.dependencies import get_google_vision_credentials
 from app.services.extraction_service import (
     extract_image_text, extract_pdf_file_contents,
     extract_text_file_contents, extract_docx_file_contents
@@ -19,14 +19,14 @@ from app.models.recipe import (
     FormattedRecipeResponse, FormatRecipeTextRequest
 )
 from app.services.chat_service import ChatService
-from app.middleware.session_middleware import RedisStore
+from app.middleware.session_middleware import get_redis_store
+from app.utils.deadline_utils import check_deadline, DeadlineExceeded
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger("main")
 
 # Load the environment variables
 credentials = get_google_vision_credentials()
-client = get_openai_client()
 
 UPLOAD_DIR = Path(__file__).parent.parent.parent / "uploads"
 
@@ -70,11 +70,15 @@ def get_session_id(request: Request) -> str:
     session_id = request.headers.get("Session-ID")
     return session_id
 
-def get_chat_service(request: Request) -> ChatService:
-    """ Define a function to get the chat service. """
-    session_id = get_session_id(request)
-    redis_store = RedisStore(session_id)
-    return ChatService(store=redis_store)
+async def get_chat_service(request: Request) -> AsyncIterator[ChatService]:
+    """ Define a function to get the chat service.  The session changes made
+    by the endpoint are written back in one transaction when it returns. """
+    redis_store = get_redis_store(request)
+    chat_service = await ChatService.create(store=redis_store)
+    try:
+        yield chat_service
+    finally:
+        await chat_service.commit()
 
 @router.post(
     "/upload-files",
@@ -95,6 +99,8 @@ async def extract_and_format_recipes(
     i = 0
     while i <= 3:
         try:
+            # Only retry while the request has time left
+            check_deadline()
             logger.info(f"Received {len(files)} files for processing.")
 
             file_types = set([file.filename.split(".")[-1] for file in files])
@@ -117,7 +123,7 @@ async def extract_and_format_recipes(
                 formatted_text = await format_recipe(extracted_text)
 
             elif file_type == "txt":
-                extracted_text = extract_text_file_contents(
+                extracted_text = await extract_text_file_contents(
                     [file.file.read().decode('utf-8', errors='ignore') for file in files]
                 )
                 formatted_text = await format_recipe(extracted_text)
@@ -143,6 +149,8 @@ async def extract_and_format_recipes(
                 "session_id": chat_service.session_id,
                 "thread_id": chat_service.thread_id
             }
+        except DeadlineExceeded:
+            raise
         except Exception as e:
             logger.error(f"Error processing files: {e}")
             logger.debug(f"Retrying... {i + 1} attempt to process files.")
@@ -165,14 +173,18 @@ async def format_text_endpoint(recipe_text: FormatRecipeTextRequest, chat_servic
     i = 0
     while i <= 3:
         try:
-            recipe = await format_recipe(recipe_text.recipe_text)
+            # Only retry while the request has time left
+            check_deadline()
+            recipe = await format_recipe(recipe_text.recipe_text, fresh=recipe_text.fresh)
             # Add a user message to the chat history
-            chat_service.add_user_message(f"Here is a recipe that I have uploaded and formatted for you:\
+            await chat_service.add_user_message(f"Here is a recipe that I have uploaded and formatted for you:\
                 {recipe}")
 
             # Return the formatted recipe
             return {"formatted_recipe": json.loads(recipe), "session_id": chat_service.session_id,
                     "thread_id": chat_service.thread_id}
+        except DeadlineExceeded:
+            raise
         except Exception as e:
             logger.error(f"Error formatting recipe text: {e}")
             logger.debug(f"Retrying... {i + 1} attempt to format recipe text.")
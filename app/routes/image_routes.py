@@ -1,10 +1,12 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Request
 import logging
 from pydantic import BaseModel, Field
 from typing import Union
 import json
 from app.services.image_service import get_image_prompt, create_image_string
-from models.recipe import Recipe, FormattedRecipe
+from app.models.recipe import Recipe, FormattedRecipe
+from app.utils.deadline_utils import DeadlineExceeded
+from app.utils.disconnect_utils import cancel_on_disconnect
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger("main")
@@ -28,7 +30,7 @@ class ImageResponse(BaseModel):
     tags = ["Image Endpoints"],
     response_model = ImageResponse
 )
-async def create_image(recipe: ImageRequest) -> ImageResponse:
+async def create_image(recipe: ImageRequest, request: Request) -> ImageResponse:
     """ Endpoint to generate an image based on the given recipe. """
     try:
         logger.debug(
@@ -38,11 +40,13 @@ async def create_image(recipe: ImageRequest) -> ImageResponse:
         if isinstance(recipe.recipe, str):
             recipe.recipe = json.loads(recipe.recipe)
             logger.info(f"Recipe converted to dictionary: {recipe.recipe} for image generation.")
-        prompt = await get_image_prompt(recipe.recipe)
+        prompt = await cancel_on_disconnect(request, get_image_prompt(recipe.recipe))
         logger.debug(f"Generated prompt: {prompt}")
-        image_string = await create_image_string(prompt)
+        image_string = await cancel_on_disconnect(request, create_image_string(prompt))
         logger.debug("Image string created")
         return ImageResponse(image_string=image_string)
+    except (HTTPException, DeadlineExceeded):
+        raise
     except Exception as e:
         logger.error(f"Error creating image: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -0,0 +1,19 @@
+""" The routes for the worker metrics """
+import logging
+from fastapi import APIRouter
+from app.utils.metrics_utils import metrics
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger("main")
+
+router = APIRouter()
+
+@router.get(
+    "/metrics",
+    response_description="The counters, latency percentiles and component state for this worker.",
+    summary="View the worker metrics.",
+    tags=["Metrics Endpoints"]
+)
+async def get_metrics():
+    """ Endpoint to view the in-process metrics of this worker. """
+    return metrics.snapshot()
@@ -0,0 +1,44 @@
+""" Tests for the chat history endpoint """
+import unittest
+from unittest import mock
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from app.routes.chat_routes import get_chat_service, router
+
+class TestChatRoutes(unittest.TestCase):
+    """ Tests for the ETag and cursors of /view-chat-history. """
+    def setUp(self):
+        self.chat_service = mock.MagicMock()
+        self.chat_service.chat_history_etag = mock.AsyncMock(return_value='"2-abc"')
+        self.chat_service.view_chat_history = mock.AsyncMock(
+            return_value={"chat_history": [], "has_more": False, "session_id": "session"}
+        )
+        app = FastAPI()
+        app.include_router(router)
+        app.dependency_overrides[get_chat_service] = lambda: self.chat_service
+        self.client = TestClient(app)
+
+    def test_unchanged_history_is_not_modified(self):
+        """ A poll with the current ETag gets a 304 without the history being read. """
+        response = self.client.get("/view-chat-history")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["ETag"], '"2-abc"')
+
+        response = self.client.get("/view-chat-history", headers={"If-None-Match": '"2-abc"'})
+        self.assertEqual(response.status_code, 304)
+        self.chat_service.view_chat_history.assert_awaited_once()
+
+    def test_history_is_served_without_an_etag(self):
+        """ Without an ETag (Redis unavailable) the history is still returned. """
+        self.chat_service.chat_history_etag.return_value = None
+        response = self.client.get("/view-chat-history", headers={"If-None-Match": '"2-abc"'})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("ETag", response.headers)
+
+    def test_before_and_after_are_exclusive(self):
+        """ Asking for both cursors is rejected. """
+        response = self.client.get("/view-chat-history", params={"before": 3, "after": 1})
+        self.assertEqual(response.status_code, 400)
+
+if __name__ == "__main__":
+    unittest.main()
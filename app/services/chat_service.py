@@ -1,12 +1,17 @@
 """ This module defines the ChatService class, which is responsible for managing the chatbot. """
 import json
-from typing import Union, Optional
+import hashlib
+import time
+from typing import Tuple, Union, Optional
 import logging
 import base64
 from redis.exceptions import RedisError
-from app.dependencies import get_openai_client
 from app.middleware.session_middleware import RedisStore
-client = get_openai_client()
+from app.utils.context_utils import get_context_token_budget, split_context_window
+from app.utils.session_utils import (
+    decode_message, encode_message, get_session_refresh_interval, get_session_ttl, session_cache,
+    INVALIDATION_CHANNEL, WORKER_ID
+)
 # Create a dictionary to house the chef data to populate the chef model
 
 # Establish the core models that will be used by the chat service
@@ -15,122 +20,302 @@ core_models = ["gpt-3.5-turbo", "gpt-3.5-turbo-0613", "gpt-3.5-turbo-16k"]
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger("main")
 
+# The session keys whose sliding TTL is refreshed whenever the session is accessed
+expiring_fields = ["chef_type", "thread_id", "messages", "context", "summary", "thread_messages"]
+
 class ChatMessage:
     """ A class to represent a chat message. """
     def __init__(self, content, role, thread_id: Optional[str] = None):
         self.content = content
         self.role = role
         self.thread_id = thread_id
+        self.created_at = int(time.time())
 
     def format_message(self):
         """ Format the message for the chat history. """
         # Return a dictionary with the format {"role": role, "content": content,
-        # "thread_id": thread_id}
-        return {"role": self.role, "content": self.content, "thread_id": self.thread_id}
+        # "thread_id": thread_id, "created_at": created_at}
+        return {"role": self.role, "content": self.content, "thread_id": self.thread_id,
+                "created_at": self.created_at}
 
 class ChatService:
-    """ A class to represent the chatbot. """
+    """ A class to represent the chatbot.  The chat history is stored as a Redis list
+    under {session_id}:messages with one JSON message per entry, so a new message is a
+    single RPUSH rather than a rewrite of the whole history.  Every session key has a
+    sliding TTL that is refreshed whenever the session is loaded or saved. """
     def __init__(self, store: RedisStore = None):
         self.store = store
         self.session_id = self.store.session_id
-        self.chef_type = self.store.redis.get(f'{self.session_id}:chef_type')
-        chat_history = self.store.redis.get(f'{self.session_id}:chat_history')
-        if chat_history:
-            self.chat_history = chat_history
-        else:
-            self.chat_history = []
-        if self.chef_type:
-            self.chef_type = self.chef_type
+        self.chef_type = "home_cook"
+        self.thread_id = None
+        self.context = None
+        # Writes made during the request, flushed together by commit()
+        self.pending_writes = {}
+        self.new_messages = []
+        self.history_reset = False
+
+    @classmethod
+    async def create(cls, store: RedisStore = None):
+        """ Create the chat service and load the session state from Redis. """
+        service = cls(store)
+        await service.load_session()
+        return service
+
+    def session_key(self, field: str) -> str:
+        """ The Redis key for a field of the session. """
+        return f'{self.session_id}:{field}'
+
+    async def load_session(self):
+        """ Load the chef type and thread_id for the session and refresh its TTL in one
+        round trip, or from the in-process cache when this worker has them, refreshing the
+        TTL at most every SESSION_REFRESH_INTERVAL.  The chat history is only read when it
+        is needed. """
+        cached = session_cache.get(self.session_id)
+        if cached is not None:
+            self.chef_type = cached["chef_type"]
+            self.thread_id = cached["thread_id"]
+            if session_cache.refresh_due(self.session_id, get_session_refresh_interval()):
+                await self.refresh_ttl()
+            return
+        ttl = get_session_ttl()
+        try:
+            async with self.store.redis.pipeline(transaction=False) as pipe:
+                pipe.mget(
+                    self.session_key("chef_type"), self.session_key("thread_id"), self.session_key("chat_history")
+                )
+                for field in expiring_fields:
+                    pipe.expire(self.session_key(field), ttl)
+                (chef_type, thread_id, legacy_history), *_ = await pipe.execute()
+        except RedisError as e:
+            logger.error("Failed to load the session from Redis: %s", e)
+            return
+        if legacy_history is not None:
+            await self.migrate_chat_history(legacy_history)
+        if chef_type:
+            self.chef_type = chef_type.decode()
         else:
             self.chef_type = "home_cook"
-            self.save_chef_type()
-        self.thread_id = self.store.redis.get(f'{self.session_id}:thread_id')
-        if self.thread_id:
-            self.thread_id = self.thread_id.decode()
+            await self.save_chef_type()
+        if thread_id:
+            self.thread_id = thread_id.decode()
             logger.info(f"Thread ID loaded from Redis: {self.thread_id}")
         else:
             self.thread_id = None
+        session_cache.set(self.session_id, {"chef_type": self.chef_type, "thread_id": self.thread_id})
 
-    def load_chat_history(self):
-        """ Load the chat history from Redis. """
+    async def refresh_ttl(self):
+        """ Reset the sliding TTL of the session keys. """
+        ttl = get_session_ttl()
         try:
-            # Load the chat history from redis.  If there is not chat history, return an empty list
-            chat_history = self.store.redis.get(f'{self.session_id}:chat_history')
-            if chat_history:
-                return json.loads(chat_history)
-            return []
+            async with self.store.redis.pipeline(transaction=False) as pipe:
+                for field in expiring_fields:
+                    pipe.expire(self.session_key(field), ttl)
+                await pipe.execute()
         except RedisError as e:
-            logger.log(logger.ERROR, "Failed to load chat history from Redis: %s", e)
-            return []
+            logger.error("Failed to refresh the session TTL in Redis: %s", e)
 
-    def save_chat_history(self):
-        """ Save the chat history to Redis. """
+    async def migrate_chat_history(self, legacy_history: bytes):
+        """ Move a chat history stored as a single JSON blob under {session_id}:chat_history
+        onto the message list. """
+        messages = json.loads(legacy_history) if legacy_history else []
         try:
-            chat_history_json = json.dumps(self.chat_history)
-            self.store.redis.set(f'{self.session_id}:chat_history', chat_history_json)
+            async with self.store.redis.pipeline(transaction=True) as pipe:
+                pipe.delete(self.session_key("messages"))
+                if messages:
+                    pipe.rpush(self.session_key("messages"), *[encode_message(message) for message in messages])
+                    pipe.expire(self.session_key("messages"), get_session_ttl())
+                pipe.delete(self.session_key("chat_history"))
+                await pipe.execute()
+            logger.info(f"Migrated {len(messages)} messages for session {self.session_id}")
         except RedisError as e:
-            logger.log(logger.ERROR, "Failed to save chat history to Redis: %s", e)
-        return self.chat_history
+            logger.error("Failed to migrate the chat history: %s", e)
 
-    def save_chef_type(self):
-        """ Save the chef type to Redis. """
+    async def commit(self):
+        """ Write every change made during the request in a single MULTI/EXEC. """
+        if not (self.pending_writes or self.new_messages or self.history_reset):
+            return
+        writes, self.pending_writes = self.pending_writes, {}
+        messages, self.new_messages = self.new_messages, []
+        history_reset, self.history_reset = self.history_reset, False
+        ttl = get_session_ttl()
         try:
-            self.store.redis.set(f'{self.session_id}:chef_type', self.chef_type)
+            async with self.store.redis.pipeline(transaction=True) as pipe:
+                for key, value in writes.items():
+                    pipe.set(key, value, ex=ttl)
+                if history_reset:
+                    pipe.delete(self.session_key("messages"))
+                if messages:
+                    pipe.rpush(self.session_key("messages"), *[encode_message(message) for message in messages])
+                    pipe.expire(self.session_key("messages"), ttl)
+                if writes:
+                    # Tell the other workers to drop their cached copy of the session
+                    pipe.publish(INVALIDATION_CHANNEL, f"{WORKER_ID}:{self.session_id}")
+                await pipe.execute()
+            if writes:
+                session_cache.set(self.session_id, {"chef_type": self.chef_type, "thread_id": self.thread_id})
         except RedisError as e:
-            logger.log(logger.ERROR, "Failed to save chef type to Redis: %s", e)
-        return self.chef_type
+            logger.error("Failed to save the session to Redis: %s", e)
+            session_cache.invalidate(self.session_id)
 
-    # Define a function to load the chef type from Redis
-    def load_chef_type(self):
-        """ Load the chef type from Redis. """
+    async def load_chat_history(self):
+        """ Load the chat history from Redis, including messages added during the request. """
+        if self.history_reset:
+            return list(self.new_messages)
+        try:
+            stored = await self.store.redis.lrange(self.session_key("messages"), 0, -1)
+        except RedisError as e:
+            logger.error("Failed to load chat history from Redis: %s", e)
+            stored = []
+        return [decode_message(message) for message in stored] + self.new_messages
+
+    async def load_chat_page(self, limit: Optional[int] = None, before: Optional[int] = None,
+                             after: Optional[int] = None) -> dict:
+        """ Load a page of the stored chat history.  Each message gets an "id", its position
+        in the history, to use as the before / after cursor for the next page.  Without a
+        cursor the latest limit messages are returned; without a limit, all of them.  Only
+        one of before and after may be given. """
+        if before is not None and after is not None:
+            raise ValueError("Only one of before and after may be given.")
+        if after is not None:
+            start, end = after + 1, after + limit if limit else -1
+        elif before is not None:
+            start, end = max(0, before - limit) if limit else 0, before - 1
+        else:
+            start, end = -limit if limit else 0, -1
+        if before == 0:
+            return {"chat_history": [], "has_more": False}
+        try:
+            async with self.store.redis.pipeline(transaction=False) as pipe:
+                pipe.llen(self.session_key("messages"))
+                pipe.lrange(self.session_key("messages"), start, end)
+                length, stored = await pipe.execute()
+        except RedisError as e:
+            logger.error("Failed to load chat history from Redis: %s", e)
+            return {"chat_history": [], "has_more": False}
+        first_id = max(0, length + start) if start < 0 else start
+        messages = [{**decode_message(message), "id": first_id + index} for index, message in enumerate(stored)]
+        if after is not None:
+            has_more = first_id + len(messages) < length
+        else:
+            has_more = first_id > 0 and bool(messages)
+        return {"chat_history": messages, "has_more": has_more}
+
+    async def chat_history_etag(self) -> Optional[str]:
+        """ An ETag for the stored chat history, built from its length and last message
+        so that it can be checked without reading the history.  None if Redis is unavailable. """
+        try:
+            async with self.store.redis.pipeline(transaction=False) as pipe:
+                pipe.llen(self.session_key("messages"))
+                pipe.lindex(self.session_key("messages"), -1)
+                length, last_message = await pipe.execute()
+        except RedisError as e:
+            logger.error("Failed to load the chat history ETag from Redis: %s", e)
+            return None
+        digest = hashlib.sha1(last_message or b"").hexdigest()[:16]
+        return f'"{length}-{digest}"'
+
+    async def load_context(self) -> Optional[str]:
+        """ Load the context for the conversation, e.g. the recipe being discussed.  It
+        gives the direct chat engine what an Assistants thread would otherwise hold. """
+        if self.context is None:
+            try:
+                context = await self.store.redis.get(self.session_key("context"))
+            except RedisError as e:
+                logger.error("Failed to load the chat context from Redis: %s", e)
+                context = None
+            self.context = context.decode() if context else ""
+        return self.context or None
+
+    async def set_context(self, context: str):
+        """ Set the context for the conversation. """
+        self.context = context
+        self.pending_writes[self.session_key("context")] = context
+        return context
+
+    async def queue_thread_message(self, thread_id: str, content: str):
+        """ Queue a user message for the thread, to be sent with its next run instead of
+        on its own. """
+        messages = await self.load_thread_messages(thread_id)
+        messages.append({"role": "user", "content": content})
+        self.pending_writes[self.session_key("thread_messages")] = json.dumps(
+            {"thread_id": thread_id, "messages": messages}
+        )
+
+    async def load_thread_messages(self, thread_id: str) -> list:
+        """ Load the messages queued for the thread. """
+        stored = self.pending_writes.get(self.session_key("thread_messages"))
+        if stored is None:
+            try:
+                stored = await self.store.redis.get(self.session_key("thread_messages"))
+            except RedisError as e:
+                logger.error("Failed to load the queued thread messages from Redis: %s", e)
+        if not stored:
+            return []
+        queued = json.loads(stored)
+        return queued["messages"] if queued["thread_id"] == thread_id else []
+
+    async def clear_thread_messages(self):
+        """ Drop the queued messages once they have been sent with a run. """
+        self.pending_writes[self.session_key("thread_messages")] = ""
+
+    async def load_summary(self) -> Tuple[Optional[str], int]:
+        """ Load the summary of the earlier conversation and the number of messages,
+        from the start of the history, that it covers. """
+        if self.history_reset:
+            return None, 0
         try:
-            chef_type = self.store.redis.get(f'{self.session_id}:chef_type')
-            if chef_type:
-                return chef_type
-            return "home_cook"
+            stored = await self.store.redis.get(self.session_key("summary"))
         except RedisError as e:
-            logger.log(logger.ERROR, "Failed to load chef type from Redis: %s", e)
-            return "home_cook"
+            logger.error("Failed to load the chat summary from Redis: %s", e)
+            stored = None
+        if not stored:
+            return None, 0
+        summary = json.loads(stored)
+        return summary["summary"], summary["covered"]
+
+    async def reset_chat_history(self, messages: list):
+        """ Replace the whole chat history, and drop its summary, when the request is committed. """
+        self.history_reset = True
+        self.pending_writes[self.session_key("summary")] = ""
+        self.new_messages = list(messages)
+        return self.new_messages
+
+    async def save_chef_type(self):
+        """ Queue the chef type to be saved to Redis. """
+        self.pending_writes[self.session_key("chef_type")] = self.chef_type
+        return self.chef_type
 
-    def add_user_message(self, message: str, thread_id: Optional[str] = None):
+    # Define a function to load the chef type from Redis
+    async def load_chef_type(self):
+        """ Return the chef type loaded with the session. """
+        return self.chef_type
+
+    async def add_user_message(self, message: str, thread_id: Optional[str] = None):
         """ Add a message from the user to the chat history. """
-        # Format the message and add it to the chat history
+        # Format the message and queue it to be appended to the chat history
         user_message = ChatMessage(message, "user", thread_id).format_message()
-        self.chat_history = self.load_chat_history()
-        self.chat_history.append(user_message)
-        # Save the chat history to redis
-        return self.save_chat_history()
+        self.new_messages.append(user_message)
+        return user_message
 
     # Define a function to add a message from the chef to the chat history
-    def add_chef_message(self, message: str, thread_id: Optional[str] = None):
+    async def add_chef_message(self, message: str, thread_id: Optional[str] = None):
         """ Add a message from the chef to the chat history. """
         chef_message = ChatMessage(message, "ai", thread_id).format_message()
-        self.chat_history.append(chef_message)
-        # Save the chat history to redis
-        return self.save_chat_history()
+        self.new_messages.append(chef_message)
+        return chef_message
 
     # Define a function to set the thread_id
-    def set_thread_id(self, thread_id: str):
+    async def set_thread_id(self, thread_id: str):
         """ Set the thread_id. """
-        try:
-            self.store.redis.set(f'{self.session_id}:thread_id', thread_id)
-            logger.info(f"Thread ID set to {thread_id} in Redis")
-        except RedisError as e:
-            logger.log(logger.ERROR, "Failed to set thread_id in Redis: %s", e)
+        self.thread_id = thread_id or None
+        self.pending_writes[self.session_key("thread_id")] = thread_id
+        logger.info(f"Thread ID set to {thread_id}")
         return thread_id
 
     # Define a function to load the thread_id
-    def get_thread_id(self):
+    async def get_thread_id(self):
         """ Get the thread_id. """
-        try:
-            thread_id = self.store.redis.get(f'{self.session_id}:thread_id')
-            if thread_id:
-                return thread_id.decode()
-            # Create a new thread_id if one does not exist
-            return None
-        except RedisError as e:
-            logger.log(logger.ERROR, "Failed to load thread_id from Redis: %s", e)
-            return None
+        return self.thread_id
 
     # @TODO Define a function to add a message to a thread
 
@@ -140,47 +325,50 @@ class ChatService:
         # Set the chef type if it is passed in
         if chef_type:
             self.chef_type = chef_type
-            self.save_chef_type()
+            await self.save_chef_type()
+        # Carry over the summary and the most recent turns rather than the whole history
+        summary, _ = await self.load_summary()
+        _, chat_history = split_context_window(await self.load_chat_history(), get_context_token_budget())
+        if summary:
+            chat_history = [{"role": "system", "content": f"Summary of the earlier conversation: {summary}"}] + chat_history
         # Set the initial message
         initial_message = {
             "role": "system",
             "content": f"""
-            The context, if any, is {context}  Your chat history so far is {self.chat_history}.
+            The context, if any, is {context}  Your chat history so far is {chat_history}.
             Please remember that you are on a website called "Bakespace" that
             is a social and recipe platform that allows users to create, upload, and share recipes as
             well as create cookbooks for themselves and other users to enjoy.
             """
         }
-        # Add the initial message to the chat history
-        self.chat_history = [initial_message]
-
-        # Save the chat history to redis
-        self.save_chat_history()
+        # Replace the chat history with the initial message
+        chat_history = await self.reset_chat_history([initial_message])
 
         # Log the chat history
-        logger.log(logger.INFO, "Chat history successfully initialized: %s", self.chat_history)
+        logger.info("Chat history successfully initialized: %s", chat_history)
 
-        return {"chat_history": self.chat_history, "session_id": self.session_id}
+        return {"chat_history": chat_history, "session_id": self.session_id}
 
-    def clear_chat_history(self):
+    async def clear_chat_history(self):
         """ Clear the chat history. """
-        self.chat_history = []
-        self.save_chat_history()
-        # Reset the thread_id
-        self.set_thread_id("")
+        await self.reset_chat_history([])
+        # Reset the thread_id and the context that went with it
+        await self.set_thread_id("")
+        await self.set_context("")
 
         # Return the session_id, the chat_history, and "Chat history cleared" as a json object
-        return {"session_id": self.session_id, "chat_history": self.load_chat_history(),
+        return {"session_id": self.session_id, "chat_history": await self.load_chat_history(),
                 "message": "Chat history cleared"}
 
-    def view_chat_history(self):
-        """ View the chat history. """
+    async def view_chat_history(self, limit: Optional[int] = None, before: Optional[int] = None,
+                                after: Optional[int] = None):
+        """ View the chat history, or a page of it. """
         # Return the chat_history and the session_id as a json object
-        return {
-            "chat_history": self.load_chat_history(), "session_id": self.session_id
-        }
+        page = await self.load_chat_page(limit, before, after)
+        return {**page, "session_id": self.session_id}
 
-    def check_status(self):
+    async def check_status(self, include_history: bool = True):
         """ Return the session id and any user data from Redis. """
-        return {"session_id": self.session_id, "chat_history": self.load_chat_history(),
+        chat_history = await self.load_chat_history() if include_history else None
+        return {"session_id": self.session_id, "chat_history": chat_history,
                 "chef_type": self.chef_type, "thread_id": self.thread_id}
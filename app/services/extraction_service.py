@@ -1,19 +1,25 @@
 """ Utility functions for extracting text from images and text files. """
 from typing import List
+import asyncio
 import logging
+import os
 from io import BytesIO
 from fastapi import UploadFile
 import google.cloud.vision as vision  # pylint: disable=no-member
 import pdfplumber
 import docx
-from app.dependencies import get_google_vision_credentials, get_openai_client
+from app.dependencies import get_google_vision_credentials
+from app.utils.deadline_utils import deadline_timeout, DeadlineExceeded
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger("main")
 
 # Load the environment variables
 credentials = get_google_vision_credentials()
-client = get_openai_client()
+
+def get_ocr_timeout() -> float:
+    """ The timeout of a Google Vision text detection call, in seconds. """
+    return float(os.getenv("OCR_TIMEOUT", "30"))
 
 async def extract_docx_file_contents(files: List[UploadFile]) -> str:
     """ Extract the text from the docx file. """
@@ -60,9 +66,14 @@ async def extract_image_text(files: List[bytes]) -> str:
     try:
         for file in files:
             image = vision.Image(content=file)
-            response = client.document_text_detection(image=image)
+            # The vision client is blocking, so run it off the event loop
+            response = await asyncio.to_thread(
+                client.document_text_detection, image=image, timeout=deadline_timeout(get_ocr_timeout())
+            )
             response_text = response.full_text_annotation.text
             total_response_text += response_text
+    except DeadlineExceeded:
+        raise
     except Exception as e:
         logger.error(f"Error extracting text from image file: {e}")
     return response_text
@@ -1,9 +1,10 @@
 """ Service Utilities for Image Generation """
 from typing import Union
-from app.dependencies import get_openai_api_key, get_openai_org
-from openai import OpenAI, OpenAIError
+from app.dependencies import get_openai_client
+from openai import OpenAIError
 import logging
-from models.recipe import Recipe, FormattedRecipe
+from app.models.recipe import Recipe, FormattedRecipe
+from app.utils.singleflight_utils import singleflight
 import base64
 import io
 from PIL import Image
@@ -11,8 +12,6 @@ from PIL import Image
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger("main")
 
-client = OpenAI(api_key=get_openai_api_key(), organization=get_openai_org(), max_retries=3, timeout=55)
-
 # Decode Base64 JSON to Image
 async def decode_image(image_data, image_name):
     """ Decode the image data from the given image request. """
@@ -23,12 +22,15 @@ async def decode_image(image_data, image_name):
     # Save the image
     return image.save(image_name)
 
+# Failures come back as an {"error": ...} dict, which is not shared with other callers
+@singleflight("create_image_string", succeeded=lambda result: isinstance(result, str))
 async def create_image_string(prompt : str):
     """ Generate an image from the given image request. """
     logger.info(f"Generating image for prompt: {prompt}")
     # Generate the image
+    client = get_openai_client()
     try:
-        response = client.images.generate(
+        response = await client.images.generate(
             prompt=prompt,
             model="dall-e-3",
             size="1024x1024",
@@ -46,6 +48,7 @@ async def create_image_string(prompt : str):
         logger.error(f"Error generating image: {e}")
         return {"error": str(e)}
 
+@singleflight("get_image_prompt")
 async def get_image_prompt(recipe: Union[dict, str, Recipe, FormattedRecipe]) -> str:
     logger.info(f"Generating prompt for image generation for recipe: {recipe}")
     messages = [
@@ -70,8 +73,9 @@ async def get_image_prompt(recipe: Union[dict, str, Recipe, FormattedRecipe]) ->
             an engaging and contextually appropriate photo."""
         }
     ]
+    client = get_openai_client()
     try:
-        response = client.chat.completions.create(
+        response = await client.chat.completions.create(
             model="gpt-4-turbo-preview",
             messages=messages,
             max_tokens=500,
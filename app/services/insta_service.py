@@ -4,10 +4,8 @@ import json
 from typing import List
 from pydantic import BaseModel, Field
 from openai import OpenAIError
-from dependencies import get_openai_client
-
-# Create the OpenAI client
-client = get_openai_client()
+from app.dependencies import get_openai_client
+from app.utils.breaker_utils import breakers, CircuitOpenError
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
@@ -98,19 +96,21 @@ async def get_messages(post_option: str, prompt: str):
 
 async def create_post(post_type: str, prompt: str):
     """ Generate a post based on a user prompt"""
-    core_message_models = ["gpt-4-preview-1106", "gpt-4"]
+    core_message_models = ["gpt-4-1106-preview", "gpt-4"]
     messages = await get_messages(post_type, prompt)
-    for model in core_message_models:
+    client = get_openai_client()
+    for model in breakers.available("openai", core_message_models):
         try:
             logger.debug(f"Trying model: {model}")
-            response = client.chat.completions.create(
-                model=model,
-                messages=messages,
-                temperature=0.75,
-                top_p=1,
-                max_tokens=750,
-                response_format={"type": "json_object"}
-            )
+            with breakers.track("openai", model):
+                response = await client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    temperature=0.75,
+                    top_p=1,
+                    max_tokens=750,
+                    response_format={"type": "json_object"}
+                )
             post_response = json.loads(response.choices[0].message.content)
             logger.debug(f"Response: {post_response}")
             logger.debug(f"Response type: {type(post_response)}")
@@ -119,7 +119,7 @@ async def create_post(post_type: str, prompt: str):
                 "image_prompt": post_response["image_prompt"] if "image_prompt" in post_response else None
             }
 
-        except OpenAIError as e:
+        except (OpenAIError, CircuitOpenError) as e:
             logger.error(f"Error with model: {model}. Error: {e}")
             continue
 
@@ -155,8 +155,9 @@ async def alter_image(prompt: str, image_url: str):
         }
     ]
 
+    client = get_openai_client()
     try:
-        response = client.chat.completions.create(
+        response = await client.chat.completions.create(
             model="gpt-4-vision-preview",
             messages=messages,
             max_tokens=250,
@@ -178,8 +179,9 @@ async def generate_dalle2_images(prompt : str):
     logger.debug(f"Generating images for prompt: {prompt}")
     image_list = []
     # Generate the image
+    client = get_openai_client()
     try:
-        response = client.images.generate(
+        response = await client.images.generate(
             prompt=prompt,
             model="dall-e-2",
             size="1024x1024",
@@ -200,8 +202,9 @@ async def generate_dalle2_images(prompt : str):
 
 async def generate_dalle3_image(prompt : str, size: str = "1024x1024"):
     logger.debug(f"Generating image for prompt: {prompt} at size {size}")
+    client = get_openai_client()
     try:
-        response = client.images.generate(
+        response = await client.images.generate(
             prompt=prompt,
             model="dall-e-3",
             size=size,
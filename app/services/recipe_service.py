@@ -1,11 +1,13 @@
 """ OpenAI and local functions related to recipes """
+import asyncio
 import logging
 import os
 import time
 import sys
 import json
 import anthropic
-# from typing import List
+from contextlib import aclosing
+from typing import Awaitable, Callable, Optional
 from pydantic import ValidationError
 from dotenv import load_dotenv
 from openai import OpenAIError
@@ -14,16 +16,22 @@ from app.dependencies import (
     get_anthropic_client, get_openai_client, get_query_filter_client,
 )  # noqa: E402
 from app.models.recipe import FormattedRecipe, Recipe  # noqa: E402
+from app.utils.stream_utils import IncrementalJSONParser  # noqa: E402
+from app.utils.cache_utils import cached_recipe, collapse_whitespace  # noqa: E402
+from app.utils.singleflight_utils import singleflight  # noqa: E402
+from app.utils.latency_utils import LatencyWindow, run_hedged  # noqa: E402
+from app.utils.breaker_utils import breakers, CircuitOpenError  # noqa: E402
+from app.utils.ratelimit_utils import estimate_tokens, rate_limits, RateLimitTimeout  # noqa: E402
+from app.utils.deadline_utils import DeadlineExceeded  # noqa: E402
+from app.utils.filter_utils import (
+    classify_food_query, get_cached_verdict, set_cached_verdict
+)  # noqa: E402
 # from app.services.anthropic_service import AnthropicRecipe  # noqa: E402
 # from app.utils.redis_utils import save_recipe  # noqa: E402
 
 # Load environment variables
 load_dotenv()
 
-# Set up the client
-client = get_openai_client()
-anthropic_client = get_anthropic_client()
-
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger("main")
@@ -42,8 +50,33 @@ core_models = [
 
 test_models = ["gpt-4-turbo-preview", "gpt-4-1106-preview"]
 
+# The Claude model used for recipe generation
+claude_model = "claude-3-5-sonnet-20240620"
+
+# Latency of successful Claude recipe generations, used to derive the hedge delay
+claude_recipe_latency = LatencyWindow()
+
+def normalize_cache_params(params: dict) -> dict:
+    """ Map the serving size before a request is hashed for the recipe cache
+    so that e.g. "For Two" and "2" share an entry. """
+    if "serving_size" in params:
+        params["serving_size"] = serving_size_dict.get(params["serving_size"], params["serving_size"])
+    return params
+
+@singleflight("filter_query")
 async def filter_query(text: str) -> bool:
-    """ Determine if the text is related to food. """
+    """ Determine if the text is related to food.  Clear cases are decided by the local
+    classifier, and ambiguous text is sent to the LLM with the verdict cached in Redis. """
+    is_food = classify_food_query(text)
+    if is_food is not None:
+        logger.info(f"Query {text} is related to food: {is_food} (local classifier)")
+        return is_food
+
+    is_food = await get_cached_verdict(text)
+    if is_food is not None:
+        logger.info(f"Query {text} is related to food: {is_food} (cached verdict)")
+        return is_food
+
     client = get_query_filter_client()
     messages = [
         {
@@ -57,46 +90,72 @@ async def filter_query(text: str) -> bool:
         }
     ]
     models = core_models
-    for model in models:
+    for model in breakers.available("openai", models):
         try:
-            response = client.chat.completions.create(
-                model=model,
-                messages=messages,
-                temperature=0.5,
-                top_p=0.75,
-                max_tokens=1000
-            )
-            is_food = response.choices[0].message.content
+            await rate_limits.acquire("openai", model, estimate_tokens(messages, 2))
+            with breakers.track("openai", model):
+                response = await client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    temperature=0,
+                    max_tokens=2
+                )
+            is_food = not response.choices[0].message.content.strip().lower().startswith("false")
             logger.info(f"Query {text} is related to food: {is_food}")
+            await set_cached_verdict(text, is_food)
             return is_food
 
-        except OpenAIError as e:
+        except (OpenAIError, CircuitOpenError, RateLimitTimeout) as e:
             logger.error("Error with model: %s. Error: %s", model, e)
             continue
 
+    # Let the request through rather than fail it if the filter is unavailable
+    logger.warning("All filter models failed, allowing the query.")
+    return True
+
+def get_speculative_generation() -> bool:
+    """ Whether to start generating while the food filter is still running. """
+    return os.getenv("SPECULATIVE_GENERATION", "true").lower() in ["1", "true", "yes"]
+
+async def generate_if_food(query: str, generate: Callable[[], Awaitable]):
+    """ Run the generation only for food-related queries.  When the local classifier
+    cannot decide, the LLM filter and the generation are started concurrently and the
+    generation is cancelled if the filter rejects the query, so the filter adds no
+    latency for the (vast majority of) food queries.  Raises ValueError for non-food queries. """
+    is_food = classify_food_query(query)
+    if is_food is None and get_speculative_generation():
+        filter_task = asyncio.create_task(filter_query(query))
+        generation_task = asyncio.create_task(generate())
+        try:
+            is_food = await filter_task
+        except BaseException:
+            generation_task.cancel()
+            raise
+        if not is_food:
+            generation_task.cancel()
+            logger.debug(f"Query {query} is not related to food, cancelled speculative generation.")
+            raise ValueError("Query is not related to food.")
+        return await generation_task
+
+    if is_food is None:
+        is_food = await filter_query(query)
+    if not is_food:
+        logger.debug(f"Query {query} is not related to food.")
+        raise ValueError("Query is not related to food.")
+    return await generate()
+
 # ---------------------------------------------------------------------------------------------------------------
 
+# Bump the prompt_version of a cached function whenever its prompt changes
+@cached_recipe("create_recipe", model=core_models[0], prompt_version="1", normalize=normalize_cache_params)
 async def create_recipe(specifications: str, serving_size: str = "4"):
     """ Generate a recipe based on the specifications provided asynchronously """
-    # First check to make sure the query is related to food
-    query = specifications + serving_size
-    is_food = await filter_query(query)
-    if is_food == "False":
-        logger.debug(f"Query {specifications} is not related to food.")
-        raise ValueError("Query is not related to food.")
-        return json.dumps(
-            {
-                "recipe_name": '',
-                "ingredients": [],
-                "directions": [],
-                "prep_time": 0,
-                "cook_time": 0,
-                "serving_size": '',
-                "calories": 0,
-                "fun_fact": '',
-                "is_food": False
-            }
-        )
+    return await generate_if_food(
+        specifications + serving_size, lambda: generate_openai_recipe(specifications, serving_size)
+    )
+
+async def generate_openai_recipe(specifications: str, serving_size: str = "4"):
+    """ Generate a recipe with OpenAI without checking the query. """
     if serving_size in serving_size_dict.keys():
         serving_size = serving_size_dict[serving_size]
     messages = [
@@ -132,53 +191,36 @@ async def create_recipe(specifications: str, serving_size: str = "4"):
         }
     ]
 
+    client = get_openai_client()
     models = core_models
 
-    for model in models:
+    for model in breakers.available("openai", models):
         try:
             logger.info("Trying model: %s for recipe generation.", model)
-            # Assuming client has an async method for chat completions
-            response = client.chat.completions.create(
-                model=model,
-                messages=messages,
-                temperature=0.75,
-                top_p=1,
-                max_tokens=750,
-                response_format={"type": "json_object"}
-            )
+            await rate_limits.acquire("openai", model, estimate_tokens(messages, 750))
+            with breakers.track("openai", model):
+                response = await client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    temperature=0.75,
+                    top_p=1,
+                    max_tokens=750,
+                    response_format={"type": "json_object"}
+                )
             chef_response = response.choices[0].message.content
             logger.info(f"New recipe generated: {chef_response}")
             return chef_response
 
-        except OpenAIError as e:
+        except (OpenAIError, CircuitOpenError, RateLimitTimeout) as e:
             logger.error("Error with model: %s. Error: %s", model, e)
             continue
 
     return None  # Return None or a default response if all models fail
 
-async def claude_recipe(specifications: str, serving_size: str = "4") -> Recipe:
-    query = specifications + serving_size
-    is_food = await filter_query(query)
-    if is_food == "False":
-        logger.debug(f"Query {specifications} is not related to food.")
-        raise ValueError("Query is not related to food.")
-        return json.dumps(
-            {
-                "recipe_name": '',
-                "ingredients": [],
-                "directions": [],
-                "prep_time": 0,
-                "cook_time": 0,
-                "serving_size": '',
-                "calories": 0,
-                "fun_fact": '',
-                "is_food": False
-            }
-        )
-    if serving_size in serving_size_dict.keys():
-        serving_size = serving_size_dict[serving_size]
-
-    messages = [
+def get_claude_recipe_messages(specifications: str, serving_size) -> list:
+    """ Build the Claude messages for a new recipe.  The assistant turn is
+    prefilled with '{' so that Claude answers with the JSON object directly. """
+    return [
         {
             "role": "user",
             "content": f"""Please create a one-of-a-kind, exceptional recipe
@@ -277,7 +319,7 @@ async def claude_recipe(specifications: str, serving_size: str = "4") -> Recipe:
         }
     ]
 
-    system_message = """You are a master chef with knowledge and training that extends to
+claude_system_message = """You are a master chef with knowledge and training that extends to
     every style of cooking imagineable.  Strive to seamlessly merge
     the expertise of a trusted culinary source
     with the creative finesse of a professional chef. Your goal is to craft a recipe
@@ -287,31 +329,62 @@ async def claude_recipe(specifications: str, serving_size: str = "4") -> Recipe:
     to impress with your culinary creativity, ensuring ease of preparation and enjoyment
     while delivering a memorable and delightful culinary journey."""
 
-    model = "claude-3-5-sonnet-20240620"
+# Coalesced outside the cache so that fresh=True, which skips the cache, also skips
+# sharing another request's recipe
+@singleflight("claude_recipe", result_model=Recipe, normalize=normalize_cache_params)
+@cached_recipe(
+    "claude_recipe", model=claude_model, prompt_version="1", recipe_model=Recipe,
+    normalize=normalize_cache_params
+)
+async def claude_recipe(specifications: str, serving_size: str = "4") -> Recipe:
+    """ Generate a recipe with Claude based on the specifications provided. """
+    return await generate_if_food(
+        specifications + serving_size, lambda: generate_claude_recipe(specifications, serving_size)
+    )
 
+async def generate_claude_recipe(specifications: str, serving_size: str = "4") -> Recipe:
+    """ Generate a recipe with Claude without checking the query. """
+    if serving_size in serving_size_dict.keys():
+        serving_size = serving_size_dict[serving_size]
+
+    messages = get_claude_recipe_messages(specifications, serving_size)
+
+    # The rate limiter owns retries on 429s, so the client does not retry them again
+    anthropic_client = get_anthropic_client().with_options(max_retries=0)
+    model = claude_model
+
+    started = time.monotonic()
     try:
-        response = anthropic_client.messages.create(
-            model=model,
-            max_tokens=1024,
-            messages=messages,
-            system=system_message,
-            temperature=0.75,
+        # Only the provider calls themselves count towards the breaker, not the limiter waits
+        response = await rate_limits.call(
+            "anthropic", model,
+            lambda: breakers.call("anthropic", model, lambda: anthropic_client.messages.create(
+                model=model,
+                max_tokens=1024,
+                messages=messages,
+                system=claude_system_message,
+                temperature=0.75,
+            )),
+            tokens=estimate_tokens(messages, 1024, claude_system_message),
+            retry_on=(anthropic.RateLimitError,)
         )
         logger.debug(f"Claude Response {response}")
         recipe = '{' + response.content[0].text
         logger.info(f"Claude Recipe generated: {Recipe(**json.loads(recipe))}")
+        claude_recipe_latency.record(time.monotonic() - started)
 
         return Recipe(**json.loads(recipe))
 
+    except (CircuitOpenError, RateLimitTimeout) as e:
+        logger.error(e)
+
     except anthropic.APIConnectionError as e:
         logger.error("The server could not be reached")
         logger.error(e.__cause__)
 
     except anthropic.RateLimitError as e:
-        logger.error("A 429 status code was received; we should back off a bit.")
+        logger.error("A 429 status code was received and the retries were exhausted.")
         logger.error(f"Response: {e.response}")
-        # Implementing a basic backoff strategy
-        time.sleep(10)  # Sleep for 10 seconds before retrying or proceeding
 
     except anthropic.APIStatusError as e:
         logger.error("A non-200-range status code was received")
@@ -337,12 +410,46 @@ async def claude_recipe(specifications: str, serving_size: str = "4") -> Recipe:
         logger.error("A validation error occurred")
         logger.error(e)
 
+    except DeadlineExceeded:
+        raise
+
     except Exception as e:
         # A generic catch-all for any other unexpected errors
         logger.error("An unexpected error occurred")
         logger.error(e)
 
 
+def get_hedge_delay() -> float:
+    """ How long to wait for Claude before also asking OpenAI for a recipe.  Once there
+    are enough samples this is the HEDGE_PERCENTILE (default p95) of Claude's recent
+    latency, clamped to [HEDGE_DELAY_MIN, HEDGE_DELAY_MAX]; until then it is HEDGE_DELAY. """
+    percentile = float(os.getenv("HEDGE_PERCENTILE", "0.95"))
+    observed = claude_recipe_latency.percentile(percentile)
+    if observed is None or len(claude_recipe_latency) < int(os.getenv("HEDGE_MIN_SAMPLES", "20")):
+        return float(os.getenv("HEDGE_DELAY", "25"))
+    return min(max(observed, float(os.getenv("HEDGE_DELAY_MIN", "5"))), float(os.getenv("HEDGE_DELAY_MAX", "40")))
+
+def validate_recipe(recipe) -> Optional[Recipe]:
+    """ Return the recipe as a Recipe, or None if it is missing or invalid. """
+    if recipe is None or isinstance(recipe, Recipe):
+        return recipe
+    try:
+        return Recipe(**(json.loads(recipe) if isinstance(recipe, str) else recipe))
+    except (ValueError, TypeError) as e:
+        logger.error(f"Invalid recipe {recipe}: {e}")
+        return None
+
+async def hedged_recipe(specifications: str, serving_size: str = "4", fresh: bool = False) -> Optional[Recipe]:
+    """ Generate a recipe with Claude, hedged with OpenAI.  If Claude has not returned a
+    valid recipe within the hedge delay (or fails), the OpenAI recipe is requested in
+    parallel and whichever validates first is returned.  Raises ValueError if the query
+    is not related to food and returns None if both providers fail. """
+    return await run_hedged(
+        lambda: claude_recipe(specifications, serving_size, fresh=fresh),
+        lambda: create_recipe(specifications, serving_size, fresh=fresh),
+        delay=get_hedge_delay(), validate=validate_recipe, reraise=(ValueError, DeadlineExceeded)
+    )
+
 # Create recipe tool
 create_recipe_tool = {
     "name": "create_new_recipe",
@@ -370,7 +477,7 @@ create_recipe_tool = {
 # ---------------------------------------------------------------------------------------------------------------'''
 
 # Adjust recipe functions
-def adjust_recipe(recipe: dict, adjustments: str):
+async def adjust_recipe(recipe: dict, adjustments: str):
     """ Chat a new recipe that needs to be generated based on\
     a previous recipe. """
     # Set the chef style
@@ -406,23 +513,26 @@ def adjust_recipe(recipe: dict, adjustments: str):
     ]
 
     # models = [model, "gpt-3.5-turbo-16k-0613", "gpt-3.5-turbo-16k"]
+    client = get_openai_client()
     models = core_models
-    for model in models:
+    for model in breakers.available("openai", models):
         logger.info("Trying model: %s for adjusting recipe.", model)
         try:
-          response = client.chat.completions.create(
-              model=model,
-              messages=messages,
-              temperature=0.75,
-              top_p=0.75,
-              max_tokens=1000,
-              response_format = {"type" : "json_object"}
-          )
+          await rate_limits.acquire("openai", model, estimate_tokens(messages, 1000))
+          with breakers.track("openai", model):
+              response = await client.chat.completions.create(
+                  model=model,
+                  messages=messages,
+                  temperature=0.75,
+                  top_p=0.75,
+                  max_tokens=1000,
+                  response_format = {"type" : "json_object"}
+              )
           recipe = response.choices[0].message.content
           logger.info(f"Adjusted recipe generated: {recipe}")
           return recipe
 
-        except OpenAIError as e:
+        except (OpenAIError, CircuitOpenError, RateLimitTimeout) as e:
             logger.error("Error with model: %s. Error: %s", model, e)
             continue
 
@@ -451,24 +561,16 @@ adjust_recipe_tool = {
 
 # ---------------------------------------------------------------------------------------------------------------
 # Add the function to extract and format recipe text from the user's files
+# Keyed on the recipe text as it is, apart from spacing, since its punctuation carries the quantities
+@cached_recipe(
+    "format_recipe", model="gpt-3.5-turbo-1106", prompt_version="1", normalize_value=collapse_whitespace
+)
 async def format_recipe(recipe_text: str):
     """ Extract and format the text from the user's files. """
-    is_food = await filter_query(recipe_text)
-    if is_food == "False":
-        logger.debug(f"Query {recipe_text} is not related to food.")
-        raise ValueError("Query is not related to food.")
-        return json.dumps(
-            {
-                "recipe_name": '',
-                "ingredients": [],
-                "directions": [],
-                "prep_time": 0,
-                "cook_time": 0,
-                "serving_size": '',
-                "calories": 0,
-                "is_food": False
-            }
-        )
+    return await generate_if_food(recipe_text, lambda: generate_formatted_recipe(recipe_text))
+
+async def generate_formatted_recipe(recipe_text: str):
+    """ Format the recipe text without checking it. """
     messages = [
         {
             "role" : "system", "content" :
@@ -503,22 +605,25 @@ async def format_recipe(recipe_text: str):
         }
     ]
     # models = [model, "gpt-3.5-turbo-16k-0613", "gpt-3.5-turbo-16k"]
+    client = get_openai_client()
     models = ["gpt-3.5-turbo-1106", "gpt-4-1106-preview"]
-    for model in models:
+    for model in breakers.available("openai", models):
         try:
-            response = client.chat.completions.create(
-                model=model,
-                messages=messages,
-                temperature=0.5,
-                top_p=0.75,
-                max_tokens=1000,
-                response_format = {"type" : "json_object"}
-            )
+            await rate_limits.acquire("openai", model, estimate_tokens(messages, 1000))
+            with breakers.track("openai", model):
+                response = await client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    temperature=0.5,
+                    top_p=0.75,
+                    max_tokens=1000,
+                    response_format = {"type" : "json_object"}
+                )
             recipe = response.choices[0].message.content
             logger.info(f"Formatted recipe generated: {recipe} with model {model}.")
             return recipe
 
-        except OpenAIError as e:
+        except (OpenAIError, CircuitOpenError, RateLimitTimeout) as e:
             logger.error("Error with model: %s. Error: %s", model, e)
             continue
 
@@ -545,30 +650,9 @@ adjust_recipe_tool = {
     }
 }
 
-async def claude_ingredients_recipe(
-        specifications: str, ingredients_list: str, serving_size: str = "4") -> Recipe:
-    query = specifications + serving_size
-    is_food = await filter_query(query)
-    if is_food == "False":
-        logger.debug(f"Query {specifications} is not related to food.")
-        raise ValueError("Query is not related to food.")
-        return json.dumps(
-            {
-                "recipe_name": '',
-                "ingredients": [],
-                "directions": [],
-                "prep_time": 0,
-                "cook_time": 0,
-                "serving_size": '',
-                "calories": 0,
-                "fun_fact": '',
-                "is_food": False
-            }
-        )
-    if serving_size in serving_size_dict.keys():
-        serving_size = serving_size_dict[serving_size]
-
-    messages = [
+def get_claude_ingredients_messages(specifications: str, ingredients_list: str, serving_size) -> list:
+    """ Build the Claude messages for a recipe that uses up a list of ingredients. """
+    return [
         {
             "role": "user",
             "content": f"""You are a creative and skilled chef AI assistant. Your task is to generate a unique
@@ -631,14 +715,41 @@ async def claude_ingredients_recipe(
         }
     ]
 
-    model = "claude-3-5-sonnet-20240620"
+@cached_recipe(
+    "claude_ingredients_recipe", model=claude_model, prompt_version="1", recipe_model=Recipe,
+    normalize=normalize_cache_params
+)
+async def claude_ingredients_recipe(
+        specifications: str, ingredients_list: str, serving_size: str = "4") -> Recipe:
+    """ Generate a recipe with Claude that uses up the ingredients provided. """
+    return await generate_if_food(
+        specifications + serving_size,
+        lambda: generate_claude_ingredients_recipe(specifications, ingredients_list, serving_size)
+    )
+
+async def generate_claude_ingredients_recipe(
+        specifications: str, ingredients_list: str, serving_size: str = "4") -> Recipe:
+    """ Generate an ingredients recipe with Claude without checking the query. """
+    if serving_size in serving_size_dict.keys():
+        serving_size = serving_size_dict[serving_size]
+
+    messages = get_claude_ingredients_messages(specifications, ingredients_list, serving_size)
+
+    # The rate limiter owns retries on 429s, so the client does not retry them again
+    anthropic_client = get_anthropic_client().with_options(max_retries=0)
+    model = claude_model
 
     try:
-        response = anthropic_client.messages.create(
-            model=model,
-            max_tokens=1024,
-            messages=messages,
-            temperature=0.75,
+        response = await rate_limits.call(
+            "anthropic", model,
+            lambda: breakers.call("anthropic", model, lambda: anthropic_client.messages.create(
+                model=model,
+                max_tokens=1024,
+                messages=messages,
+                temperature=0.75,
+            )),
+            tokens=estimate_tokens(messages, 1024),
+            retry_on=(anthropic.RateLimitError,)
         )
         logger.debug(f"Claude Response {response}")
         recipe = '{' + response.content[0].text
@@ -646,15 +757,16 @@ async def claude_ingredients_recipe(
 
         return Recipe(**json.loads(recipe))
 
+    except (CircuitOpenError, RateLimitTimeout) as e:
+        logger.error(e)
+
     except anthropic.APIConnectionError as e:
         logger.error("The server could not be reached")
         logger.error(e.__cause__)
 
     except anthropic.RateLimitError as e:
-        logger.error("A 429 status code was received; we should back off a bit.")
+        logger.error("A 429 status code was received and the retries were exhausted.")
         logger.error(f"Response: {e.response}")
-        # Implementing a basic backoff strategy
-        time.sleep(10)  # Sleep for 10 seconds before retrying or proceeding
 
     except anthropic.APIStatusError as e:
         logger.error("A non-200-range status code was received")
@@ -680,7 +792,59 @@ async def claude_ingredients_recipe(
         logger.error("A validation error occurred")
         logger.error(e)
 
+    except DeadlineExceeded:
+        raise
+
     except Exception as e:
         # A generic catch-all for any other unexpected errors
         logger.error("An unexpected error occurred")
         logger.error(e)
+
+async def stream_claude_recipe(messages: list, system: Optional[str] = None):
+    """ Stream a recipe from Claude, reporting each field as soon as it is complete.
+    Yields dicts with an "event" and "data" key: "item" for each ingredient or
+    direction, "field" for each completed top-level field, and finally "recipe"
+    with the validated Recipe, or "error" if the recipe could not be generated. """
+    anthropic_client = get_anthropic_client()
+    parser = IncrementalJSONParser()
+    # Replay the '{' prefill so that the parser sees the whole object
+    parser.feed("{")
+    recipe_text = "{"
+
+    async def claude_text():
+        async with anthropic_client.messages.stream(
+            model=claude_model,
+            max_tokens=1024,
+            messages=messages,
+            system=system or anthropic.NOT_GIVEN,
+            temperature=0.75,
+        ) as stream:
+            async for text in stream.text_stream:
+                yield text
+
+    try:
+        await rate_limits.acquire("anthropic", claude_model, estimate_tokens(messages, 1024, system))
+        # Only the waits on Claude count toward its breaker, not the consumer's between the yields
+        async with aclosing(breakers.track_stream("anthropic", claude_model, claude_text())) as texts:
+            async for text in texts:
+                recipe_text += text
+                for kind, key, value in parser.feed(text):
+                    yield {"event": kind, "data": {"field": key, "value": value}}
+
+        try:
+            recipe = Recipe(**json.loads(recipe_text))
+        except json.JSONDecodeError:
+            # Fall back to whatever the tolerant parser recovered
+            logger.warning("Streamed recipe was not valid JSON, using the parsed fields")
+            recipe = Recipe(**parser.result)
+        logger.info(f"Claude Recipe streamed: {recipe}")
+        yield {"event": "recipe", "data": recipe.model_dump()}
+
+    except (anthropic.APIError, CircuitOpenError, RateLimitTimeout) as e:
+        logger.error(f"Error streaming recipe from Claude: {e}")
+        yield {"event": "error", "data": str(e)}
+
+    except ValidationError as e:
+        logger.error("A validation error occurred")
+        logger.error(e)
+        yield {"event": "error", "data": "The generated recipe was incomplete."}
@@ -0,0 +1,94 @@
+""" Tests for loading the chat session and paging through its history """
+import asyncio
+import os
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+from redis.exceptions import RedisError
+from app.services.chat_service import ChatService, expiring_fields
+from app.utils.session_utils import encode_message, session_cache
+
+class FakePipeline:
+    """ A pipeline over an in-memory message list, supporting the list reads of the chat history. """
+    def __init__(self, messages: list):
+        self.messages = messages
+        self.commands = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    def llen(self, key):
+        self.commands.append(lambda: len(self.messages))
+
+    def lrange(self, key, start, end):
+        length = len(self.messages)
+        start = max(0, length + start) if start < 0 else start
+        end = length + end if end < 0 else end
+        self.commands.append(lambda: self.messages[start:end + 1])
+
+    def lindex(self, key, index):
+        self.commands.append(lambda: self.messages[index] if self.messages else None)
+
+    def expire(self, key, ttl):
+        self.commands.append(lambda: key)
+
+    async def execute(self):
+        return [command() for command in self.commands]
+
+def make_service(messages: list) -> ChatService:
+    """ A chat service whose stored history holds the messages. """
+    stored = [encode_message({"role": "user", "content": message, "thread_id": None}) for message in messages]
+    redis = mock.MagicMock()
+    redis.pipeline.side_effect = lambda transaction=False: FakePipeline(stored)
+    return ChatService(SimpleNamespace(redis=redis, session_id="session"))
+
+class TestChatService(unittest.TestCase):
+    """ Tests for the session TTL and the chat history pages and ETag. """
+    def test_pages_follow_the_cursors(self):
+        """ Pages hold the latest messages by default and move with before / after. """
+        service = make_service(["a", "b", "c", "d", "e"])
+        latest = asyncio.run(service.load_chat_page(limit=2))
+        self.assertEqual([message["content"] for message in latest["chat_history"]], ["d", "e"])
+        self.assertEqual([message["id"] for message in latest["chat_history"]], [3, 4])
+        self.assertTrue(latest["has_more"])
+
+        earlier = asyncio.run(service.load_chat_page(limit=2, before=1))
+        self.assertEqual([message["content"] for message in earlier["chat_history"]], ["a"])
+        self.assertFalse(earlier["has_more"])
+
+        newer = asyncio.run(service.load_chat_page(limit=2, after=1))
+        self.assertEqual([message["content"] for message in newer["chat_history"]], ["c", "d"])
+        self.assertTrue(newer["has_more"])
+
+        with self.assertRaises(ValueError):
+            asyncio.run(service.load_chat_page(limit=2, before=3, after=1))
+
+    def test_etag_changes_with_the_history(self):
+        """ The ETag follows the history and is None when Redis is unavailable. """
+        etag = asyncio.run(make_service(["a", "b"]).chat_history_etag())
+        self.assertEqual(etag, asyncio.run(make_service(["a", "b"]).chat_history_etag()))
+        self.assertNotEqual(etag, asyncio.run(make_service(["a", "b", "c"]).chat_history_etag()))
+
+        service = make_service([])
+        service.store.redis.pipeline.side_effect = RedisError("connection refused")
+        self.assertIsNone(asyncio.run(service.chat_history_etag()))
+
+    def test_cached_sessions_keep_their_ttl(self):
+        """ A session served from the in-process cache still has its Redis TTL refreshed. """
+        service = make_service([])
+        pipeline = FakePipeline([])
+        service.store.redis.pipeline.side_effect = None
+        service.store.redis.pipeline.return_value = pipeline
+        session_cache.set("session", {"chef_type": "home_cook", "thread_id": None})
+        self.addCleanup(session_cache.invalidate, "session")
+
+        with mock.patch.dict(os.environ, {"SESSION_REFRESH_INTERVAL": "0"}):
+            asyncio.run(service.load_session())
+        service.store.redis.pipeline.assert_called_once()
+        self.assertEqual(asyncio.run(pipeline.execute()), [f"session:{field}" for field in expiring_fields])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,44 +1,50 @@
 import unittest
 import asyncio
-from unittest.mock import patch, MagicMock
-from image_service import create_image_string, get_image_prompt
+from unittest.mock import patch, MagicMock, AsyncMock
+from app.services.image_service import create_image_string, get_image_prompt
 
 class TestImageService(unittest.TestCase):
 
-    @patch('image_service.OpenAI')
-    def test_create_image_string(self, mock_openai):
+    @patch('app.services.image_service.decode_image', new_callable=AsyncMock)
+    @patch('app.services.image_service.get_openai_client')
+    def test_create_image_string(self, mock_get_client, mock_decode_image):
         # Arrange
-        mock_openai.images.generate.return_value = MagicMock(data=[MagicMock(b64_json="test_image")])
+        mock_openai = MagicMock()
+        mock_openai.images.generate = AsyncMock(return_value=MagicMock(data=[MagicMock(b64_json="test_image")]))
+        mock_get_client.return_value = mock_openai
         prompt = "Test prompt"
 
         # Act
-        result = create_image_string(prompt)
+        result = asyncio.run(create_image_string(prompt))
 
         # Assert
         self.assertEqual(result, "test_image")
-        mock_openai.images.generate.assert_called_once_with(
+        mock_openai.images.generate.assert_awaited_once_with(
             prompt=prompt,
             model="dall-e-3",
             size="1024x1024",
             quality="hd",
             n=1,
+            style="vivid",
             response_format="b64_json"
         )
 
-    @patch('image_service.OpenAI')
-    def test_get_image_prompt(self, mock_openai):
+    @patch('app.services.image_service.get_openai_client')
+    def test_get_image_prompt(self, mock_get_client):
         # Arrange
-        mock_openai.chat.completions.create.return_value = MagicMock(
+        mock_openai = MagicMock()
+        mock_openai.chat.completions.create = AsyncMock(return_value=MagicMock(
             choices=[MagicMock(message=MagicMock(content="Test prompt"))]
-        )
+        ))
+        mock_get_client.return_value = mock_openai
         recipe = "Test recipe"
 
         # Act
-        result = get_image_prompt(recipe)
+        result = asyncio.run(get_image_prompt(recipe))
 
         # Assert
         self.assertEqual(result, "Test prompt")
-        mock_openai.chat.completions.create.assert_called_once()
+        mock_openai.chat.completions.create.assert_awaited_once()
 
 if __name__ == '__main__':
-    asyncio.run(unittest.main())
+    unittest.main()
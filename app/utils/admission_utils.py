@@ -0,0 +1,174 @@
+""" Admission control for the LLM-bound endpoints.  Each request needs a slot of its
+endpoint and of every provider the endpoint calls; requests that cannot get them wait in
+a bounded queue served by priority, and are turned away with a 429 once it is full. """
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+from app.utils.deadline_utils import deadline_timeout
+from app.utils.metrics_utils import metrics
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger("main")
+
+# The priority of each class of request, lowest first: interactive chat ahead of recipe
+# generation, which is ahead of image generation and bulk formatting
+priorities = {
+    "chat": 0,
+    "recipe": 1,
+    "image": 2,
+    "bulk": 3,
+}
+
+# The class, concurrency limit and providers of each admitted endpoint.  Other
+# endpoints are not admission controlled.
+endpoint_admission = {
+    "/get_chef_response": ("chat", 32, ("openai",)),
+    "/get_chef_response/stream": ("chat", 32, ("openai",)),
+    "/create-recipe": ("recipe", 16, ("anthropic", "openai")),
+    "/create-recipe/stream": ("recipe", 16, ("anthropic", "openai")),
+    "/generate-image": ("image", 8, ("openai",)),
+    "/upload-files": ("bulk", 4, ("openai",)),
+    "/format-recipe-text": ("bulk", 8, ("openai",)),
+}
+
+# The concurrency limit of each provider, across all endpoints
+provider_limits = {
+    "openai": 48,
+    "anthropic": 24,
+}
+
+class AdmissionRejected(Exception):
+    """ Raised when a request cannot be admitted; retry_after is the suggested wait in seconds. """
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+def get_admission_queue_size() -> int:
+    """ How many requests may wait for a slot before new ones are rejected. """
+    return int(os.getenv("ADMISSION_QUEUE_SIZE", "64"))
+
+def get_admission_queue_timeout() -> float:
+    """ The longest a request waits in the queue for a slot, in seconds. """
+    return float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "30"))
+
+def get_admission_retry_after() -> int:
+    """ The Retry-After sent with a rejection, in seconds. """
+    return int(os.getenv("ADMISSION_RETRY_AFTER", "5"))
+
+def pool_name(kind: str, name: str) -> str:
+    """ The env suffix of a pool, e.g. ("endpoint", "/create-recipe") -> ENDPOINT_CREATE_RECIPE. """
+    return f"{kind}_{name.strip('/').replace('-', '_').replace('/', '_')}".upper()
+
+def get_pool_limit(kind: str, name: str) -> int:
+    """ The concurrency limit of an endpoint or provider pool.  ADMISSION_LIMIT_<POOL>
+    overrides it, e.g. ADMISSION_LIMIT_PROVIDER_OPENAI or ADMISSION_LIMIT_ENDPOINT_GENERATE_IMAGE. """
+    override = os.getenv(f"ADMISSION_LIMIT_{pool_name(kind, name)}")
+    if override:
+        return int(override)
+    if kind == "endpoint":
+        return endpoint_admission[name][1]
+    return provider_limits.get(name, 32)
+
+class Waiter:
+    """ A queued request and the pools it is waiting for. """
+    def __init__(self, request_class: str, pools: List[Tuple[str, str]]):
+        self.request_class = request_class
+        self.pools = pools
+        self.granted = asyncio.get_running_loop().create_future()
+
+class AdmissionScheduler:
+    """ The endpoint and provider slots of this worker.  A freed slot goes to the
+    highest-priority waiter whose pools all have room, oldest first within a class. """
+    def __init__(self):
+        self.in_flight: Dict[Tuple[str, str], int] = defaultdict(int)
+        self.waiters: List[Tuple[int, int, Waiter]] = []
+        self.sequence = itertools.count()
+
+    def _fits(self, pools: List[Tuple[str, str]]) -> bool:
+        return all(self.in_flight[pool] < get_pool_limit(*pool) for pool in pools)
+
+    def _take(self, pools: List[Tuple[str, str]]):
+        for pool in pools:
+            self.in_flight[pool] += 1
+
+    def _grant(self):
+        """ Hand the free slots to the waiters, in priority order. """
+        remaining = []
+        for entry in sorted(self.waiters):
+            waiter = entry[2]
+            if not waiter.granted.done() and self._fits(waiter.pools):
+                self._take(waiter.pools)
+                waiter.granted.set_result(True)
+            elif not waiter.granted.done():
+                remaining.append(entry)
+        heapq.heapify(remaining)
+        self.waiters = remaining
+
+    async def acquire(self, path: str) -> Optional[List[Tuple[str, str]]]:
+        """ Wait for the slots of a request to path and return them, or None if the
+        endpoint is not admission controlled.  Raises AdmissionRejected when the queue
+        is full or the wait runs past ADMISSION_QUEUE_TIMEOUT. """
+        if path not in endpoint_admission:
+            return None
+        request_class, _, providers = endpoint_admission[path]
+        pools = [("endpoint", path)] + [("provider", provider) for provider in providers]
+        if not self.waiters and self._fits(pools):
+            self._take(pools)
+            metrics.observe(f"admission.{request_class}.wait", 0.0)
+            return pools
+
+        if len(self.waiters) >= get_admission_queue_size():
+            metrics.increment(f"admission.{request_class}.rejected")
+            logger.warning(f"Admission queue is full, rejecting {path}")
+            raise AdmissionRejected("The server is busy, please retry shortly.", get_admission_retry_after())
+
+        timeout = deadline_timeout(get_admission_queue_timeout())
+        waiter = Waiter(request_class, pools)
+        heapq.heappush(self.waiters, (priorities[request_class], next(self.sequence), waiter))
+        metrics.observe("admission.queue_depth", len(self.waiters))
+        started = time.monotonic()
+        self._grant()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.granted), timeout)
+        except BaseException as e:
+            if waiter.granted.done() and not waiter.granted.cancelled():
+                # The slots were granted just as the wait gave up, so hand them on
+                self.release(pools)
+            else:
+                waiter.granted.cancel()
+                self.waiters = [entry for entry in self.waiters if entry[2] is not waiter]
+                heapq.heapify(self.waiters)
+            if isinstance(e, asyncio.TimeoutError):
+                metrics.increment(f"admission.{request_class}.timed_out")
+                raise AdmissionRejected("Timed out waiting for capacity, please retry shortly.",
+                                        get_admission_retry_after()) from None
+            raise
+        finally:
+            metrics.observe(f"admission.{request_class}.wait", time.monotonic() - started)
+        return pools
+
+    def release(self, pools: Optional[List[Tuple[str, str]]]):
+        """ Give back the slots of a finished request and admit the next waiters. """
+        if pools is None:
+            return
+        for pool in pools:
+            self.in_flight[pool] -= 1
+        self._grant()
+
+    def snapshot(self) -> dict:
+        """ The slots in use and the queue depth per class for the metrics endpoint. """
+        queued = defaultdict(int)
+        for _, _, waiter in self.waiters:
+            queued[waiter.request_class] += 1
+        return {
+            "in_flight": {f"{kind}:{name}": count for (kind, name), count in self.in_flight.items()},
+            "queued": dict(queued),
+        }
+
+admission = AdmissionScheduler()
+metrics.register("admission", admission.snapshot)
@@ -1,13 +1,15 @@
 """ Utilities to support the run endpoints """
 import asyncio
+import inspect
 import json
 import logging
 import os
 import sys
+from typing import Awaitable, Callable, Optional
 from dotenv import load_dotenv
 # Add the app directory to the system path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from services.recipe_service import ( # noqa E402
+from app.services.recipe_service import ( # noqa E402
   # adjust_recipe, # noqa E402
   format_recipe, # noqa E402
   #save_recipe, # noqa E402 # noqa E402
@@ -16,6 +18,8 @@ from services.recipe_service import ( # noqa E402
 # from services.image_service import generate_image # noqa E402
 from app.models.recipe import Recipe # noqa E402
 from app.dependencies import get_openai_client # noqa E402
+from app.utils.metrics_utils import metrics # noqa E402
+from app.utils.run_utils import run_tracker, cancel_run, END_STATUSES # noqa E402
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -24,9 +28,6 @@ load_dotenv()
 
 logger = logging.getLogger("main")
 
-# Create the OpenAI client
-client = get_openai_client()
-
 # Create the chef_type / assistant_id dictionary
 id_dict = {
     "home_cook": "asst_DXoYw6E9Nky5RfJ0D7OhPhDd",
@@ -38,6 +39,58 @@ def adjust_recipe(adjusted_recipe):
     """ Return an adjusted recipe object """
     return adjusted_recipe
 
+# Instructions and tools for the run that saves the user's adjusted recipe
+save_recipe_instructions = "Use the adjust_recipe tool to make any necessary changes to the original recipe\
+    based on the user's requests.  Just use the tool,\
+    do not return a message to the user. This is just to\
+    save the recipe in the database.  Thanks!"
+
+# The message that asks the chef to save the recipe discussed so far
+save_recipe_message = "I am ready to save my recipe!  Please use the 'adjust_recipe' tool\
+    to make any necessary changes based on the original recipe and our ensuing conversation."
+
+save_recipe_tools = [
+    {
+        "type": "function",
+        "function": {
+            "name": "adjust_recipe",
+            "description": (
+                "Adjust an existing recipe based on the original recipe object and"
+                " the user specifications and interactions to conform to the recipe"
+                " object schema."
+            ),
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "adjusted_recipe": {
+                        "type": "object",
+                        "description": (
+                            "The adjusted recipe object following the specified"
+                            " Pydantic schema."
+                        ),
+                        "properties": {
+                            "recipe_name": {"type": "string"},
+                            "ingredients": {"type": "array", "items": {"type": "string"}},
+                            "directions": {"type": "array", "items": {"type": "string"}},
+                            "prep_time": {"type": ["integer", "string"]},
+                            "cook_time": {"type": ["string", "integer"], "nullable": True},
+                            "serving_size": {"type": ["string", "integer"], "nullable": True},
+                            "calories": {"type": ["string", "integer"], "nullable": True},
+                            "fun_fact": {"type": "string"},
+                            "pairs_with": {"type": "string"}
+                        },
+                        "required": [
+                            "recipe_name", "ingredients", "directions", "fun_fact", "pairs_with",
+                            "prep_time", "cook_time", "serving_size", "calories"
+                        ]
+                    },
+                },
+                "required": ["adjusted_recipe"]
+            }
+        }
+    }
+]
+
 functions_dict = {
     "adjust_recipe": {
         "function" : adjust_recipe,
@@ -71,6 +124,8 @@ async def call_named_function(function_name: str, **kwargs):
         if function_name in functions_dict:
             # Call the function
             function_output = functions_dict[function_name]["function"](**kwargs)
+            if inspect.isawaitable(function_output):
+                function_output = await function_output
             # Return the function output
             return function_output
         else:
@@ -78,67 +133,53 @@ async def call_named_function(function_name: str, **kwargs):
     except TypeError as e:
         return f"Error in calling {function_name}: {e}"
 
-async def retrieve_run_status(thread_id, run_id):
-    try:
-        # Assuming client has an async method for retrieving run status
-        return client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run_id)
-    except Exception as e:
-        logging.error(f"Error retrieving run status: {e}")
-        return None
+async def process_tool_calls(tool_calls):
+    """ Run the requested tool calls in parallel and return the tool outputs
+    to submit along with the values returned by each tool. """
+    tool_outputs = []
+    tool_return_values = []
 
-async def poll_run_status(run_id: str, thread_id: str):
-    run_status = await retrieve_run_status(thread_id, run_id)
-    if run_status is None:
-        return None
+    async def process_tool_call(tool_call):
+        function_name = tool_call.function.name
+        logging.info(f"Processing tool call for function {function_name}")
+        tool_call_id = tool_call.id
+        logging.debug(f"Processing tool call {tool_call_id} for function {function_name}")
+        parameters = json.loads(tool_call.function.arguments)
+        logging.debug(
+            f"Processing tool call {tool_call_id}\
+            for function {function_name} with parameters {parameters}"
+        )
 
-    tool_return_values = []
+        function_output = await call_named_function(function_name=function_name, **parameters)
 
-    while run_status.status not in ["completed", "failed", "expired", "cancelling", "cancelled"]:
-        if run_status.status == "requires_action":
-            tool_outputs = []
-            tool_calls = run_status.required_action.submit_tool_outputs.tool_calls
-
-            async def process_tool_call(tool_call):
-                function_name = tool_call.function.name
-                logging.info(f"Processing tool call for function {function_name}")
-                tool_call_id = tool_call.id
-                logging.debug(f"Processing tool call {tool_call_id} for function {function_name}")
-                parameters = json.loads(tool_call.function.arguments)
-                logging.debug(
-                    f"Processing tool call {tool_call_id}\
-                    for function {function_name} with parameters {parameters}"
-                )
-
-                function_output = await call_named_function(function_name=function_name, **parameters)
-
-                tool_outputs.append({
-                    "tool_call_id": tool_call_id,
-                    "output": json.dumps(function_output)
-                })
-
-                tool_return_values.append({
-                    "tool_name": function_name,
-                    "output": function_output
-                })
-
-            # Process each tool call in parallel
-            await asyncio.gather(*(process_tool_call(tool_call) for tool_call in tool_calls))
-
-            try:
-                run = client.beta.threads.runs.submit_tool_outputs(
-                    thread_id=thread_id, run_id=run_id, tool_outputs=tool_outputs)
-                run_status = run
-            except Exception as e:
-                logging.error(f"Error submitting tool outputs: {e}")
-                return None
-        else:
-            await asyncio.sleep(1.5)  # Non-blocking sleep
-            run_status = await retrieve_run_status(thread_id, run_id)
-            if run_status is None:
-                return None
+        tool_outputs.append({
+            "tool_call_id": tool_call_id,
+            "output": json.dumps(function_output)
+        })
 
+        tool_return_values.append({
+            "tool_name": function_name,
+            "output": function_output
+        })
+
+    # Process each tool call in parallel
+    await asyncio.gather(*(process_tool_call(tool_call) for tool_call in tool_calls))
+
+    return tool_outputs, tool_return_values
+
+async def wait_for_run_result(thread_id: str, run_id: str):
+    """ Wait for a run made by another request to end and return its final message,
+    leaving its tool calls to the request that made it. """
+    run_status = await run_tracker.wait(thread_id, run_id, statuses=END_STATUSES)
+    if run_status is None:
+        return None
+    return await get_run_result(thread_id, run_id, [])
+
+async def get_run_result(thread_id: str, run_id: str, tool_return_values: list):
+    """ The final message of an ended run along with its tool return values. """
+    client = get_openai_client()
     try:
-        final_messages = client.beta.threads.messages.list(thread_id=thread_id, limit=1)
+        final_messages = await client.beta.threads.messages.list(thread_id=thread_id, limit=1)
     except Exception as e:
         logging.error(f"Error retrieving final messages: {e}")
         return None
@@ -150,14 +191,115 @@ async def poll_run_status(run_id: str, thread_id: str):
         "tool_return_values": tool_return_values[0]["output"] if tool_return_values else "No tool return values"
     }
 
+async def stream_run_events(run_stream, thread_id: Optional[str] = None,
+                            on_run_created: Optional[Callable[[str], Awaitable]] = None):
+    """ Forward the events of a streamed run as they arrive.  Tool calls are
+    handled inline and the run continues on the stream returned when the tool
+    outputs are submitted.  on_run_created is called with the run id as soon as
+    the run exists.  If the stream is abandoned before the run ends, e.g. because
+    the client disconnected, the run is cancelled.  Yields dicts with an "event"
+    and "data" key:
+
+    thread: the thread id, once the run has been created
+    delta: a chunk of the chef's message text
+    tool: the output of a tool call
+    message: the final text of the chef's message
+    error: the run failed, expired or was cancelled
+    """
+    client = get_openai_client()
+    stream = run_stream
+    # The request that opened the stream, plus one per submission of tool outputs
+    round_trips = 1
+    # The run, while it is active
+    run_id = None
+    try:
+        while stream is not None:
+            next_stream = None
+            async for event in stream:
+                if event.event == "thread.run.created":
+                    thread_id = event.data.thread_id
+                    run_id = event.data.id
+                    if on_run_created is not None:
+                        await on_run_created(run_id)
+                    yield {"event": "thread", "data": thread_id}
+
+                elif event.event == "thread.message.delta":
+                    for content in event.data.delta.content or []:
+                        if content.type == "text" and content.text and content.text.value:
+                            yield {"event": "delta", "data": content.text.value}
+
+                elif event.event in ["thread.message.completed", "thread.message.incomplete"]:
+                    message = "".join(
+                        content.text.value for content in event.data.content if content.type == "text"
+                    )
+                    yield {"event": "message", "data": message}
+
+                elif event.event == "thread.run.requires_action":
+                    run = event.data
+                    tool_calls = run.required_action.submit_tool_outputs.tool_calls
+                    tool_outputs, tool_return_values = await process_tool_calls(tool_calls)
+                    for tool_return_value in tool_return_values:
+                        yield {"event": "tool", "data": tool_return_value}
+                    next_stream = await client.beta.threads.runs.submit_tool_outputs(
+                        thread_id=thread_id, run_id=run.id, tool_outputs=tool_outputs, stream=True
+                    )
+                    round_trips += 1
+
+                elif event.event in ["thread.run.completed", "thread.run.incomplete"]:
+                    run_id = None
+
+                elif event.event in ["thread.run.failed", "thread.run.expired", "thread.run.cancelled"]:
+                    run_id = None
+                    logger.error(f"Run {event.data.id} ended with status {event.data.status}")
+                    yield {"event": "error", "data": event.data.status}
+
+                elif event.event == "error":
+                    logger.error(f"Error streaming run: {event.data}")
+                    yield {"event": "error", "data": event.data.message}
+
+            stream = next_stream
+    except (asyncio.CancelledError, GeneratorExit):
+        if run_id is not None:
+            cancel_run(thread_id, run_id)
+        raise
+    metrics.observe("assistant_turn.round_trips", round_trips)
+
+async def run_turn(run_stream, thread_id: Optional[str] = None,
+                   on_run_created: Optional[Callable[[str], Awaitable]] = None):
+    """ Run a streamed run to the end and return its thread_id, final message, run_id and
+    tool return values, in the same shape as get_run_result.  The final message is read
+    from the stream, so the run needs no polling and no listing of the thread's messages
+    afterwards.  Returns None if the run fails. """
+    result = {"thread_id": thread_id, "message": "", "run_id": None, "tool_return_values": []}
+
+    async def run_created(run_id: str):
+        result["run_id"] = run_id
+        if on_run_created is not None:
+            await on_run_created(run_id)
+
+    async for event in stream_run_events(run_stream, thread_id, run_created):
+        if event["event"] == "thread":
+            result["thread_id"] = event["data"]
+        elif event["event"] == "message":
+            result["message"] = event["data"]
+        elif event["event"] == "tool":
+            result["tool_return_values"].append(event["data"])
+        elif event["event"] == "error":
+            return None
+
+    tool_return_values = result["tool_return_values"]
+    result["tool_return_values"] = tool_return_values[0]["output"] if tool_return_values else "No tool return values"
+    return result
+
 def get_assistant_id(chef_type: str):
   """ Load the assistant id from the store """
   assistant_id = id_dict[chef_type]
   return assistant_id
 
-def create_thread(role: str, content: str, metadata = None):
+async def create_thread(role: str, content: str, metadata = None):
   logger.info(f"Creating thread with role {role} and content {content}")
-  thread = client.beta.threads.create(
+  client = get_openai_client()
+  thread = await client.beta.threads.create(
       messages=[
           {
               "role": role,
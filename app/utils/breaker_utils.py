@@ -0,0 +1,202 @@
+""" Circuit breakers for the provider models used by the fallback model loops """
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import AsyncGenerator, AsyncIterator, Awaitable, Callable, Dict, List, Tuple
+from app.utils.deadline_utils import DeadlineExceeded
+from app.utils.metrics_utils import metrics
+from app.utils.ratelimit_utils import RateLimitTimeout
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger("main")
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# Cancelled, a streaming generator closed early, or out of budget: no verdict on the model
+NO_VERDICT = (asyncio.CancelledError, GeneratorExit, RateLimitTimeout, DeadlineExceeded)
+
+class CircuitOpenError(Exception):
+    """ Raised when a call is attempted on a model whose circuit is open. """
+
+class CircuitBreaker:
+    """ Tracks the recent error rate and latency of one (provider, model) pair.
+
+    The circuit opens when, over the last BREAKER_WINDOW seconds and at least
+    BREAKER_MIN_REQUESTS calls, the error rate reaches BREAKER_ERROR_RATE or the share of
+    calls slower than BREAKER_SLOW_CALL_SECONDS reaches BREAKER_SLOW_CALL_RATE.  After a
+    cooldown a single probe call is let through (half-open); success closes the circuit
+    and failure re-opens it with the cooldown doubled, up to BREAKER_MAX_COOLDOWN. """
+    def __init__(self, provider: str, model: str):
+        self.provider = provider
+        self.model = model
+        self.window_seconds = float(os.getenv("BREAKER_WINDOW", "60"))
+        self.min_requests = int(os.getenv("BREAKER_MIN_REQUESTS", "5"))
+        self.error_rate_threshold = float(os.getenv("BREAKER_ERROR_RATE", "0.5"))
+        self.slow_call_seconds = float(os.getenv("BREAKER_SLOW_CALL_SECONDS", "45"))
+        self.slow_call_rate_threshold = float(os.getenv("BREAKER_SLOW_CALL_RATE", "0.8"))
+        self.base_cooldown = float(os.getenv("BREAKER_COOLDOWN", "30"))
+        self.max_cooldown = float(os.getenv("BREAKER_MAX_COOLDOWN", "600"))
+        self.cooldown = self.base_cooldown
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        # (timestamp, succeeded, latency) for each call in the window
+        self.calls = deque()
+
+    def _prune(self, now: float):
+        while self.calls and self.calls[0][0] < now - self.window_seconds:
+            self.calls.popleft()
+
+    def is_available(self) -> bool:
+        """ Whether a call to the model would be allowed right now. """
+        if self.state == CLOSED:
+            return True
+        if self.probe_in_flight:
+            return False
+        return time.monotonic() >= self.opened_at + self.cooldown
+
+    def begin(self):
+        """ Claim permission for a call, raising CircuitOpenError if the circuit is open. """
+        if self.state == CLOSED:
+            return
+        if not self.is_available():
+            metrics.increment(f"breaker.{self.provider}.{self.model}.rejected")
+            raise CircuitOpenError(f"Circuit for {self.provider}/{self.model} is open")
+        self.state = HALF_OPEN
+        self.probe_in_flight = True
+        logger.info(f"Probing {self.provider}/{self.model}")
+
+    def release(self):
+        """ Give up a claimed call without recording a result, e.g. when it is cancelled. """
+        self.probe_in_flight = False
+
+    def record(self, succeeded: bool, latency: float):
+        """ Record the outcome of a call and update the circuit state. """
+        now = time.monotonic()
+        self.probe_in_flight = False
+        metrics.observe(f"provider.{self.provider}.{self.model}.latency", latency)
+        metrics.increment(f"provider.{self.provider}.{self.model}.{'success' if succeeded else 'error'}")
+
+        if self.state == HALF_OPEN:
+            if succeeded:
+                logger.info(f"Circuit for {self.provider}/{self.model} closed")
+                self.state = CLOSED
+                self.cooldown = self.base_cooldown
+                self.calls.clear()
+            else:
+                self._open(now, min(self.cooldown * 2, self.max_cooldown))
+            return
+
+        self.calls.append((now, succeeded, latency))
+        self._prune(now)
+        if self.state == CLOSED and len(self.calls) >= self.min_requests:
+            errors = sum(1 for _, ok, _ in self.calls if not ok)
+            slow = sum(1 for _, _, call_latency in self.calls if call_latency >= self.slow_call_seconds)
+            if (errors / len(self.calls) >= self.error_rate_threshold
+                    or slow / len(self.calls) >= self.slow_call_rate_threshold):
+                self._open(now, self.base_cooldown)
+
+    def _open(self, now: float, cooldown: float):
+        logger.warning(f"Circuit for {self.provider}/{self.model} opened for {cooldown}s")
+        metrics.increment(f"breaker.{self.provider}.{self.model}.opened")
+        self.state = OPEN
+        self.opened_at = now
+        self.cooldown = cooldown
+        self.calls.clear()
+
+    def snapshot(self) -> dict:
+        """ The current state of the breaker for the metrics endpoint. """
+        self._prune(time.monotonic())
+        errors = sum(1 for _, ok, _ in self.calls if not ok)
+        return {
+            "state": self.state,
+            "calls": len(self.calls),
+            "error_rate": errors / len(self.calls) if self.calls else 0.0,
+            "cooldown": self.cooldown,
+        }
+
+class BreakerRegistry:
+    """ The circuit breakers for every (provider, model) pair, shared by all services. """
+    def __init__(self):
+        self.breakers: Dict[Tuple[str, str], CircuitBreaker] = {}
+
+    def get(self, provider: str, model: str) -> CircuitBreaker:
+        """ Get the breaker for a model, creating it on first use. """
+        key = (provider, model)
+        if key not in self.breakers:
+            self.breakers[key] = CircuitBreaker(provider, model)
+        return self.breakers[key]
+
+    def available(self, provider: str, models: List[str]) -> List[str]:
+        """ Filter a fallback list down to the models whose circuit allows a call. """
+        allowed = [model for model in models if self.get(provider, model).is_available()]
+        skipped = [model for model in models if model not in allowed]
+        if skipped:
+            logger.info(f"Skipping {provider} models with open circuits: {skipped}")
+        return allowed
+
+    @contextmanager
+    def track(self, provider: str, model: str):
+        """ Guard a provider call: raises CircuitOpenError if the circuit is open,
+        otherwise records the call's outcome and latency.  Our own throttling and
+        deadlines, and cancellation, say nothing about the model and are not recorded. """
+        breaker = self.get(provider, model)
+        breaker.begin()
+        started = time.monotonic()
+        try:
+            yield breaker
+        except NO_VERDICT:
+            breaker.release()
+            raise
+        except Exception:
+            breaker.record(False, time.monotonic() - started)
+            raise
+        breaker.record(True, time.monotonic() - started)
+
+    async def call(self, provider: str, model: str, request: Callable[[], Awaitable]):
+        """ Make a single provider call guarded by the model's breaker, e.g. as the
+        request of a rate-limited call so that limiter waits are not counted. """
+        with self.track(provider, model):
+            return await request()
+
+    async def track_stream(self, provider: str, model: str, chunks: AsyncGenerator) -> AsyncIterator:
+        """ Forward a provider stream guarded by the model's breaker.  Only the time spent
+        waiting on the provider, to open the stream and for each chunk, is counted; the
+        consumer's time between chunks is not, and a consumer that stops early or is
+        cancelled gives no verdict.  Use it with contextlib.aclosing, so that the stream
+        is closed as soon as the consumer stops. """
+        breaker = self.get(provider, model)
+        breaker.begin()
+        waited = 0.0
+        try:
+            while True:
+                started = time.monotonic()
+                try:
+                    chunk = await chunks.__anext__()
+                except StopAsyncIteration:
+                    break
+                except NO_VERDICT:
+                    raise
+                except Exception:
+                    breaker.record(False, waited + time.monotonic() - started)
+                    raise
+                waited += time.monotonic() - started
+                yield chunk
+        except NO_VERDICT:
+            breaker.release()
+            raise
+        finally:
+            await chunks.aclose()
+        breaker.record(True, waited)
+
+    def snapshot(self) -> dict:
+        """ The state of every breaker, keyed by provider/model. """
+        return {f"{provider}/{model}": breaker.snapshot() for (provider, model), breaker in self.breakers.items()}
+
+breakers = BreakerRegistry()
+metrics.register("circuit_breakers", breakers.snapshot)
@@ -0,0 +1,156 @@
+""" A content-addressed cache for generated recipes, stored in Redis """
+import functools
+import hashlib
+import inspect
+import json
+import logging
+import os
+import re
+import time
+from typing import Callable, Optional, Type
+from pydantic import BaseModel
+from redis.exceptions import RedisError
+from app.middleware.session_middleware import get_redis
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger("main")
+
+RECIPE_CACHE_PREFIX = "recipe_cache"
+RECIPE_CACHE_INDEX = f"{RECIPE_CACHE_PREFIX}:index"
+RECIPE_CACHE_STATS = f"{RECIPE_CACHE_PREFIX}:stats"
+
+def get_recipe_cache_ttl() -> int:
+    """ How long a cached recipe is kept, in seconds. """
+    return int(os.getenv("RECIPE_CACHE_TTL", str(60 * 60 * 24 * 7)))
+
+def get_recipe_cache_max_entries() -> int:
+    """ The maximum number of recipes kept in the cache. """
+    return int(os.getenv("RECIPE_CACHE_MAX_ENTRIES", "10000"))
+
+def normalize_text(text) -> str:
+    """ Normalize text so that requests differing only in case, whitespace
+    or punctuation share a cache entry. """
+    text = re.sub(r"[^\w\s]", " ", str(text).lower())
+    return " ".join(text.split())
+
+def collapse_whitespace(text) -> str:
+    """ Normalize text by its whitespace only, for inputs such as a whole recipe whose
+    punctuation carries meaning ("1/2 cup" and "1-2 cups", "350°F"). """
+    return " ".join(str(text).split())
+
+def recipe_cache_key(name: str, model: str, prompt_version: str, params: dict,
+                     normalize_value: Callable[[object], str] = normalize_text) -> str:
+    """ Build the cache key from the normalized request, the model and the prompt version. """
+    normalized = {key: normalize_value(value) for key, value in sorted(params.items())}
+    digest = hashlib.sha256(
+        json.dumps([model, prompt_version, normalized]).encode("utf-8")
+    ).hexdigest()
+    return f"{RECIPE_CACHE_PREFIX}:{name}:{digest}"
+
+async def get_cached_recipe(name: str, key: str) -> Optional[str]:
+    """ Return the cached recipe for the key, or None on a miss. """
+    try:
+        async with get_redis().pipeline(transaction=False) as pipe:
+            pipe.get(key)
+            pipe.hincrby(RECIPE_CACHE_STATS, f"{name}:lookups", 1)
+            cached, _ = await pipe.execute()
+    except RedisError as e:
+        logger.error(f"Failed to read recipe cache: {e}")
+        return None
+    if cached is None:
+        try:
+            await get_redis().hincrby(RECIPE_CACHE_STATS, f"{name}:misses", 1)
+        except RedisError as e:
+            logger.error(f"Failed to update recipe cache stats: {e}")
+        return None
+    logger.info(f"Recipe cache hit for {key}")
+    return cached.decode("utf-8")
+
+async def set_cached_recipe(name: str, key: str, value: str):
+    """ Store a recipe and evict the oldest entries once the cache is over its size cap. """
+    ttl = get_recipe_cache_ttl()
+    try:
+        async with get_redis().pipeline(transaction=False) as pipe:
+            now = int(time.time())
+            pipe.set(key, value, ex=ttl)
+            pipe.zadd(RECIPE_CACHE_INDEX, {key: now})
+            # Entries older than the TTL have already expired
+            pipe.zremrangebyscore(RECIPE_CACHE_INDEX, "-inf", now - ttl)
+            pipe.zcard(RECIPE_CACHE_INDEX)
+            size = (await pipe.execute())[-1]
+
+        overflow = size - get_recipe_cache_max_entries()
+        if overflow > 0:
+            evicted = [member for member, _ in await get_redis().zpopmin(RECIPE_CACHE_INDEX, overflow)]
+            if evicted:
+                await get_redis().delete(*evicted)
+            logger.info(f"Evicted {len(evicted)} recipes from the recipe cache")
+    except RedisError as e:
+        logger.error(f"Failed to write recipe cache: {e}")
+
+async def get_recipe_cache_stats() -> dict:
+    """ Return the hit and miss counts for each cached function. """
+    try:
+        stats = await get_redis().hgetall(RECIPE_CACHE_STATS)
+        size = await get_redis().zcard(RECIPE_CACHE_INDEX)
+    except RedisError as e:
+        logger.error(f"Failed to read recipe cache stats: {e}")
+        return {}
+    counts = {}
+    for field, value in stats.items():
+        name, counter = field.decode("utf-8").rsplit(":", 1)
+        counts.setdefault(name, {"lookups": 0, "misses": 0})[counter] = int(value)
+    for count in counts.values():
+        count["hits"] = count["lookups"] - count["misses"]
+    return {"size": size, "functions": counts}
+
+def cached_recipe(name: str, model: str, prompt_version: str,
+                  recipe_model: Optional[Type[BaseModel]] = None,
+                  normalize: Optional[Callable[[dict], dict]] = None,
+                  normalize_value: Callable[[object], str] = normalize_text):
+    """ Cache the result of an async recipe function in Redis.
+
+    The key is the function's normalized arguments plus the model and prompt version,
+    so bump prompt_version whenever the prompt changes.  normalize may rewrite the
+    arguments (e.g. map serving sizes) before they are hashed, and normalize_value is
+    applied to each of them; pass collapse_whitespace for arguments whose punctuation
+    matters.  Results are stored as
+    JSON and, if recipe_model is given, rebuilt into that model on a hit.  Callers can
+    pass fresh=True to bypass the cache.  None results are never cached. """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        def cache_key(*args, **kwargs) -> str:
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            params = dict(bound.arguments)
+            if normalize:
+                params = normalize(params)
+            return recipe_cache_key(name, model, prompt_version, params, normalize_value)
+
+        async def get_cached(*args, **kwargs):
+            cached = await get_cached_recipe(name, cache_key(*args, **kwargs))
+            if cached is None or recipe_model is None:
+                return cached
+            return recipe_model(**json.loads(cached))
+
+        async def set_cached(result, *args, **kwargs):
+            if isinstance(result, BaseModel):
+                result = result.model_dump_json()
+            await set_cached_recipe(name, cache_key(*args, **kwargs), result)
+
+        @functools.wraps(func)
+        async def wrapper(*args, fresh: bool = False, **kwargs):
+            if not fresh:
+                cached = await get_cached(*args, **kwargs)
+                if cached is not None:
+                    return cached
+            result = await func(*args, **kwargs)
+            if result is not None and not fresh:
+                await set_cached(result, *args, **kwargs)
+            return result
+
+        wrapper.get_cached = get_cached
+        wrapper.set_cached = set_cached
+        return wrapper
+    return decorator
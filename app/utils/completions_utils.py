@@ -0,0 +1,169 @@
+""" A chat engine that answers as the chef with chat completions directly, using the
+session's own chat history as the context instead of an Assistants thread """
+import logging
+import os
+from contextlib import aclosing
+from types import SimpleNamespace
+from typing import List, Optional
+from openai import NOT_GIVEN, OpenAIError
+from app.dependencies import get_openai_client
+from app.utils.assistant_utils import process_tool_calls
+from app.utils.breaker_utils import breakers, CircuitOpenError
+from app.utils.ratelimit_utils import estimate_tokens, rate_limits, RateLimitTimeout
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger("main")
+
+ASSISTANTS_ENGINE = "assistants"
+COMPLETIONS_ENGINE = "completions"
+
+# The system prompt shared by every chef, followed by the chef's own persona
+base_chef_instructions = """You are a chef on Bakespace, a social and recipe platform that allows
+users to create, upload, and share recipes as well as create cookbooks for themselves and other
+users to enjoy.  Answer the user's cooking questions, help them adjust their recipes and suggest
+pairings.  Format your answers in markdown."""
+
+chef_instructions = {
+    "home_cook": "You are a friendly home cook.  Keep your advice simple, practical and encouraging,\
+    using everyday ingredients and equipment.",
+    "pro_chef": "You are a professional chef.  Share precise techniques, timings and the reasons\
+    behind them, as you would with a line cook in your kitchen.",
+    "adventurous_chef": "You are an adventurous chef who loves bold flavors and global cuisines.\
+    Suggest creative twists and unexpected ingredients while keeping the recipe achievable.",
+}
+
+def get_chat_engine(chef_type: Optional[str]) -> str:
+    """ The chat engine used for a chef type: CHAT_ENGINE_<CHEF_TYPE> if it is set,
+    otherwise CHAT_ENGINE.  Either "assistants" (the default) or "completions". """
+    engine = os.getenv(f"CHAT_ENGINE_{(chef_type or 'home_cook').upper()}") or os.getenv("CHAT_ENGINE")
+    engine = (engine or ASSISTANTS_ENGINE).lower()
+    if engine not in [ASSISTANTS_ENGINE, COMPLETIONS_ENGINE]:
+        logger.warning(f"Unknown chat engine {engine}, using {ASSISTANTS_ENGINE}")
+        return ASSISTANTS_ENGINE
+    return engine
+
+def get_completions_model() -> str:
+    """ The model used by the completions chat engine. """
+    return os.getenv("CHAT_COMPLETIONS_MODEL", "gpt-4o")
+
+def build_chat_messages(chef_type: Optional[str], chat_history: List[dict], context: Optional[str] = None,
+                        instructions: Optional[str] = None, summary: Optional[str] = None) -> List[dict]:
+    """ Build the chat completion messages for the chef from the session's chat history
+    and the summary of the turns before it, if any. """
+    system = "\n\n".join(
+        part for part in [
+            base_chef_instructions,
+            chef_instructions.get(chef_type, chef_instructions["home_cook"]),
+            context,
+            f"Summary of the earlier conversation: {summary}" if summary else None,
+            instructions,
+        ] if part
+    )
+    messages = [{"role": "system", "content": system}]
+    for message in chat_history:
+        role = "assistant" if message["role"] == "ai" else message["role"]
+        if role in ["user", "assistant", "system"] and message.get("content"):
+            messages.append({"role": role, "content": message["content"]})
+    return messages
+
+async def stream_completion_events(messages: List[dict], tools: Optional[list] = None,
+                                   tool_choice: Optional[dict] = None, answer_after_tools: bool = True,
+                                   max_tool_rounds: int = 3):
+    """ Stream the chef's answer from chat completions.  Tool calls are run with the
+    same functions as the Assistants runs and their outputs are sent back to the model
+    until it answers.  Yields the same events as assistant_utils.stream_run_events:
+
+    delta: a chunk of the chef's message text
+    tool: the output of a tool call
+    message: the final text of the chef's message
+    error: the completion failed
+    """
+    client = get_openai_client()
+    model = get_completions_model()
+    messages = list(messages)
+    for _ in range(max_tool_rounds + 1):
+        content = ""
+        tool_calls = {}
+
+        async def completion_chunks():
+            stream = await client.chat.completions.create(
+                model=model,
+                messages=messages,
+                tools=tools or NOT_GIVEN,
+                tool_choice=tool_choice or NOT_GIVEN,
+                temperature=0.75,
+                max_tokens=1000,
+                stream=True,
+            )
+            async with stream:
+                async for chunk in stream:
+                    yield chunk
+
+        try:
+            await rate_limits.acquire("openai", model, estimate_tokens(messages, 1000))
+            async with aclosing(breakers.track_stream("openai", model, completion_chunks())) as chunks:
+                async for chunk in chunks:
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta
+                    if delta.content:
+                        content += delta.content
+                        yield {"event": "delta", "data": delta.content}
+                    # Tool call names and arguments arrive in fragments keyed by index
+                    for tool_call in delta.tool_calls or []:
+                        call = tool_calls.setdefault(tool_call.index, {"id": "", "name": "", "arguments": ""})
+                        call["id"] = tool_call.id or call["id"]
+                        if tool_call.function:
+                            call["name"] += tool_call.function.name or ""
+                            call["arguments"] += tool_call.function.arguments or ""
+        except (OpenAIError, CircuitOpenError, RateLimitTimeout) as e:
+            logger.error(f"Error streaming chat completion: {e}")
+            yield {"event": "error", "data": str(e)}
+            return
+
+        if not tool_calls:
+            yield {"event": "message", "data": content}
+            return
+
+        calls = [
+            SimpleNamespace(id=call["id"], function=SimpleNamespace(name=call["name"], arguments=call["arguments"]))
+            for _, call in sorted(tool_calls.items())
+        ]
+        tool_outputs, tool_return_values = await process_tool_calls(calls)
+        for tool_return_value in tool_return_values:
+            yield {"event": "tool", "data": tool_return_value}
+        if not answer_after_tools:
+            yield {"event": "message", "data": content}
+            return
+
+        messages.append({
+            "role": "assistant",
+            "content": content or None,
+            "tool_calls": [
+                {"id": call.id, "type": "function",
+                 "function": {"name": call.function.name, "arguments": call.function.arguments}}
+                for call in calls
+            ],
+        })
+        messages.extend(
+            {"role": "tool", "tool_call_id": output["tool_call_id"], "content": output["output"]}
+            for output in tool_outputs
+        )
+        # The tool has been called, let the model answer
+        tool_choice = None
+
+    yield {"event": "message", "data": content}
+
+async def complete_chat(messages: List[dict], tools: Optional[list] = None, tool_choice: Optional[dict] = None,
+                        answer_after_tools: bool = True) -> dict:
+    """ Run the completions engine to the end.  Returns the chef's message, the tool
+    return values and the error, if any. """
+    result = {"message": "", "tool_return_values": [], "error": None}
+    async for event in stream_completion_events(messages, tools, tool_choice, answer_after_tools):
+        if event["event"] == "message":
+            result["message"] = event["data"]
+        elif event["event"] == "tool":
+            result["tool_return_values"].append(event["data"])
+        elif event["event"] == "error":
+            result["error"] = event["data"]
+    return result
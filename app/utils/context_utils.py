@@ -0,0 +1,140 @@
+""" Token-budgeted context windows for the chat, with older turns rolled into a summary """
+import asyncio
+import json
+import logging
+import os
+from typing import List, Optional, Tuple
+from openai import OpenAIError
+from redis.exceptions import RedisError
+from app.dependencies import get_openai_client
+from app.utils.breaker_utils import breakers, CircuitOpenError
+from app.utils.deadline_utils import detached_context
+from app.utils.ratelimit_utils import estimate_tokens, rate_limits, RateLimitTimeout
+from app.utils.session_utils import get_session_ttl
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger("main")
+
+# Summaries being written in the background, kept so that the tasks are not garbage collected
+summary_tasks = set()
+
+def get_context_token_budget() -> int:
+    """ The number of prompt tokens given to the recent chat history. """
+    return int(os.getenv("CHAT_CONTEXT_TOKENS", "3000"))
+
+def get_compaction_threshold() -> int:
+    """ How many tokens of older messages build up before they are rolled into the summary. """
+    return int(os.getenv("CHAT_COMPACTION_TOKENS", "1000"))
+
+def get_summary_model() -> str:
+    """ The model that writes the conversation summaries. """
+    return os.getenv("CHAT_SUMMARY_MODEL", "gpt-3.5-turbo-1106")
+
+def get_assistant_last_messages() -> int:
+    """ How many of the most recent thread messages an Assistants run sees. """
+    return int(os.getenv("ASSISTANT_LAST_MESSAGES", "20"))
+
+def get_assistant_max_prompt_tokens() -> int:
+    """ The most prompt tokens an Assistants run may use across its steps. """
+    return int(os.getenv("ASSISTANT_MAX_PROMPT_TOKENS", "8000"))
+
+def get_run_context_options() -> dict:
+    """ The truncation options for the Assistants runs, so that prompts stop growing with the thread. """
+    return {
+        "truncation_strategy": {"type": "last_messages", "last_messages": get_assistant_last_messages()},
+        "max_prompt_tokens": get_assistant_max_prompt_tokens(),
+    }
+
+def count_message_tokens(message: dict) -> int:
+    """ A rough token count for a chat message: about four characters per token. """
+    return len(str(message.get("content") or "")) // 4 + 4
+
+def split_context_window(messages: List[dict], budget: int) -> Tuple[List[dict], List[dict]]:
+    """ Split the messages into the older ones and the most recent ones that fit in the budget.
+    The latest message is always kept. """
+    used = 0
+    start = len(messages)
+    while start > 0:
+        tokens = count_message_tokens(messages[start - 1])
+        if used + tokens > budget and start < len(messages):
+            break
+        used += tokens
+        start -= 1
+    return messages[:start], messages[start:]
+
+async def summarize_messages(summary: Optional[str], messages: List[dict]) -> Optional[str]:
+    """ Fold the messages into the running summary of the conversation. """
+    transcript = "\n".join(f"{message['role']}: {message['content']}" for message in messages)
+    prompt = [
+        {
+            "role": "system", "content": """You summarize a conversation between a user and a chef
+            on a recipe website.  Keep the recipes, ingredients, adjustments, preferences, allergies
+            and decisions that later turns may refer to.  Be concise, at most 200 words."""
+        },
+        {
+            "role": "user",
+            "content": f"Summary so far:\n{summary or 'None'}\n\nNew messages:\n{transcript}"
+        },
+    ]
+    client = get_openai_client()
+    model = get_summary_model()
+    try:
+        await rate_limits.acquire("openai", model, estimate_tokens(prompt, 300))
+        with breakers.track("openai", model):
+            response = await client.chat.completions.create(
+                model=model, messages=prompt, temperature=0.2, max_tokens=300
+            )
+        return response.choices[0].message.content
+    except (OpenAIError, CircuitOpenError, RateLimitTimeout) as e:
+        logger.error(f"Failed to summarize the chat history: {e}")
+        return None
+
+async def compact_history(chat_service, summary: Optional[str], covered: int, older: List[dict]):
+    """ Roll the older messages into the session summary.  Runs after the request that
+    triggered it, so it writes to Redis directly, and a lock keeps concurrent turns from
+    summarizing the same messages twice. """
+    redis = chat_service.store.redis
+    lock = chat_service.session_key("summary_lock")
+    try:
+        if not await redis.set(lock, "1", nx=True, ex=60):
+            return
+    except RedisError as e:
+        logger.error(f"Failed to take the chat summary lock: {e}")
+        return
+    try:
+        new_summary = await summarize_messages(summary, older)
+        if new_summary:
+            await redis.set(
+                chat_service.session_key("summary"),
+                json.dumps({"summary": new_summary, "covered": covered + len(older)}),
+                ex=get_session_ttl()
+            )
+            logger.info(f"Compacted {len(older)} messages for session {chat_service.session_id}")
+    except RedisError as e:
+        logger.error(f"Failed to save the chat summary: {e}")
+    finally:
+        try:
+            await redis.delete(lock)
+        except RedisError as e:
+            logger.error(f"Failed to release the chat summary lock: {e}")
+
+async def get_context_window(chat_service, budget: Optional[int] = None) -> Tuple[Optional[str], List[dict]]:
+    """ Return the conversation summary and the recent messages that fit in the token
+    budget.  Messages that fall out of the window stay in it until enough of them build
+    up, and are then folded into the summary in the background, outside of the request
+    deadline. """
+    budget = budget or get_context_token_budget()
+    chat_history = await chat_service.load_chat_history()
+    summary, covered = await chat_service.load_summary()
+    if covered > len(chat_history):
+        # The history was cleared or replaced since the summary was written
+        summary, covered = None, 0
+    older, recent = split_context_window(chat_history[covered:], budget)
+    if sum(count_message_tokens(message) for message in older) < get_compaction_threshold():
+        return summary, older + recent
+    task = asyncio.create_task(
+        compact_history(chat_service, summary, covered, older), context=detached_context()
+    )
+    summary_tasks.add(task)
+    task.add_done_callback(summary_tasks.discard)
+    return summary, recent
@@ -0,0 +1,93 @@
+""" Request deadlines.  Each request gets a time budget for its endpoint, kept in a
+context variable, and every downstream call sizes its timeout and retries from what is
+left of it instead of from its own fixed settings. """
+import os
+import time
+from contextvars import Context, ContextVar, copy_context
+from typing import Optional, TypeVar
+
+T = TypeVar("T")
+
+# The time.monotonic() at which the current request must have answered
+request_deadline: ContextVar[Optional[float]] = ContextVar("request_deadline", default=None)
+
+# The budget of each endpoint, in seconds.  The streaming endpoints only need to have
+# started their response within it; the deadline is lifted once it has started.
+# Others get REQUEST_DEADLINE.
+endpoint_deadlines = {
+    "/get_chef_response": 90,
+    "/get_chef_response/stream": 60,
+    "/create-recipe": 60,
+    "/create-recipe/stream": 60,
+    "/generate-image": 90,
+    "/upload-files": 120,
+    "/format-recipe-text": 60,
+}
+
+class DeadlineExceeded(Exception):
+    """ Raised when a request has used up its deadline budget. """
+
+def get_default_deadline() -> float:
+    """ The budget of the endpoints without one of their own, in seconds. """
+    return float(os.getenv("REQUEST_DEADLINE", "60"))
+
+def get_deadline_retry_floor() -> float:
+    """ Below this many seconds left, calls are not retried. """
+    return float(os.getenv("REQUEST_DEADLINE_RETRY_FLOOR", "10"))
+
+def get_endpoint_deadline(path: str) -> float:
+    """ The budget for a request to the path.  REQUEST_DEADLINE_<PATH> overrides it, e.g.
+    REQUEST_DEADLINE_GENERATE_IMAGE for /generate-image. """
+    name = path.strip("/").replace("-", "_").replace("/", "_").upper()
+    override = os.getenv(f"REQUEST_DEADLINE_{name}")
+    if override:
+        return float(override)
+    return endpoint_deadlines.get(path, get_default_deadline())
+
+def start_deadline(budget: float):
+    """ Start the deadline of the current request.  Returns the token to reset it with. """
+    return request_deadline.set(time.monotonic() + budget)
+
+def detached_context() -> Context:
+    """ A copy of the current context without the request deadline, for the tasks that
+    carry on after the request, e.g. cleanups and background writes. """
+    context = copy_context()
+    context.run(request_deadline.set, None)
+    return context
+
+def remaining_time() -> Optional[float]:
+    """ The seconds left before the request deadline, or None outside of a request. """
+    deadline = request_deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+def check_deadline() -> Optional[float]:
+    """ Raise DeadlineExceeded if the request is out of time, otherwise return the
+    seconds left (None outside of a request). """
+    remaining = remaining_time()
+    if remaining is not None and remaining <= 0:
+        raise DeadlineExceeded("The request deadline was exceeded.")
+    return remaining
+
+def deadline_timeout(timeout: float) -> float:
+    """ The timeout for a call: its own timeout, capped by the time left. """
+    remaining = check_deadline()
+    return timeout if remaining is None else min(timeout, remaining)
+
+def deadline_retries(retries: int) -> int:
+    """ The retries for a call: its own, unless too little time is left to use them. """
+    remaining = check_deadline()
+    if remaining is not None and remaining < get_deadline_retry_floor():
+        return 0
+    return retries
+
+def with_deadline(client: T) -> T:
+    """ An SDK client (OpenAI or Anthropic) with its timeout and retries fitted into
+    the request deadline.  Outside of a request it is returned as it is. """
+    if request_deadline.get() is None:
+        return client
+    timeout = client.timeout if isinstance(client.timeout, (int, float)) else client.timeout.read
+    return client.with_options(
+        timeout=deadline_timeout(timeout or 600), max_retries=deadline_retries(client.max_retries)
+    )
@@ -0,0 +1,41 @@
+""" Stops the provider work of a request once its client has gone """
+import asyncio
+import logging
+from typing import Awaitable, TypeVar
+from fastapi import HTTPException, Request
+from app.utils.metrics_utils import metrics
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger("main")
+
+T = TypeVar("T")
+
+# The status logged for requests abandoned by their client, as nginx does
+CLIENT_CLOSED_REQUEST = 499
+
+async def wait_for_disconnect(request: Request):
+    """ Return once the client disconnects.  Only for endpoints that have read their
+    body and do not stream, since StreamingResponse listens for the disconnect itself. """
+    while True:
+        message = await request.receive()
+        if message["type"] == "http.disconnect":
+            return
+
+async def cancel_on_disconnect(request: Request, awaitable: Awaitable[T]) -> T:
+    """ Await the work of a request, cancelling it if the client disconnects first.
+    Cancellation reaches the provider calls underneath, which release their breaker
+    claims and cancel their Assistants runs.  Raises a 499 HTTPException when the
+    client has gone. """
+    work = asyncio.ensure_future(awaitable)
+    disconnect = asyncio.create_task(wait_for_disconnect(request))
+    try:
+        await asyncio.wait({work, disconnect}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        disconnect.cancel()
+        if not work.done():
+            work.cancel()
+    if work.cancelled() or not work.done():
+        logger.info(f"Client disconnected, cancelled the work for {request.url.path}")
+        metrics.increment("requests.disconnected")
+        raise HTTPException(status_code=CLIENT_CLOSED_REQUEST, detail="Client closed the request")
+    return work.result()
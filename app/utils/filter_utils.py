@@ -0,0 +1,112 @@
+""" A local food / spam classifier and a Redis verdict cache for the query filter """
+import hashlib
+import logging
+import os
+import re
+from typing import Optional
+from redis.exceptions import RedisError
+from app.middleware.session_middleware import get_redis
+from app.utils.cache_utils import normalize_text
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger("main")
+
+# Ingredients, dishes and drinks: words whose presence is strong evidence of a culinary query
+food_terms = set("""
+    flour sugar salt pepper butter oil olive egg eggs milk cream cheese yogurt honey syrup vanilla cinnamon
+    nutmeg ginger garlic onion onions shallot scallion leek basil oregano thyme rosemary parsley cilantro
+    mint dill sage cumin paprika turmeric curry chili chilli cayenne saffron cardamom clove cloves allspice
+    chicken beef pork lamb turkey duck bacon ham sausage steak brisket ribs veal venison fish salmon tuna
+    cod shrimp prawn prawns crab lobster scallops clams mussels oyster oysters tofu tempeh seitan beans
+    bean lentils lentil chickpeas chickpea rice pasta noodles noodle spaghetti macaroni lasagna ravioli
+    bread loaf dough yeast sourdough bagel baguette tortilla tortillas pita naan biscuit biscuits scone
+    scones muffin muffins pancake pancakes waffle waffles crepe crepes cake cakes cupcake cupcakes cookie
+    cookies brownie brownies pie pies tart tarts pastry croissant donut doughnut pudding custard mousse
+    icecream gelato sorbet frosting icing chocolate cocoa caramel fudge candy jam jelly marmalade
+    apple apples banana bananas orange oranges lemon lemons lime limes berry berries strawberry
+    strawberries blueberry blueberries raspberry raspberries cherry cherries peach peaches pear pears plum
+    grape grapes mango pineapple coconut avocado tomato tomatoes potato potatoes carrot carrots celery
+    spinach kale lettuce cabbage broccoli cauliflower zucchini squash pumpkin eggplant cucumber
+    peppers mushroom mushrooms corn peas asparagus beet beets radish artichoke olives nuts almond almonds
+    walnut walnuts pecan pecans peanut peanuts cashew pistachio hazelnut oats oatmeal granola cereal quinoa
+    barley couscous soup soups stew stews broth sauce sauces gravy dressing salad salads
+    sandwich sandwiches burger burgers pizza taco tacos burrito enchilada quesadilla sushi ramen pho
+    stirfry casserole quiche omelet omelette frittata risotto paella gnocchi dumpling dumplings
+    hummus guacamole salsa pesto vinaigrette mayonnaise mustard ketchup vinegar soy
+    cocktail cocktails mocktail smoothie smoothies juice lemonade tea coffee espresso latte wine beer cider
+    whiskey bourbon vodka gin rum tequila margarita mojito sangria milkshake
+""".split())
+
+# Cooking techniques, equipment, measures and meal words.  They support a culinary reading
+# but are too common elsewhere to decide a query on their own.
+cooking_terms = set("""
+    food foods recipe recipes dish dishes meal meals snack snacks dessert desserts appetizer appetizers
+    breakfast brunch lunch dinner supper entree cook cooking cooked bake baking baked roast roasted grill
+    grilled fry fried saute sauteed simmer boil boiled braise braised steam steamed poach poached whisk knead
+    marinate marinade chop chopped dice diced mince minced slice sliced stir blend preheat oven stovetop
+    skillet saucepan wok blender tablespoon tablespoons teaspoon teaspoons tbsp tsp ounce ounces gram grams
+    ml pinch serving servings ingredients directions prep calories vegan vegetarian gluten keto paleo dairy
+    glutenfree lowcarb spicy savory crispy creamy tangy barbecue bbq beverage beverages
+""".split())
+
+# Phrases that mark spam, advertising or abuse rather than a recipe request
+spam_terms = [
+    "buy now", "click here", "limited offer", "promo code", "discount code", "free money",
+    "make money", "work from home", "subscribe", "follow me", "casino", "betting", "crypto",
+    "bitcoin", "forex", "viagra", "cialis", "loan", "investment", "seo services", "porn",
+    "xxx", "onlyfans", "http://", "https://", "www.", ".com",
+]
+
+def _is_food_term(token: str) -> bool:
+    """ Whether the token (or its singular) is a known ingredient, dish or drink. """
+    return token in food_terms or token.rstrip("s") in food_terms
+
+def _is_cooking_term(token: str) -> bool:
+    """ Whether the token is a cooking technique, piece of equipment, measure or meal word. """
+    return token in cooking_terms or token.rstrip("s") in cooking_terms
+
+def classify_food_query(text: str) -> Optional[bool]:
+    """ Decide the clear cases of the food filter locally.  Returns True only on strong
+    evidence, i.e. at least one ingredient, dish or drink and two culinary words in all,
+    False for obvious spam with nothing culinary in it and None otherwise, so that
+    anything ambiguous is checked by the LLM. """
+    lowered = text.lower()
+    spam_hits = sum(1 for term in spam_terms if term in lowered)
+    tokens = re.findall(r"[a-z]+", lowered)
+    if not tokens:
+        return None
+    food_hits = sum(1 for token in tokens if _is_food_term(token))
+    cooking_hits = sum(1 for token in tokens if _is_cooking_term(token))
+
+    if spam_hits:
+        return False if food_hits + cooking_hits == 0 else None
+    if food_hits >= 1 and food_hits + cooking_hits >= 2:
+        return True
+    return None
+
+def get_filter_cache_ttl() -> int:
+    """ How long a verdict from the LLM filter is cached, in seconds. """
+    return int(os.getenv("FILTER_CACHE_TTL", str(60 * 60 * 24 * 30)))
+
+def filter_cache_key(text: str) -> str:
+    """ The verdict cache key for the normalized text. """
+    digest = hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+    return f"filter_verdict:{digest}"
+
+async def get_cached_verdict(text: str) -> Optional[bool]:
+    """ Return the cached verdict for the text, or None if it has not been seen. """
+    try:
+        verdict = await get_redis().get(filter_cache_key(text))
+    except RedisError as e:
+        logger.error(f"Failed to read filter verdict cache: {e}")
+        return None
+    if verdict is None:
+        return None
+    return verdict == b"1"
+
+async def set_cached_verdict(text: str, is_food: bool):
+    """ Cache the verdict for the text. """
+    try:
+        await get_redis().set(filter_cache_key(text), "1" if is_food else "0", ex=get_filter_cache_ttl())
+    except RedisError as e:
+        logger.error(f"Failed to write filter verdict cache: {e}")
@@ -0,0 +1,67 @@
+""" Latency tracking and hedged requests across providers """
+import asyncio
+import logging
+import math
+from collections import deque
+from typing import Any, Awaitable, Callable, Optional, Tuple, Type
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger("main")
+
+class LatencyWindow:
+    """ A rolling window of the most recent latencies, in seconds. """
+    def __init__(self, size: int = 200):
+        self.samples = deque(maxlen=size)
+
+    def record(self, latency: float):
+        """ Add a latency to the window. """
+        self.samples.append(latency)
+
+    def percentile(self, percentile: float) -> Optional[float]:
+        """ Return the given percentile (0-1) of the window, or None if it is empty. """
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        index = min(len(ordered) - 1, max(0, math.ceil(percentile * len(ordered)) - 1))
+        return ordered[index]
+
+    def __len__(self):
+        return len(self.samples)
+
+async def run_hedged(primary: Callable[[], Awaitable], hedge: Callable[[], Awaitable], delay: float,
+                     validate: Callable[[Any], Any], reraise: Tuple[Type[BaseException], ...] = ()):
+    """ Start the primary request and, if it has not produced a valid result within
+    delay seconds (or fails before then), start the hedge request alongside it.
+    validate turns a raw result into the value to return, or None if it is not usable.
+    The first valid result wins and the other request is cancelled.  Exceptions in
+    reraise are raised immediately; any other error counts as an invalid result.
+    Returns None if neither request produces a valid result. """
+    loop = asyncio.get_running_loop()
+    hedge_at = loop.time() + delay
+    tasks = {asyncio.create_task(primary()): "primary"}
+    hedge_started = False
+    try:
+        while tasks or not hedge_started:
+            if not hedge_started and (not tasks or loop.time() >= hedge_at):
+                logger.info("Starting hedge request")
+                tasks[asyncio.create_task(hedge())] = "hedge"
+                hedge_started = True
+            timeout = None if hedge_started else max(0, hedge_at - loop.time())
+            done, _ = await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                name = tasks.pop(task)
+                try:
+                    result = validate(task.result())
+                except reraise:
+                    raise
+                except Exception as e:
+                    logger.error(f"Hedged {name} request failed: {e}")
+                    result = None
+                if result is not None:
+                    logger.info(f"Hedged {name} request won")
+                    return result
+                logger.warning(f"Hedged {name} request did not produce a valid result")
+        return None
+    finally:
+        for task in tasks:
+            task.cancel()
@@ -0,0 +1,42 @@
+""" In-process metrics for the worker, served by the /metrics endpoint """
+from collections import defaultdict
+from typing import Callable, Dict
+from app.utils.latency_utils import LatencyWindow
+
+class Metrics:
+    """ Counters, observed values (e.g. latencies) and collectors that report
+    the state of other components when a snapshot is taken. """
+    def __init__(self):
+        self.counters: Dict[str, int] = defaultdict(int)
+        self.observations: Dict[str, LatencyWindow] = defaultdict(LatencyWindow)
+        self.collectors: Dict[str, Callable[[], dict]] = {}
+
+    def increment(self, name: str, amount: int = 1):
+        """ Increment a counter. """
+        self.counters[name] += amount
+
+    def observe(self, name: str, value: float):
+        """ Record an observed value such as a latency or a queue wait. """
+        self.observations[name].record(value)
+
+    def register(self, name: str, collector: Callable[[], dict]):
+        """ Register a function whose result is included in every snapshot. """
+        self.collectors[name] = collector
+
+    def snapshot(self) -> dict:
+        """ Return the current value of every metric. """
+        return {
+            "counters": dict(self.counters),
+            "observations": {
+                name: {
+                    "count": len(window),
+                    "p50": window.percentile(0.5),
+                    "p95": window.percentile(0.95),
+                    "max": window.percentile(1),
+                }
+                for name, window in self.observations.items()
+            },
+            **{name: collector() for name, collector in self.collectors.items()},
+        }
+
+metrics = Metrics()
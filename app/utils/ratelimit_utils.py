@@ -0,0 +1,241 @@
+""" Async token-bucket rate limiting for the LLM providers, fed from their rate-limit headers """
+import asyncio
+import json
+import logging
+import os
+import random
+import re
+import time
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, Optional, Tuple, Type
+import httpx
+from app.utils.deadline_utils import deadline_retries, deadline_timeout
+from app.utils.metrics_utils import metrics
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger("main")
+
+# The hosts of each provider, used to attribute responses seen by the HTTP clients
+provider_hosts = {
+    "api.openai.com": "openai",
+    "api.anthropic.com": "anthropic",
+}
+
+# (limit, remaining, reset) headers for the request and token budgets of each provider
+rate_limit_headers = {
+    "openai": {
+        "requests": ("x-ratelimit-limit-requests", "x-ratelimit-remaining-requests", "x-ratelimit-reset-requests"),
+        "tokens": ("x-ratelimit-limit-tokens", "x-ratelimit-remaining-tokens", "x-ratelimit-reset-tokens"),
+    },
+    "anthropic": {
+        "requests": ("anthropic-ratelimit-requests-limit", "anthropic-ratelimit-requests-remaining",
+                     "anthropic-ratelimit-requests-reset"),
+        "tokens": ("anthropic-ratelimit-tokens-limit", "anthropic-ratelimit-tokens-remaining",
+                   "anthropic-ratelimit-tokens-reset"),
+    },
+}
+
+class RateLimitTimeout(Exception):
+    """ Raised when a call would have to wait longer than RATE_LIMIT_MAX_WAIT for its budget. """
+
+def get_rate_limit_max_wait() -> float:
+    """ The longest a caller will queue for rate-limit budget, in seconds. """
+    return float(os.getenv("RATE_LIMIT_MAX_WAIT", "30"))
+
+def get_rate_limit_retries() -> int:
+    """ How many times a rate-limited call is retried. """
+    return int(os.getenv("RATE_LIMIT_RETRIES", "2"))
+
+def parse_reset(value: str) -> Optional[float]:
+    """ Parse a reset header into seconds from now.  OpenAI sends durations
+    such as "6m0s" or "20ms"; Anthropic sends RFC 3339 timestamps. """
+    try:
+        return max(0.0, datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp() - time.time())
+    except ValueError:
+        pass
+    units = {"h": 3600, "m": 60, "s": 1, "ms": 0.001}
+    parts = re.findall(r"([\d.]+)(ms|h|m|s)", value)
+    if not parts:
+        return None
+    return sum(float(amount) * units[unit] for amount, unit in parts)
+
+def parse_retry_after(headers: httpx.Headers) -> Optional[float]:
+    """ The retry-after of a response in seconds, if it sent one. """
+    for header, scale in (("retry-after-ms", 0.001), ("retry-after", 1)):
+        try:
+            return float(headers[header]) * scale
+        except (KeyError, ValueError):
+            continue
+    return None
+
+class TokenBucket:
+    """ A bucket of capacity units that refills at rate units per second.  The capacity
+    and level are unknown (unlimited) until the provider reports them. """
+    def __init__(self):
+        self.capacity: Optional[float] = None
+        self.rate = 0.0
+        self.level = 0.0
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        if self.capacity is not None:
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """ How long until amount units are available. """
+        now = time.monotonic()
+        self._refill(now)
+        if self.capacity is None:
+            return 0.0
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        if self.rate <= 0:
+            return float("inf")
+        return (amount - self.level) / self.rate
+
+    def take(self, amount: float):
+        """ Spend amount units.  The level may go negative so that later callers wait. """
+        self._refill(time.monotonic())
+        if self.capacity is not None:
+            self.level -= min(amount, self.capacity)
+
+    def update(self, limit: float, remaining: float, reset: Optional[float]):
+        """ Resync the bucket with the budget reported by the provider. """
+        self._refill(time.monotonic())
+        self.capacity = limit
+        # Both providers replenish the budget continuously and report when it will be
+        # full again; without that assume the per-minute limits they document
+        if reset and remaining < limit:
+            self.rate = (limit - remaining) / reset
+        else:
+            self.rate = limit / 60.0
+        self.level = remaining
+
+class RateLimiter:
+    """ The request and token budgets of one (provider, model) pair.  Callers queue in
+    order behind an asyncio lock, so a burst waits on the event loop per request instead
+    of blocking the worker. """
+    def __init__(self, provider: str, model: str):
+        self.provider = provider
+        self.model = model
+        self.requests = TokenBucket()
+        self.tokens = TokenBucket()
+        self.blocked_until = 0.0
+        self.lock = asyncio.Lock()
+
+    def wait_time(self, tokens: float) -> float:
+        """ How long a call needing tokens would have to wait right now. """
+        return max(self.blocked_until - time.monotonic(), self.requests.wait_time(1), self.tokens.wait_time(tokens))
+
+    async def acquire(self, tokens: float = 0, max_wait: Optional[float] = None):
+        """ Wait for budget for one request of roughly tokens tokens.  Raises
+        RateLimitTimeout if the wait would exceed max_wait or the request deadline. """
+        max_wait = deadline_timeout(get_rate_limit_max_wait() if max_wait is None else max_wait)
+        started = time.monotonic()
+        async with self.lock:
+            while True:
+                wait = self.wait_time(tokens)
+                if wait <= 0:
+                    break
+                if time.monotonic() - started + wait > max_wait:
+                    metrics.increment(f"ratelimit.{self.provider}.{self.model}.rejected")
+                    raise RateLimitTimeout(
+                        f"Rate limit for {self.provider}/{self.model} needs a {wait:.1f}s wait"
+                    )
+                logger.info(f"Waiting {wait:.2f}s for {self.provider}/{self.model} rate limit")
+                await asyncio.sleep(wait)
+            self.requests.take(1)
+            self.tokens.take(tokens)
+        metrics.observe(f"ratelimit.{self.provider}.{self.model}.wait", time.monotonic() - started)
+
+    def update(self, headers: httpx.Headers):
+        """ Resync the budgets from a provider response. """
+        for kind, (limit, remaining, reset) in rate_limit_headers[self.provider].items():
+            try:
+                limit_value, remaining_value = float(headers[limit]), float(headers[remaining])
+            except (KeyError, ValueError):
+                continue
+            reset_value = parse_reset(headers[reset]) if reset in headers else None
+            getattr(self, kind).update(limit_value, remaining_value, reset_value)
+
+    def block(self, seconds: float):
+        """ Hold every caller back for seconds, e.g. after a 429 with retry-after. """
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def snapshot(self) -> dict:
+        """ The current budgets for the metrics endpoint. """
+        return {
+            "requests": self.requests.level if self.requests.capacity is not None else None,
+            "tokens": self.tokens.level if self.tokens.capacity is not None else None,
+            "blocked_for": max(0.0, self.blocked_until - time.monotonic()),
+        }
+
+class RateLimiterRegistry:
+    """ The rate limiters for every (provider, model) pair, shared by all services. """
+    def __init__(self):
+        self.limiters: Dict[Tuple[str, str], RateLimiter] = {}
+
+    def get(self, provider: str, model: str) -> RateLimiter:
+        """ Get the limiter for a model, creating it on first use. """
+        key = (provider, model)
+        if key not in self.limiters:
+            self.limiters[key] = RateLimiter(provider, model)
+        return self.limiters[key]
+
+    async def acquire(self, provider: str, model: str, tokens: float = 0):
+        """ Wait for budget for one request to the model. """
+        await self.get(provider, model).acquire(tokens)
+
+    async def observe_response(self, response: httpx.Response):
+        """ httpx response hook for the provider clients: resync the model's budgets from
+        the rate-limit headers and honour retry-after on a 429. """
+        provider = provider_hosts.get(response.request.url.host)
+        if provider is None:
+            return
+        try:
+            model = json.loads(response.request.content).get("model")
+        except (ValueError, AttributeError, httpx.RequestNotRead):
+            model = None
+        if not model:
+            return
+        limiter = self.get(provider, model)
+        limiter.update(response.headers)
+        if response.status_code == 429:
+            retry_after = parse_retry_after(response.headers)
+            if retry_after:
+                limiter.block(retry_after)
+
+    async def call(self, provider: str, model: str, request: Callable[[], Awaitable],
+                   tokens: float = 0, retry_on: Tuple[Type[BaseException], ...] = ()):
+        """ Make a rate-limited request, retrying the errors in retry_on with jittered
+        exponential backoff (or the provider's retry-after, whichever is longer). """
+        limiter = self.get(provider, model)
+        retries = deadline_retries(get_rate_limit_retries())
+        for attempt in range(retries + 1):
+            await limiter.acquire(tokens)
+            try:
+                return await request()
+            except retry_on as e:
+                if attempt == retries:
+                    raise
+                metrics.increment(f"ratelimit.{provider}.{model}.retried")
+                response = getattr(e, "response", None)
+                retry_after = parse_retry_after(response.headers) if response is not None else None
+                backoff = random.uniform(0, min(2 ** attempt, 8))
+                delay = max(backoff, retry_after or 0)
+                logger.warning(f"Rate limited by {provider}/{model}, retrying in {delay:.2f}s")
+                limiter.block(delay)
+
+    def snapshot(self) -> dict:
+        """ The budgets of every limiter, keyed by provider/model. """
+        return {f"{provider}/{model}": limiter.snapshot() for (provider, model), limiter in self.limiters.items()}
+
+def estimate_tokens(messages: list, max_tokens: int, system: Optional[str] = None) -> int:
+    """ A rough token count for a request: about four characters per prompt
+    token plus the completion budget. """
+    return (len(json.dumps(messages)) + len(system or "")) // 4 + max_tokens
+
+rate_limits = RateLimiterRegistry()
+metrics.register("rate_limits", rate_limits.snapshot)
@@ -0,0 +1,397 @@
+""" Tracks Assistants runs until they settle.  Each run is polled by a single task
+across all of the workers, with adaptive backoff, and waiters are woken when its
+status changes instead of every request polling the run on its own. """
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+import uuid
+from typing import AsyncIterator, Dict, Optional
+from redis.exceptions import RedisError, WatchError
+from app.dependencies import get_openai_client
+from app.middleware.session_middleware import get_redis
+from app.utils.deadline_utils import deadline_timeout, detached_context
+from app.utils.metrics_utils import metrics
+from app.utils.session_utils import WORKER_ID
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger("main")
+
+# The statuses after which a run will not change again without the caller acting
+END_STATUSES = {"completed", "incomplete", "failed", "expired", "cancelling", "cancelled"}
+SETTLED_STATUSES = END_STATUSES | {"requires_action"}
+
+# Published with "{run_id}:{status}" by the worker polling a run whenever its status changes
+RUN_STATUS_CHANNEL = "run_status"
+
+def get_run_poll_initial_delay() -> float:
+    """ The delay before the first status check of a run, in seconds. """
+    return float(os.getenv("RUN_POLL_INITIAL_DELAY", "0.25"))
+
+def get_run_poll_max_delay() -> float:
+    """ The longest delay between status checks of a run, in seconds. """
+    return float(os.getenv("RUN_POLL_MAX_DELAY", "4"))
+
+def get_run_poll_timeout() -> float:
+    """ How long a request waits for a run to settle, in seconds. """
+    return float(os.getenv("RUN_POLL_TIMEOUT", "600"))
+
+def get_run_queue_timeout() -> float:
+    """ How long a request queues for a thread that is busy with another run, in seconds. """
+    return float(os.getenv("RUN_QUEUE_TIMEOUT", "60"))
+
+def get_run_cancel_timeout() -> float:
+    """ The timeout of the call cancelling an abandoned run, in seconds. """
+    return float(os.getenv("RUN_CANCEL_TIMEOUT", "10"))
+
+def get_thread_lock_ttl() -> int:
+    """ The expiry of a thread's run lock, in seconds.  The holder renews it, so this
+    only bounds how long a crashed worker can keep the thread. """
+    return int(os.getenv("THREAD_LOCK_TTL", "30"))
+
+def next_poll_delay(delay: float) -> float:
+    """ Double the delay between status checks, up to RUN_POLL_MAX_DELAY. """
+    return min(delay * 2, get_run_poll_max_delay())
+
+async def retrieve_run_status(thread_id, run_id):
+    client = get_openai_client()
+    try:
+        return await client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run_id)
+    except Exception as e:
+        logging.error(f"Error retrieving run status: {e}")
+        return None
+
+# Cancellations sent for abandoned runs, kept so that the tasks are not garbage collected
+cancel_tasks = set()
+
+async def _cancel_run(thread_id: str, run_id: str):
+    try:
+        client = get_openai_client().with_options(timeout=get_run_cancel_timeout(), max_retries=1)
+        await client.beta.threads.runs.cancel(thread_id=thread_id, run_id=run_id)
+        metrics.increment("run_tracker.cancelled")
+        logger.info(f"Cancelled run {run_id} on thread {thread_id}")
+    except Exception as e:
+        logger.error(f"Error cancelling run {run_id}: {e}")
+
+def cancel_run(thread_id: str, run_id: str):
+    """ Cancel a run nobody is waiting for any more.  The cancellation is sent from a
+    task of its own, since the caller is usually being cancelled itself, and outside of
+    the request deadline, which has often run out by then. """
+    task = asyncio.create_task(_cancel_run(thread_id, run_id), context=detached_context())
+    cancel_tasks.add(task)
+    task.add_done_callback(cancel_tasks.discard)
+
+class TrackedRun:
+    """ The latest known state of a run and the requests waiting on it in this worker. """
+    def __init__(self, thread_id: str, run_id: str):
+        self.thread_id = thread_id
+        self.run_id = run_id
+        self.run = None
+        self.status: Optional[str] = None
+        self.failed = False
+        self.waiters = 0
+        self.task: Optional[asyncio.Task] = None
+        self.delay = get_run_poll_initial_delay()
+        self.changed = asyncio.Event()
+        self.wake = asyncio.Event()
+
+    def update(self, status: str, run=None) -> bool:
+        """ Record the run's status, waking the waiters if it changed. """
+        if run is not None:
+            self.run = run
+        if status == self.status:
+            return False
+        self.status = status
+        self.delay = get_run_poll_initial_delay()
+        self.changed.set()
+        self.changed = asyncio.Event()
+        return True
+
+    def fail(self):
+        """ Give up on the run, waking the waiters. """
+        self.failed = True
+        self.changed.set()
+
+class RunTracker:
+    """ The runs being waited on in this worker.  One task per run either polls it, if
+    this worker holds the run's poller lock in Redis, or follows the statuses that the
+    worker holding it publishes on RUN_STATUS_CHANNEL. """
+    def __init__(self):
+        self.runs: Dict[str, TrackedRun] = {}
+
+    async def wait(self, thread_id: str, run_id: str, run=None, statuses=SETTLED_STATUSES):
+        """ Wait until the run reaches one of the statuses and return it, or None if the
+        run could not be retrieved or did not settle within RUN_POLL_TIMEOUT.  Pass the
+        latest copy of the run the caller has, e.g. the one returned when it was created
+        or its tool outputs were submitted, so that the poller starts from there. """
+        tracked = self.runs.get(run_id)
+        if tracked is None:
+            tracked = self.runs[run_id] = TrackedRun(thread_id, run_id)
+        if run is not None:
+            tracked.update(run.status, run)
+            tracked.wake.set()
+        if tracked.task is None or tracked.task.done():
+            tracked.task = asyncio.create_task(self._track(tracked))
+
+        tracked.waiters += 1
+        started = time.monotonic()
+        try:
+            deadline = started + deadline_timeout(get_run_poll_timeout())
+            while tracked.status not in statuses and not tracked.failed:
+                await asyncio.wait_for(tracked.changed.wait(), deadline - time.monotonic())
+        except asyncio.TimeoutError:
+            logger.error(f"Timed out waiting for run {run_id}")
+            return None
+        finally:
+            tracked.waiters -= 1
+            if tracked.waiters == 0:
+                tracked.task.cancel()
+                self.runs.pop(run_id, None)
+        metrics.observe("run_tracker.wait", time.monotonic() - started)
+
+        if tracked.failed:
+            return None
+        if tracked.run is None or tracked.run.status != tracked.status:
+            # Followed from another worker's poller, fetch the run itself once
+            tracked.run = await retrieve_run_status(thread_id, run_id)
+        return tracked.run
+
+    def notify(self, run_id: str, status: str):
+        """ Apply a status published by the worker polling the run. """
+        tracked = self.runs.get(run_id)
+        if tracked is not None:
+            tracked.update(status)
+
+    async def _claim(self, run_id: str, ttl: int) -> bool:
+        """ Take or renew this worker's lock on polling the run. """
+        redis = get_redis()
+        lock = f"run_poller:{run_id}"
+        if await redis.set(lock, WORKER_ID, nx=True, ex=ttl):
+            return True
+        if await redis.get(lock) == WORKER_ID.encode():
+            await redis.expire(lock, ttl)
+            return True
+        return False
+
+    async def _track(self, tracked: TrackedRun):
+        """ Poll or follow the run until it ends or nobody is waiting on it. """
+        redis = get_redis()
+        ttl = int(get_run_poll_max_delay() * 3) + 1
+        status_key = f"run_status:{tracked.run_id}"
+        leader = False
+        failures = 0
+        try:
+            while tracked.status not in END_STATUSES:
+                try:
+                    leader = await self._claim(tracked.run_id, ttl)
+                except RedisError as e:
+                    # Without Redis every worker polls its own runs
+                    logger.warning(f"Run poller lock unavailable, polling run {tracked.run_id} locally: {e}")
+                    leader = True
+
+                if not leader:
+                    # Another worker polls the run; catch up with the last status it
+                    # saw, then wait for the next one or for its lock to lapse
+                    try:
+                        stored = await redis.get(status_key)
+                    except RedisError:
+                        stored = None
+                    if stored:
+                        tracked.update(stored.decode())
+                    changed = tracked.changed
+                    try:
+                        await asyncio.wait_for(changed.wait(), ttl)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                try:
+                    await asyncio.wait_for(tracked.wake.wait(), tracked.delay)
+                except asyncio.TimeoutError:
+                    pass
+                tracked.wake.clear()
+                metrics.increment("run_tracker.polls")
+                run = await retrieve_run_status(tracked.thread_id, tracked.run_id)
+                if run is None:
+                    failures += 1
+                    if failures >= 3:
+                        tracked.fail()
+                        return
+                    tracked.delay = next_poll_delay(tracked.delay)
+                    continue
+                failures = 0
+                if tracked.update(run.status, run):
+                    metrics.increment("run_tracker.status_changes")
+                    try:
+                        await redis.set(status_key, run.status, ex=int(get_run_poll_timeout()))
+                        await redis.publish(RUN_STATUS_CHANNEL, f"{tracked.run_id}:{run.status}")
+                    except RedisError as e:
+                        logger.error(f"Failed to publish the status of run {tracked.run_id}: {e}")
+                else:
+                    tracked.delay = next_poll_delay(tracked.delay)
+        finally:
+            if leader:
+                try:
+                    lock = f"run_poller:{tracked.run_id}"
+                    if await redis.get(lock) == WORKER_ID.encode():
+                        await redis.delete(lock)
+                except RedisError:
+                    pass
+
+    def snapshot(self) -> dict:
+        """ The runs being tracked for the metrics endpoint. """
+        return {
+            "runs": len(self.runs),
+            "waiters": sum(tracked.waiters for tracked in self.runs.values()),
+        }
+
+run_tracker = RunTracker()
+metrics.register("run_tracker", run_tracker.snapshot)
+
+class ThreadBusyError(Exception):
+    """ Raised when a thread is busy with another run for longer than RUN_QUEUE_TIMEOUT. """
+
+def get_run_request_key(message_content: str, save_recipe: bool = False) -> str:
+    """ Identifies a chef request, so that a double submit can be recognised. """
+    return hashlib.sha1(f"{save_recipe}:{message_content}".encode("utf-8")).hexdigest()
+
+class ThreadRunLock:
+    """ A Redis lock that lets one run at a time be made on a thread, since the
+    Assistants API rejects a run while another is active.  Requests for a busy thread
+    queue until it is released, or, if they repeat the request being answered, share
+    its run instead of making another. """
+    def __init__(self, thread_id: str, request_key: str):
+        self.thread_id = thread_id
+        self.request_key = request_key
+        self.key = f"thread_run:{thread_id}"
+        self.token = uuid.uuid4().hex
+        self.run_id: Optional[str] = None
+        self.coalesced_run_id: Optional[str] = None
+        self.value: Optional[str] = None
+        self.renewal: Optional[asyncio.Task] = None
+
+    def _encode(self) -> str:
+        return json.dumps({"token": self.token, "request": self.request_key, "run_id": self.run_id})
+
+    async def acquire(self, coalesce: bool = True):
+        """ Wait for the thread.  Sets coalesced_run_id instead if the active run is
+        answering the same request.  Raises ThreadBusyError after RUN_QUEUE_TIMEOUT,
+        or sooner if the request deadline comes first. """
+        redis = get_redis()
+        ttl = get_thread_lock_ttl()
+        started = time.monotonic()
+        queue_timeout = deadline_timeout(get_run_queue_timeout())
+        delay = 0.1
+        try:
+            while True:
+                value = self._encode()
+                if await redis.set(self.key, value, nx=True, ex=ttl):
+                    self.value = value
+                    self.start_renewal()
+                    break
+                stored = await redis.get(self.key)
+                active = json.loads(stored) if stored else {}
+                if coalesce and active.get("request") == self.request_key and active.get("run_id"):
+                    self.coalesced_run_id = active["run_id"]
+                    metrics.increment("thread_runs.coalesced")
+                    break
+                if time.monotonic() - started + delay > queue_timeout:
+                    metrics.increment("thread_runs.busy")
+                    raise ThreadBusyError(f"Thread {self.thread_id} is busy with another run")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 1.0)
+        except RedisError as e:
+            logger.warning(f"Thread run lock unavailable for thread {self.thread_id}: {e}")
+        metrics.observe("thread_runs.queued", time.monotonic() - started)
+        return self
+
+    async def _if_held(self, command) -> bool:
+        """ Apply command to a transaction if the lock is still held by this request. """
+        if self.value is None:
+            return False
+        async with get_redis().pipeline() as pipe:
+            try:
+                await pipe.watch(self.key)
+                if await pipe.get(self.key) != self.value.encode():
+                    return False
+                pipe.multi()
+                command(pipe)
+                await pipe.execute()
+                return True
+            except WatchError:
+                return False
+
+    async def _renew(self, ttl: int):
+        """ Keep the lock while the run goes on, up to RUN_POLL_TIMEOUT. """
+        deadline = time.monotonic() + get_run_poll_timeout()
+        while time.monotonic() < deadline:
+            await asyncio.sleep(ttl / 3)
+            try:
+                if not await self._if_held(lambda pipe: pipe.expire(self.key, ttl)):
+                    return
+            except RedisError as e:
+                logger.error(f"Failed to renew the run lock on thread {self.thread_id}: {e}")
+
+    def start_renewal(self):
+        """ Renew the lock in the background while it is held. """
+        if self.value is not None and (self.renewal is None or self.renewal.done()):
+            self.renewal = asyncio.create_task(self._renew(get_thread_lock_ttl()))
+
+    def stop_renewal(self):
+        """ Stop renewing the lock, so that it lapses after THREAD_LOCK_TTL unless it is
+        released or renewed again first. """
+        if self.renewal is not None:
+            self.renewal.cancel()
+
+    async def set_run(self, run_id: str):
+        """ Record the run answering this request, so that double submits can share it. """
+        self.run_id = run_id
+        value = self._encode()
+        try:
+            if await self._if_held(lambda pipe: pipe.set(self.key, value, keepttl=True)):
+                self.value = value
+        except RedisError as e:
+            logger.error(f"Failed to record run {run_id} on thread {self.thread_id}: {e}")
+
+    async def release(self):
+        """ Free the thread for the next run.  Safe to call more than once. """
+        self.stop_renewal()
+        try:
+            await self._if_held(lambda pipe: pipe.delete(self.key))
+        except RedisError as e:
+            logger.error(f"Failed to release the run lock on thread {self.thread_id}: {e}")
+        self.value = None
+
+async def release_after(run_lock: Optional[ThreadRunLock], stream: AsyncIterator) -> AsyncIterator:
+    """ Forward a streamed response, renewing the thread's run lock while it streams and
+    releasing it once it ends.  The caller stops the renewal before returning the
+    response, so a body that is never started cannot hold the thread for longer than
+    THREAD_LOCK_TTL; pass run_lock.release as the response's background task as well, so
+    that a client leaving before the body starts frees the thread at once. """
+    if run_lock is not None:
+        run_lock.start_renewal()
+    try:
+        async for chunk in stream:
+            yield chunk
+    finally:
+        if run_lock is not None:
+            await run_lock.release()
+
+async def run_status_listener():
+    """ Wake the requests in this worker that follow a run polled by another worker. """
+    while True:
+        pubsub = get_redis().pubsub()
+        try:
+            await pubsub.subscribe(RUN_STATUS_CHANNEL)
+            async for message in pubsub.listen():
+                if message["type"] != "message":
+                    continue
+                run_id, status = message["data"].decode().split(":", 1)
+                run_tracker.notify(run_id, status)
+        except RedisError as e:
+            logger.error(f"Run status listener failed: {e}")
+            await asyncio.sleep(1)
+        finally:
+            await pubsub.aclose()
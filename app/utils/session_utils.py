@@ -0,0 +1,215 @@
+""" Expiry, compression, caching and garbage collection for the chat session keys in Redis """
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+from typing import Optional
+from redis.exceptions import RedisError
+from app.middleware.session_middleware import get_redis
+from app.utils.metrics_utils import metrics
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger("main")
+
+# The keys stored for each session, as {session_id}:{field}.  chat_history is the
+# legacy JSON blob that is migrated onto the messages list on first load.
+SESSION_FIELDS = (
+    "chef_type", "thread_id", "messages", "context", "summary", "thread_messages", "chat_history"
+)
+
+# Marks a message that was compressed before it was stored
+COMPRESSED_PREFIX = b"\x00zlib:"
+
+SWEEPER_LOCK = "session_sweeper:lock"
+
+# Published with "{worker_id}:{session_id}" whenever a session's metadata changes
+INVALIDATION_CHANNEL = "session_invalidation"
+WORKER_ID = uuid.uuid4().hex[:12]
+
+def get_session_ttl() -> int:
+    """ How long an idle session is kept, in seconds.  Every access resets the clock. """
+    return int(os.getenv("SESSION_TTL", str(60 * 60 * 24 * 30)))
+
+def get_compression_threshold() -> int:
+    """ Messages larger than this many bytes are compressed. """
+    return int(os.getenv("SESSION_COMPRESSION_THRESHOLD", "1024"))
+
+def get_sweep_interval() -> int:
+    """ How often the session sweeper runs, in seconds.  0 disables it. """
+    return int(os.getenv("SESSION_SWEEP_INTERVAL", str(60 * 60)))
+
+def get_session_refresh_interval() -> float:
+    """ How often the TTL of a session served from the in-process cache is refreshed in
+    Redis, in seconds.  Never less often than twice per SESSION_TTL. """
+    return min(float(os.getenv("SESSION_REFRESH_INTERVAL", "60")), get_session_ttl() / 2)
+
+def get_session_cache_size() -> int:
+    """ The maximum number of sessions kept in the in-process metadata cache. """
+    return int(os.getenv("SESSION_CACHE_SIZE", "10000"))
+
+def get_session_cache_ttl() -> float:
+    """ How long session metadata is served from the in-process cache, in seconds.
+    This bounds staleness if an invalidation message is missed. """
+    return float(os.getenv("SESSION_CACHE_TTL", "60"))
+
+class SessionCache:
+    """ A bounded LRU cache, with a TTL, of the small session fields (chef type and
+    thread_id) that are read on every request.  Workers keep their caches coherent by
+    publishing an invalidation on INVALIDATION_CHANNEL whenever they change a session. """
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, session_id: str) -> Optional[dict]:
+        """ Return the cached fields for the session, or None on a miss. """
+        entry = self.entries.get(session_id)
+        if entry is None or entry[0] < time.monotonic():
+            self.entries.pop(session_id, None)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(session_id)
+        self.hits += 1
+        return dict(entry[1])
+
+    def set(self, session_id: str, fields: dict):
+        """ Cache the fields for the session, evicting the least recently used entry.  The
+        fields are loaded together with a TTL refresh, so that counts as the last one. """
+        now = time.monotonic()
+        self.entries[session_id] = (now + self.ttl, dict(fields), now)
+        self.entries.move_to_end(session_id)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def refresh_due(self, session_id: str, interval: float) -> bool:
+        """ Whether the session's TTL in Redis was last refreshed over interval seconds
+        ago.  If so it is marked as refreshed now, so that only one request refreshes it. """
+        entry = self.entries.get(session_id)
+        now = time.monotonic()
+        if entry is None or now - entry[2] < interval:
+            return False
+        self.entries[session_id] = (entry[0], entry[1], now)
+        return True
+
+    def invalidate(self, session_id: str):
+        """ Drop the session from the cache. """
+        self.entries.pop(session_id, None)
+
+    def clear(self):
+        """ Drop every session, e.g. when invalidations may have been missed. """
+        self.entries.clear()
+
+    def snapshot(self) -> dict:
+        """ The size and hit rate of the cache for the metrics endpoint. """
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+session_cache = SessionCache(get_session_cache_size(), get_session_cache_ttl())
+metrics.register("session_cache", session_cache.snapshot)
+
+async def run_invalidation_listener():
+    """ Evict sessions from this worker's cache when another worker changes them.  If
+    the subscription drops, the whole cache is cleared since messages may be lost. """
+    while True:
+        pubsub = get_redis().pubsub()
+        try:
+            await pubsub.subscribe(INVALIDATION_CHANNEL)
+            async for message in pubsub.listen():
+                if message["type"] != "message":
+                    continue
+                worker_id, session_id = message["data"].decode().split(":", 1)
+                if worker_id != WORKER_ID:
+                    session_cache.invalidate(session_id)
+        except RedisError as e:
+            logger.error(f"Session invalidation listener failed: {e}")
+            session_cache.clear()
+            await asyncio.sleep(1)
+        finally:
+            await pubsub.aclose()
+
+def encode_message(message: dict) -> bytes:
+    """ Serialize a chat message, compressing it if it is over the threshold. """
+    encoded = json.dumps(message).encode("utf-8")
+    if len(encoded) > get_compression_threshold():
+        return COMPRESSED_PREFIX + zlib.compress(encoded)
+    return encoded
+
+def decode_message(stored: bytes) -> dict:
+    """ Deserialize a chat message stored by encode_message. """
+    if stored.startswith(COMPRESSED_PREFIX):
+        stored = zlib.decompress(stored[len(COMPRESSED_PREFIX):])
+    return json.loads(stored)
+
+async def sweep_sessions(batch_size: int = 500) -> dict:
+    """ SCAN the session keys and reclaim the ones that were written without a TTL.
+    Keys idle for longer than the session TTL are deleted; the rest are given the
+    remainder of their TTL.  Returns counts of what was found and reclaimed. """
+    redis = get_redis()
+    ttl = get_session_ttl()
+    report = {"scanned": 0, "without_ttl": 0, "expired": 0, "deleted": 0}
+    for field in SESSION_FIELDS:
+        async for keys in _scan_batches(redis, f"*:{field}", batch_size):
+            report["scanned"] += len(keys)
+            async with redis.pipeline(transaction=False) as pipe:
+                for key in keys:
+                    pipe.ttl(key)
+                ttls = await pipe.execute()
+            persistent = [key for key, key_ttl in zip(keys, ttls) if key_ttl == -1]
+            if not persistent:
+                continue
+            report["without_ttl"] += len(persistent)
+
+            async with redis.pipeline(transaction=False) as pipe:
+                for key in persistent:
+                    pipe.object("idletime", key)
+                idle_times = await pipe.execute(raise_on_error=False)
+            async with redis.pipeline(transaction=False) as pipe:
+                for key, idle in zip(persistent, idle_times):
+                    idle = idle if isinstance(idle, int) else 0
+                    if idle >= ttl:
+                        pipe.delete(key)
+                        report["deleted"] += 1
+                    else:
+                        pipe.expire(key, ttl - idle)
+                        report["expired"] += 1
+                await pipe.execute()
+
+    for name, count in report.items():
+        metrics.increment(f"session_sweeper.{name}", count)
+    logger.info(f"Session sweep finished: {report}")
+    return report
+
+async def _scan_batches(redis, match: str, batch_size: int):
+    """ Yield the keys matching the pattern in SCAN-sized batches. """
+    cursor = 0
+    while True:
+        cursor, keys = await redis.scan(cursor, match=match, count=batch_size)
+        if keys:
+            yield keys
+        if cursor == 0:
+            break
+
+async def run_session_sweeper():
+    """ Sweep the sessions every SESSION_SWEEP_INTERVAL seconds.  A Redis lock makes
+    sure only one worker sweeps per interval. """
+    interval = get_sweep_interval()
+    if interval <= 0:
+        return
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            if await get_redis().set(SWEEPER_LOCK, "1", nx=True, ex=interval):
+                await sweep_sessions()
+        except RedisError as e:
+            logger.error(f"Session sweep failed: {e}")
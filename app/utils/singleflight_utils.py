@@ -0,0 +1,202 @@
+""" Singleflight coalescing of identical concurrent calls.  While a call is in flight,
+identical calls in this worker await its result, and those in other workers wait on its
+Redis lock and read the result it publishes, instead of each making its own provider
+calls.  This covers the window before a result reaches the caches. """
+import asyncio
+import functools
+import hashlib
+import inspect
+import json
+import logging
+import os
+import time
+from typing import Awaitable, Callable, Dict, Optional, Type
+from pydantic import BaseModel
+from redis.exceptions import RedisError
+from app.middleware.session_middleware import get_redis
+from app.utils.cache_utils import normalize_text
+from app.utils.deadline_utils import deadline_timeout
+from app.utils.metrics_utils import metrics
+from app.utils.session_utils import WORKER_ID
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger("main")
+
+SINGLEFLIGHT_PREFIX = "singleflight"
+
+def get_singleflight_lock_ttl() -> int:
+    """ The expiry of a leader's lock, in seconds.  The leader renews it, so this only
+    bounds how long a crashed worker can hold up the others. """
+    return int(os.getenv("SINGLEFLIGHT_LOCK_TTL", "30"))
+
+def get_singleflight_result_ttl() -> int:
+    """ How long a leader's result is kept for the followers in other workers, in seconds. """
+    return int(os.getenv("SINGLEFLIGHT_RESULT_TTL", "5"))
+
+def get_singleflight_wait() -> float:
+    """ The longest a call waits on another worker's leader before making its own, in seconds. """
+    return float(os.getenv("SINGLEFLIGHT_WAIT", "120"))
+
+def singleflight_key(name: str, params: dict) -> str:
+    """ The key of a call, from its normalized arguments. """
+    normalized = {key: normalize_text(value) for key, value in sorted(params.items())}
+    digest = hashlib.sha256(json.dumps(normalized).encode("utf-8")).hexdigest()
+    return f"{SINGLEFLIGHT_PREFIX}:{name}:{digest}"
+
+class Flight:
+    """ A call in flight in this worker and the number of callers awaiting it. """
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+class SingleFlight:
+    """ The calls in flight in this worker, keyed by singleflight_key. """
+    def __init__(self):
+        self.flights: Dict[str, Flight] = {}
+
+    async def do(self, name: str, key: str, call: Callable[[], Awaitable],
+                 encode: Callable[[object], str], decode: Callable[[bytes], object],
+                 succeeded: Callable[[object], bool]):
+        """ Return the result of call, sharing it with the identical calls in flight.  Only
+        successful results are shared: a caller that joined a call which failed, or whose
+        result was not a success, makes its own call.  The call is cancelled once every
+        caller awaiting it has been cancelled. """
+        flight = self.flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = self.flights[key] = Flight(
+                asyncio.create_task(self._lead(name, key, call, encode, decode, succeeded))
+            )
+            flight.task.add_done_callback(lambda _: self._forget(key, flight))
+        else:
+            metrics.increment(f"singleflight.{name}.coalesced")
+        flight.waiters += 1
+        try:
+            result = await asyncio.shield(flight.task)
+        except Exception:
+            if leader:
+                raise
+        else:
+            if leader or succeeded(result):
+                return result
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                self._forget(key, flight)
+                flight.task.cancel()
+        metrics.increment(f"singleflight.{name}.retried")
+        return await call()
+
+    def _forget(self, key: str, flight: Flight):
+        if self.flights.get(key) is flight:
+            del self.flights[key]
+
+    async def _lead(self, name: str, key: str, call: Callable[[], Awaitable],
+                    encode: Callable[[object], str], decode: Callable[[bytes], object],
+                    succeeded: Callable[[object], bool]):
+        """ Make the call for this worker, unless another worker is already making it,
+        in which case wait for the result it publishes. """
+        redis = get_redis()
+        lock, result_key = f"{key}:lock", f"{key}:result"
+        ttl = get_singleflight_lock_ttl()
+        owned = False
+        started = time.monotonic()
+        wait = deadline_timeout(get_singleflight_wait())
+        delay = 0.1
+        while True:
+            try:
+                stored = await redis.get(result_key)
+                if stored is not None:
+                    metrics.increment(f"singleflight.{name}.remote")
+                    metrics.observe(f"singleflight.{name}.remote_wait", time.monotonic() - started)
+                    return decode(stored)
+                if await redis.set(lock, WORKER_ID, nx=True, ex=ttl):
+                    owned = True
+                    break
+            except RedisError as e:
+                logger.warning(f"Singleflight lock unavailable for {name}, calling locally: {e}")
+                break
+            if time.monotonic() - started + delay > wait:
+                logger.warning(f"Gave up waiting on another worker for {name}, calling locally")
+                break
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 1.0)
+
+        metrics.increment(f"singleflight.{name}.led")
+        renewal = asyncio.create_task(self._renew(lock, ttl)) if owned else None
+        try:
+            result = await call()
+            if owned and succeeded(result):
+                try:
+                    await redis.set(result_key, encode(result), ex=get_singleflight_result_ttl())
+                except RedisError as e:
+                    logger.error(f"Failed to publish the singleflight result for {name}: {e}")
+            return result
+        finally:
+            if renewal is not None:
+                renewal.cancel()
+            if owned:
+                try:
+                    if await redis.get(lock) == WORKER_ID.encode():
+                        await redis.delete(lock)
+                except RedisError:
+                    pass
+
+    async def _renew(self, lock: str, ttl: int):
+        """ Keep the lock while the call goes on. """
+        redis = get_redis()
+        while True:
+            await asyncio.sleep(ttl / 3)
+            try:
+                if await redis.get(lock) != WORKER_ID.encode():
+                    return
+                await redis.expire(lock, ttl)
+            except RedisError as e:
+                logger.error(f"Failed to renew the singleflight lock {lock}: {e}")
+
+    def snapshot(self) -> dict:
+        """ The calls in flight and their callers for the metrics endpoint. """
+        return {key: flight.waiters for key, flight in self.flights.items()}
+
+flights = SingleFlight()
+metrics.register("singleflight", flights.snapshot)
+
+def singleflight(name: str, result_model: Optional[Type[BaseModel]] = None,
+                 normalize: Optional[Callable[[dict], dict]] = None,
+                 succeeded: Callable[[object], bool] = lambda result: result is not None):
+    """ Coalesce identical concurrent calls of an async function.
+
+    Calls are identical when their normalized arguments match; normalize may rewrite
+    the arguments (e.g. map serving sizes) first.  Results are passed between workers
+    as JSON and, if result_model is given, rebuilt into that model.  Only results that
+    succeeded (by default, any but None) are shared, so that one failure is not handed
+    to every caller.  Callers can pass fresh=True to make their own call; it is passed
+    on, e.g. to a cached_recipe function beneath. """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        def encode(result) -> str:
+            if isinstance(result, BaseModel):
+                return result.model_dump_json()
+            return json.dumps(result)
+
+        def decode(stored: bytes):
+            result = json.loads(stored)
+            if result_model is not None and isinstance(result, dict):
+                return result_model(**result)
+            return result
+
+        @functools.wraps(func)
+        async def wrapper(*args, fresh: bool = False, **kwargs):
+            if fresh:
+                return await func(*args, fresh=True, **kwargs)
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            params = dict(bound.arguments)
+            if normalize:
+                params = normalize(params)
+            key = singleflight_key(name, params)
+            return await flights.do(name, key, lambda: func(*args, **kwargs), encode, decode, succeeded)
+
+        return wrapper
+    return decorator
@@ -0,0 +1,180 @@
+""" Helpers for the streaming (server-sent event) endpoints """
+import json
+from typing import Any, List, Optional, Tuple
+
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "Connection": "keep-alive",
+    # Stop proxies such as nginx from buffering the event stream
+    "X-Accel-Buffering": "no",
+}
+
+def format_sse(event: str, data: Any) -> str:
+    """ Format an event and its JSON encoded data as a server-sent event. """
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+# Sentinel for a value that has not been fully received
+_INCOMPLETE = object()
+
+class IncrementalJSONParser:
+    """ A tolerant, incremental parser for a JSON object that arrives in chunks,
+    such as a streamed LLM completion.  Text before the opening brace is skipped and
+    each top-level field is reported as soon as its value is complete.  Array values
+    are also reported item by item so that e.g. ingredients can be rendered while
+    the directions are still being generated.
+
+    feed() returns a list of (kind, key, value) events where kind is "item" for a
+    completed array item and "field" for a completed top-level value. """
+    def __init__(self):
+        self.buffer = ""
+        self.pos = 0
+        self.state = "start"
+        self.key = None
+        self.items = []
+        self.result = {}
+
+    def feed(self, chunk: str) -> List[Tuple[str, str, Any]]:
+        """ Add a chunk of text and return the events it completes. """
+        self.buffer += chunk
+        events = []
+        while True:
+            event = self._step()
+            if event is False:
+                break
+            if event:
+                events.append(event)
+        # Drop the consumed text so the buffer only holds the incomplete tail
+        self.buffer = self.buffer[self.pos:]
+        self.pos = 0
+        return events
+
+    @property
+    def done(self) -> bool:
+        """ Whether the closing brace of the object has been seen. """
+        return self.state == "done"
+
+    def _skip(self, chars: str) -> bool:
+        """ Skip over the given characters, returning False if the buffer runs out. """
+        while self.pos < len(self.buffer) and (self.buffer[self.pos] in chars or self.buffer[self.pos].isspace()):
+            self.pos += 1
+        return self.pos < len(self.buffer)
+
+    def _scan_value(self) -> Optional[int]:
+        """ Return the end index of the JSON value starting at pos, or None if incomplete. """
+        buffer = self.buffer
+        start = self.pos
+        if buffer[start] == '"':
+            i = start + 1
+            while i < len(buffer):
+                if buffer[i] == "\\":
+                    i += 2
+                    continue
+                if buffer[i] == '"':
+                    return i + 1
+                i += 1
+            return None
+        if buffer[start] in "{[":
+            depth = 0
+            in_string = False
+            i = start
+            while i < len(buffer):
+                char = buffer[i]
+                if in_string:
+                    if char == "\\":
+                        i += 1
+                    elif char == '"':
+                        in_string = False
+                elif char == '"':
+                    in_string = True
+                elif char in "{[":
+                    depth += 1
+                elif char in "}]":
+                    depth -= 1
+                    if depth == 0:
+                        return i + 1
+                i += 1
+            return None
+        # Numbers and literals end at the next delimiter
+        i = start
+        while i < len(buffer) and buffer[i] not in ",}]" and not buffer[i].isspace():
+            i += 1
+        return i if i < len(buffer) else None
+
+    def _read_value(self) -> Any:
+        """ Decode the value starting at pos and advance past it, or return
+        _INCOMPLETE if it has not been fully received yet. """
+        end = self._scan_value()
+        if end is None:
+            return _INCOMPLETE
+        text = self.buffer[self.pos:end]
+        self.pos = end
+        try:
+            # strict=False lets raw newlines through inside strings
+            return json.loads(text, strict=False)
+        except json.JSONDecodeError:
+            return text.strip().strip('"')
+
+    def _step(self):
+        """ Consume the next token.  Returns an event, None if a token was consumed
+        without an event, or False if more text is needed. """
+        if self.state == "start":
+            index = self.buffer.find("{", self.pos)
+            if index == -1:
+                self.pos = len(self.buffer)
+                return False
+            self.pos = index + 1
+            self.state = "key"
+            return None
+
+        if self.state == "done" or not self._skip(","):
+            return False
+
+        char = self.buffer[self.pos]
+        if self.state == "key":
+            if char == "}":
+                self.pos += 1
+                self.state = "done"
+                return None
+            if char != '"':
+                # Tolerate stray characters between fields
+                self.pos += 1
+                return None
+            key = self._read_value()
+            if key is _INCOMPLETE:
+                return False
+            self.key = str(key)
+            self.state = "colon"
+            return None
+
+        if self.state == "colon":
+            self.pos += 1
+            if char == ":":
+                self.state = "value"
+            return None
+
+        if self.state == "value":
+            if char == "[":
+                self.pos += 1
+                self.items = []
+                self.state = "array"
+                return None
+            value = self._read_value()
+            if value is _INCOMPLETE:
+                return False
+            self.result[self.key] = value
+            self.state = "key"
+            return ("field", self.key, value)
+
+        if self.state == "array":
+            if char == "]":
+                self.pos += 1
+                self.result[self.key] = self.items
+                self.state = "key"
+                return ("field", self.key, self.items)
+            value = self._read_value()
+            if value is _INCOMPLETE:
+                return False
+            self.items.append(value)
+            return ("item", self.key, value)
+
+        return False
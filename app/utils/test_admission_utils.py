@@ -0,0 +1,54 @@
+""" Tests for the admission scheduler """
+import asyncio
+import os
+import unittest
+from unittest import mock
+from app.utils.admission_utils import AdmissionRejected, AdmissionScheduler
+
+class TestAdmissionUtils(unittest.TestCase):
+    """ Tests for admitting requests by priority within the concurrency limits. """
+    def test_chat_is_admitted_before_images(self):
+        """ A freed provider slot goes to the queued chat ahead of an earlier image request. """
+        async def run():
+            scheduler = AdmissionScheduler()
+            order = []
+
+            async def request(path):
+                pools = await scheduler.acquire(path)
+                order.append(path)
+                return pools
+
+            held = await scheduler.acquire("/generate-image")
+            image = asyncio.create_task(request("/generate-image"))
+            await asyncio.sleep(0)
+            chat = asyncio.create_task(request("/get_chef_response"))
+            await asyncio.sleep(0)
+            self.assertEqual(order, [])
+            scheduler.release(held)
+            scheduler.release(await chat)
+            scheduler.release(await image)
+            return order
+
+        with mock.patch.dict(os.environ, {"ADMISSION_LIMIT_PROVIDER_OPENAI": "1"}):
+            self.assertEqual(asyncio.run(run()), ["/get_chef_response", "/generate-image"])
+
+    def test_full_queue_is_rejected(self):
+        """ Once the queue is full, new requests are turned away with a Retry-After. """
+        async def run():
+            scheduler = AdmissionScheduler()
+            held = await scheduler.acquire("/upload-files")
+            queued = asyncio.create_task(scheduler.acquire("/upload-files"))
+            await asyncio.sleep(0)
+            with self.assertRaises(AdmissionRejected) as context:
+                await scheduler.acquire("/upload-files")
+            self.assertEqual(context.exception.retry_after, 5)
+            scheduler.release(held)
+            scheduler.release(await queued)
+            self.assertIsNone(await scheduler.acquire("/metrics"))
+
+        env = {"ADMISSION_LIMIT_ENDPOINT_UPLOAD_FILES": "1", "ADMISSION_QUEUE_SIZE": "1"}
+        with mock.patch.dict(os.environ, env):
+            asyncio.run(run())
+
+if __name__ == "__main__":
+    unittest.main()
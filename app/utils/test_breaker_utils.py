@@ -0,0 +1,118 @@
+""" Tests for the circuit breakers """
+import asyncio
+import os
+import unittest
+from contextlib import aclosing
+from unittest import mock
+from app.utils import breaker_utils
+from app.utils.breaker_utils import CLOSED, HALF_OPEN, OPEN, BreakerRegistry, CircuitOpenError
+from app.utils.ratelimit_utils import RateLimitTimeout
+
+settings = {
+    "BREAKER_MIN_REQUESTS": "4", "BREAKER_ERROR_RATE": "0.5", "BREAKER_COOLDOWN": "30",
+    "BREAKER_MAX_COOLDOWN": "100",
+}
+
+class TestBreakerUtils(unittest.TestCase):
+    """ Tests for opening, probing and closing a model's circuit. """
+    def setUp(self):
+        patcher = mock.patch.dict(os.environ, settings)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.now = 1000.0
+
+    def freeze_clock(self):
+        """ Drive the breakers' clock from self.now. """
+        clock = mock.patch.object(breaker_utils.time, "monotonic", side_effect=lambda: self.now)
+        clock.start()
+        self.addCleanup(clock.stop)
+
+    def test_opens_at_the_error_threshold(self):
+        """ The circuit stays closed below the threshold and opens once it is reached. """
+        self.freeze_clock()
+        breaker = breaker_utils.CircuitBreaker("anthropic", "claude")
+        breaker.record(True, 1)
+        breaker.record(True, 1)
+        breaker.record(False, 1)
+        self.assertEqual(breaker.state, CLOSED)
+        breaker.record(False, 1)
+        self.assertEqual(breaker.state, OPEN)
+        with self.assertRaises(CircuitOpenError):
+            breaker.begin()
+
+    def test_half_open_probe_and_cooldown_growth(self):
+        """ After the cooldown one probe is let through; failure doubles the cooldown up to
+        the maximum and success closes the circuit. """
+        self.freeze_clock()
+        breaker = breaker_utils.CircuitBreaker("anthropic", "claude")
+        for _ in range(4):
+            breaker.record(False, 1)
+        self.now += 31
+        breaker.begin()
+        self.assertEqual(breaker.state, HALF_OPEN)
+        self.assertFalse(breaker.is_available())
+        breaker.record(False, 1)
+        self.assertEqual((breaker.state, breaker.cooldown), (OPEN, 60))
+
+        self.now += 61
+        breaker.begin()
+        breaker.record(False, 1)
+        self.assertEqual(breaker.cooldown, 100)
+
+        self.now += 101
+        breaker.begin()
+        breaker.record(True, 1)
+        self.assertEqual((breaker.state, breaker.cooldown), (CLOSED, 30))
+
+    def test_own_throttling_is_not_a_failure(self):
+        """ Rate-limit timeouts and cancellation are not recorded against the model. """
+        registry = BreakerRegistry()
+
+        async def throttled():
+            raise RateLimitTimeout("needs a 40s wait")
+
+        for _ in range(4):
+            with self.assertRaises(RateLimitTimeout):
+                asyncio.run(registry.call("anthropic", "claude", throttled))
+        breaker = registry.get("anthropic", "claude")
+        self.assertEqual((breaker.state, len(breaker.calls)), (CLOSED, 0))
+
+    def test_streams_count_only_the_provider(self):
+        """ A stream's latency leaves out the consumer's time between chunks, a consumer
+        stopping early gives no verdict, and a provider error mid-stream is a failure. """
+        registry = BreakerRegistry()
+        closed = []
+
+        async def chunks(fail: bool = False):
+            try:
+                for chunk in ["a", "b"]:
+                    await asyncio.sleep(0.01)
+                    yield chunk
+                if fail:
+                    raise ConnectionError("stream dropped")
+            finally:
+                closed.append(True)
+
+        async def consume(stream, stop_early: bool = False):
+            async with aclosing(stream) as texts:
+                async for _ in texts:
+                    if stop_early:
+                        return
+                    await asyncio.sleep(0.2)
+
+        breaker = registry.get("anthropic", "claude")
+        asyncio.run(consume(registry.track_stream("anthropic", "claude", chunks())))
+        (_, succeeded, latency), = breaker.calls
+        self.assertTrue(succeeded)
+        self.assertLess(latency, 0.2)
+
+        asyncio.run(consume(registry.track_stream("anthropic", "claude", chunks()), stop_early=True))
+        self.assertEqual(len(breaker.calls), 1)
+
+        with self.assertRaises(ConnectionError):
+            asyncio.run(consume(registry.track_stream("anthropic", "claude", chunks(fail=True))))
+        self.assertEqual([call[1] for call in breaker.calls], [True, False])
+        self.assertEqual(closed, [True] * 3)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+""" Tests for the recipe cache """
+import asyncio
+import os
+import unittest
+from unittest import mock
+from app.utils import cache_utils
+
+def make_redis(pipeline_results: list) -> mock.MagicMock:
+    """ A Redis client whose pipeline returns pipeline_results. """
+    pipe = mock.MagicMock()
+    pipe.execute = mock.AsyncMock(return_value=pipeline_results)
+    redis = mock.MagicMock()
+    redis.pipeline.return_value.__aenter__.return_value = pipe
+    redis.zpopmin = mock.AsyncMock(return_value=[(b"recipe_cache:old", 1.0)])
+    redis.delete = mock.AsyncMock()
+    redis.hincrby = mock.AsyncMock()
+    redis.hgetall = mock.AsyncMock(return_value={
+        b"claude_recipe:lookups": b"5", b"claude_recipe:misses": b"2"
+    })
+    redis.zcard = mock.AsyncMock(return_value=3)
+    return redis
+
+class TestCacheUtils(unittest.TestCase):
+    """ Tests for caching recipes by normalized request. """
+    def test_keys_are_normalized(self):
+        """ Requests differing in case, spacing or punctuation share a key; prompt versions do not. """
+        key = cache_utils.recipe_cache_key("claude_recipe", "claude", "1", {"specifications": "Apple Pie!"})
+        same = cache_utils.recipe_cache_key("claude_recipe", "claude", "1", {"specifications": "  apple   pie"})
+        bumped = cache_utils.recipe_cache_key("claude_recipe", "claude", "2", {"specifications": "apple pie"})
+        self.assertEqual(key, same)
+        self.assertNotEqual(key, bumped)
+
+    def test_whole_recipes_keep_their_punctuation(self):
+        """ Recipe texts differing only in punctuation, e.g. their quantities, do not collide. """
+        def key(recipe_text: str) -> str:
+            return cache_utils.recipe_cache_key(
+                "format_recipe", "gpt", "1", {"recipe_text": recipe_text}, cache_utils.collapse_whitespace
+            )
+
+        self.assertNotEqual(key("1/2 cup flour"), key("1-2 cup flour"))
+        self.assertNotEqual(key("Bake at 350°F"), key("Bake at 350 F"))
+        self.assertEqual(key("1/2 cup\n flour"), key("1/2 cup flour"))
+
+    def test_hits_are_served_and_fresh_bypasses(self):
+        """ A hit skips the function, and fresh=True neither reads nor writes the cache. """
+        calls = []
+
+        @cache_utils.cached_recipe("recipe", model="gpt", prompt_version="1")
+        async def recipe(specifications: str):
+            calls.append(specifications)
+            return "generated"
+
+        get_cached = mock.AsyncMock(return_value="cached")
+        set_cached = mock.AsyncMock()
+        with mock.patch.object(cache_utils, "get_cached_recipe", get_cached), \
+                mock.patch.object(cache_utils, "set_cached_recipe", set_cached):
+            self.assertEqual(asyncio.run(recipe("pie")), "cached")
+            self.assertEqual(calls, [])
+            get_cached.reset_mock()
+            self.assertEqual(asyncio.run(recipe("pie", fresh=True)), "generated")
+        self.assertEqual(calls, ["pie"])
+        get_cached.assert_not_called()
+        set_cached.assert_not_called()
+
+    def test_oldest_entries_are_evicted_over_the_cap(self):
+        """ Writing past RECIPE_CACHE_MAX_ENTRIES evicts the oldest recipes. """
+        redis = make_redis([True, 1, 0, 3])
+        with mock.patch.dict(os.environ, {"RECIPE_CACHE_MAX_ENTRIES": "2"}), \
+                mock.patch.object(cache_utils, "get_redis", return_value=redis):
+            asyncio.run(cache_utils.set_cached_recipe("recipe", "recipe_cache:new", "{}"))
+        redis.zpopmin.assert_awaited_once_with(cache_utils.RECIPE_CACHE_INDEX, 1)
+        redis.delete.assert_awaited_once_with(b"recipe_cache:old")
+
+    def test_stats_count_hits(self):
+        """ Hits are the lookups that were not misses. """
+        redis = make_redis([])
+        with mock.patch.object(cache_utils, "get_redis", return_value=redis):
+            stats = asyncio.run(cache_utils.get_recipe_cache_stats())
+        self.assertEqual(stats, {"size": 3, "functions": {"claude_recipe": {"lookups": 5, "misses": 2, "hits": 3}}})
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+""" Tests for the chat context windows """
+import asyncio
+import json
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+from app.utils import context_utils
+from app.utils.context_utils import count_message_tokens, split_context_window
+from app.utils.deadline_utils import request_deadline, start_deadline, with_deadline
+
+class TestContextUtils(unittest.TestCase):
+    """ Tests for splitting the chat history into the window and the older turns. """
+    def test_window_keeps_most_recent_messages(self):
+        """ The newest messages that fit in the budget are kept, in order. """
+        messages = [{"role": "user", "content": f"Message {i} " * 10} for i in range(10)]
+        budget = sum(count_message_tokens(message) for message in messages[-3:])
+        older, recent = split_context_window(messages, budget)
+        self.assertEqual(recent, messages[-3:])
+        self.assertEqual(older, messages[:-3])
+
+    def test_latest_message_is_always_kept(self):
+        """ A message larger than the whole budget is still sent. """
+        messages = [{"role": "user", "content": "Hi"}, {"role": "user", "content": "x" * 1000}]
+        older, recent = split_context_window(messages, 10)
+        self.assertEqual(recent, messages[-1:])
+        self.assertEqual(older, messages[:1])
+
+    def test_compaction_outlives_the_deadline(self):
+        """ Older turns are summarized after the request, even once its deadline has passed,
+        and the summary lock is released. """
+        messages = [{"role": "user", "content": f"Message {i} " * 100} for i in range(10)]
+        redis = mock.AsyncMock()
+        redis.set.return_value = True
+        chat_service = SimpleNamespace(
+            store=SimpleNamespace(redis=redis), session_id="session",
+            session_key=lambda field: f"session:{field}",
+            load_chat_history=mock.AsyncMock(return_value=messages),
+            load_summary=mock.AsyncMock(return_value=(None, 0)),
+        )
+        client = mock.MagicMock(timeout=600, max_retries=2)
+        client.with_options.return_value = client
+        client.chat.completions.create = mock.AsyncMock(
+            return_value=SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content="A summary"))])
+        )
+
+        async def compact_after_deadline():
+            token = start_deadline(-0.001)
+            try:
+                await context_utils.get_context_window(chat_service, budget=100)
+            finally:
+                request_deadline.reset(token)
+            await asyncio.gather(*context_utils.summary_tasks)
+
+        with mock.patch.object(context_utils, "get_openai_client", side_effect=lambda: with_deadline(client)):
+            asyncio.run(compact_after_deadline())
+        key, value = redis.set.await_args_list[-1].args
+        self.assertEqual((key, json.loads(value)["summary"]), ("session:summary", "A summary"))
+        redis.delete.assert_awaited_once_with("session:summary_lock")
+
+if __name__ == "__main__":
+    unittest.main()
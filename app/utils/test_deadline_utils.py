@@ -0,0 +1,37 @@
+""" Tests for the request deadlines """
+import os
+import unittest
+from unittest import mock
+from app.utils.deadline_utils import (
+    DeadlineExceeded, deadline_retries, deadline_timeout, get_endpoint_deadline, request_deadline, start_deadline
+)
+
+class TestDeadlineUtils(unittest.TestCase):
+    """ Tests for fitting calls into the request deadline. """
+    def test_endpoint_budgets(self):
+        """ Endpoints have their own budget, which the environment can override. """
+        self.assertEqual(get_endpoint_deadline("/generate-image"), 90)
+        with mock.patch.dict(os.environ, {"REQUEST_DEADLINE_GET_CHEF_RESPONSE_STREAM": "5"}):
+            self.assertEqual(get_endpoint_deadline("/get_chef_response/stream"), 5)
+
+    def test_calls_fit_in_the_time_left(self):
+        """ Timeouts are capped by the time left and retries dropped near the end. """
+        self.assertEqual(deadline_timeout(55), 55)
+        token = start_deadline(5)
+        try:
+            self.assertLessEqual(deadline_timeout(55), 5)
+            self.assertEqual(deadline_retries(3), 0)
+        finally:
+            request_deadline.reset(token)
+
+    def test_exhausted_deadline_fails_fast(self):
+        """ Once the budget is used up, calls raise instead of starting. """
+        token = start_deadline(-1)
+        try:
+            with self.assertRaises(DeadlineExceeded):
+                deadline_timeout(55)
+        finally:
+            request_deadline.reset(token)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,45 @@
+""" Tests for cancelling work when the client disconnects """
+import asyncio
+import unittest
+from fastapi import HTTPException, Request
+from app.utils.disconnect_utils import cancel_on_disconnect
+
+def make_request(disconnect_after: float) -> Request:
+    """ A request whose client disconnects after the given number of seconds. """
+    async def receive():
+        await asyncio.sleep(disconnect_after)
+        return {"type": "http.disconnect"}
+    return Request({"type": "http", "method": "POST", "path": "/", "headers": []}, receive)
+
+class TestDisconnectUtils(unittest.TestCase):
+    """ Tests for cancel_on_disconnect. """
+    def test_result_is_returned_while_connected(self):
+        """ Work that finishes before the client leaves returns its result. """
+        async def work():
+            await asyncio.sleep(0.01)
+            return "recipe"
+        result = asyncio.run(cancel_on_disconnect(make_request(1), work()))
+        self.assertEqual(result, "recipe")
+
+    def test_work_is_cancelled_on_disconnect(self):
+        """ Work still running when the client leaves is cancelled. """
+        cancelled = []
+
+        async def work():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+
+        async def run():
+            with self.assertRaises(HTTPException) as context:
+                await cancel_on_disconnect(make_request(0.01), work())
+            self.assertEqual(context.exception.status_code, 499)
+            await asyncio.sleep(0)
+
+        asyncio.run(run())
+        self.assertEqual(cancelled, [True])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,41 @@
+""" Tests for the local food query classifier """
+import unittest
+from app.utils.filter_utils import classify_food_query
+
+class TestFilterUtils(unittest.TestCase):
+    """ Tests for deciding only the clear cases of the food filter locally. """
+    def test_clear_recipe_requests_are_accepted(self):
+        """ Ingredients or dishes with other culinary words are accepted without the LLM. """
+        for query in [
+            "chocolate chip cookies with brown butter",
+            "bake a lemon cake for four",
+            "a quick weeknight chicken curry recipe",
+            "vegan lasagna with spinach",
+        ]:
+            with self.subTest(query=query):
+                self.assertTrue(classify_food_query(query))
+
+    def test_spam_is_rejected(self):
+        """ Spam with nothing culinary in it is rejected without the LLM. """
+        for query in ["buy now, use promo code SAVE50", "make money with crypto at www.example.com"]:
+            with self.subTest(query=query):
+                self.assertIs(classify_food_query(query), False)
+
+    def test_ambiguous_text_goes_to_the_llm(self):
+        """ Generic words, single hits and spam mixed with food are left to the LLM. """
+        for query in [
+            "write an essay about chinese history",
+            "tell me a joke for kids",
+            "stock market tips",
+            "best course on machine learning",
+            "apple stock price",
+            "something for a birthday party",
+            "chicken",
+            "buy now cheap chocolate cake",
+            "",
+        ]:
+            with self.subTest(query=query):
+                self.assertIsNone(classify_food_query(query))
+
+if __name__ == "__main__":
+    unittest.main()
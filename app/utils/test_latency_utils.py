@@ -0,0 +1,93 @@
+""" Tests for hedged requests """
+import asyncio
+import unittest
+from app.utils.latency_utils import LatencyWindow, run_hedged
+
+def valid(result):
+    """ Accept any non-empty result. """
+    return result or None
+
+class TestLatencyUtils(unittest.TestCase):
+    """ Tests for hedging a slow primary request. """
+    def test_percentiles(self):
+        """ Percentiles are read from the window of samples. """
+        window = LatencyWindow()
+        for latency in [1, 2, 3, 4]:
+            window.record(latency)
+        self.assertEqual(window.percentile(0.5), 2)
+        self.assertEqual(window.percentile(1), 4)
+
+    def test_fast_primary_is_not_hedged(self):
+        """ A primary that answers within the delay never starts the hedge. """
+        started = []
+
+        async def primary():
+            return "claude"
+
+        async def hedge():
+            started.append("hedge")
+            return "openai"
+
+        result = asyncio.run(run_hedged(primary, hedge, delay=0.05, validate=valid))
+        self.assertEqual(result, "claude")
+        self.assertEqual(started, [])
+
+    def test_slow_primary_is_hedged_after_the_delay_and_cancelled(self):
+        """ The hedge starts only once the delay has passed, and the loser is cancelled. """
+        events = []
+
+        async def run():
+            loop = asyncio.get_running_loop()
+            began = loop.time()
+
+            async def primary():
+                try:
+                    await asyncio.sleep(10)
+                except asyncio.CancelledError:
+                    events.append("primary cancelled")
+                    raise
+
+            async def hedge():
+                events.append(("hedge", loop.time() - began >= 0.05))
+                return "openai"
+
+            result = await run_hedged(primary, hedge, delay=0.05, validate=valid)
+            await asyncio.sleep(0)
+            return result
+
+        self.assertEqual(asyncio.run(run()), "openai")
+        self.assertEqual(events, [("hedge", True), "primary cancelled"])
+
+    def test_early_primary_failure_hedges_at_once(self):
+        """ A primary that fails before the delay starts the hedge straight away. """
+        async def run():
+            loop = asyncio.get_running_loop()
+            began = loop.time()
+
+            async def primary():
+                raise RuntimeError("overloaded")
+
+            async def hedge():
+                return loop.time() - began
+
+            return await run_hedged(primary, hedge, delay=5, validate=lambda elapsed: elapsed)
+
+        self.assertLess(asyncio.run(run()), 1)
+
+    def test_non_retryable_errors_are_raised(self):
+        """ Errors in reraise, e.g. a non-food query, are raised instead of hedged. """
+        started = []
+
+        async def primary():
+            raise ValueError("Query is not related to food.")
+
+        async def hedge():
+            started.append("hedge")
+            return "openai"
+
+        with self.assertRaises(ValueError):
+            asyncio.run(run_hedged(primary, hedge, delay=5, validate=valid, reraise=(ValueError,)))
+        self.assertEqual(started, [])
+
+if __name__ == "__main__":
+    unittest.main()
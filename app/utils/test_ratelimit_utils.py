@@ -0,0 +1,40 @@
+""" Tests for the provider rate limiters """
+import asyncio
+import time
+import unittest
+import httpx
+from app.utils.ratelimit_utils import RateLimiter, RateLimitTimeout, RateLimiterRegistry, parse_reset
+
+class TestRateLimitUtils(unittest.TestCase):
+    """ Tests for the rate limiter budgets and waits. """
+    def test_parse_reset(self):
+        """ Both providers' reset formats are parsed into seconds. """
+        self.assertAlmostEqual(parse_reset("6m0s"), 360)
+        self.assertAlmostEqual(parse_reset("20ms"), 0.02)
+        self.assertIsNone(parse_reset("soon"))
+
+    def test_budget_from_headers(self):
+        """ An exhausted budget makes callers wait for the refill instead of failing. """
+        limiter = RateLimiter("anthropic", "claude")
+        limiter.update(httpx.Headers({
+            "anthropic-ratelimit-requests-limit": "60",
+            "anthropic-ratelimit-requests-remaining": "0",
+        }))
+        # 60 requests a minute refills one request a second
+        self.assertAlmostEqual(limiter.wait_time(0), 1, places=1)
+        with self.assertRaises(RateLimitTimeout):
+            asyncio.run(limiter.acquire(max_wait=0.5))
+
+    def test_retry_after_blocks_queue(self):
+        """ A 429 seen by the HTTP client holds back the next call for its retry-after. """
+        registry = RateLimiterRegistry()
+        request = httpx.Request("POST", "https://api.openai.com/v1/chat/completions", json={"model": "gpt-4"})
+        response = httpx.Response(429, headers={"retry-after-ms": "200"}, request=request)
+        asyncio.run(registry.observe_response(response))
+
+        started = time.monotonic()
+        asyncio.run(registry.acquire("openai", "gpt-4"))
+        self.assertGreaterEqual(time.monotonic() - started, 0.15)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,175 @@
+""" Tests for the shared run tracker """
+import asyncio
+import json
+import os
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+from app.utils import run_utils
+from app.utils.deadline_utils import request_deadline, start_deadline, with_deadline
+from app.utils.session_utils import WORKER_ID
+
+class FakeRedis:
+    """ The string commands and WATCH/MULTI transactions that ThreadRunLock uses, in memory. """
+    def __init__(self):
+        self.values = {}
+        self.expires = []
+
+    async def set(self, key, value, nx=False, ex=None, keepttl=False):
+        if nx and key in self.values:
+            return None
+        self.values[key] = value.encode()
+        return True
+
+    async def get(self, key):
+        return self.values.get(key)
+
+    async def expire(self, key, ttl):
+        self.expires.append(key)
+        return key in self.values
+
+    async def delete(self, key):
+        return self.values.pop(key, None) is not None
+
+    def pipeline(self):
+        return FakeTransaction(self)
+
+class FakeTransaction:
+    """ A transaction on FakeRedis; nothing else runs between WATCH and EXEC in these tests. """
+    def __init__(self, redis: FakeRedis):
+        self.redis = redis
+        self.queued = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def watch(self, key):
+        pass
+
+    async def get(self, key):
+        return await self.redis.get(key)
+
+    def multi(self):
+        pass
+
+    def __getattr__(self, command):
+        return lambda *args, **kwargs: self.queued.append(getattr(self.redis, command)(*args, **kwargs))
+
+    async def execute(self):
+        return [await command for command in self.queued]
+
+class TestRunUtils(unittest.TestCase):
+    """ Tests for polling a run once for every waiter. """
+    def test_poll_delay_backs_off(self):
+        """ The delay between checks doubles up to the maximum. """
+        with mock.patch.dict(os.environ, {"RUN_POLL_MAX_DELAY": "4"}):
+            self.assertEqual(run_utils.next_poll_delay(0.25), 0.5)
+            self.assertEqual(run_utils.next_poll_delay(3), 4)
+
+    def test_waiters_share_one_poller(self):
+        """ Concurrent waiters on a run are answered by a single poll per status. """
+        statuses = iter(["in_progress", "completed"])
+
+        async def retrieve(thread_id, run_id):
+            return SimpleNamespace(id=run_id, status=next(statuses))
+
+        redis = mock.AsyncMock()
+        redis.set.return_value = True
+        redis.get.return_value = WORKER_ID.encode()
+
+        async def wait_twice():
+            tracker = run_utils.RunTracker()
+            run = SimpleNamespace(id="run_1", status="queued")
+            return await asyncio.gather(
+                tracker.wait("thread_1", "run_1", run=run),
+                tracker.wait("thread_1", "run_1"),
+            )
+
+        with mock.patch.dict(os.environ, {"RUN_POLL_INITIAL_DELAY": "0.01"}), \
+                mock.patch.object(run_utils, "get_redis", return_value=redis), \
+                mock.patch.object(run_utils, "retrieve_run_status", side_effect=retrieve) as retrieve_mock:
+            first, second = asyncio.run(wait_twice())
+        self.assertEqual(first.status, "completed")
+        self.assertIs(first, second)
+        self.assertEqual(retrieve_mock.call_count, 2)
+
+    def test_cancel_outlives_the_deadline(self):
+        """ An abandoned run is cancelled even when its request ran out of time. """
+        client = mock.MagicMock(timeout=600, max_retries=2)
+        client.with_options.return_value = client
+        client.beta.threads.runs.cancel = mock.AsyncMock()
+
+        async def cancel_after_deadline():
+            token = start_deadline(-0.001)
+            try:
+                run_utils.cancel_run("thread_1", "run_1")
+            finally:
+                request_deadline.reset(token)
+            await asyncio.gather(*run_utils.cancel_tasks)
+
+        with mock.patch.object(run_utils, "get_openai_client", side_effect=lambda: with_deadline(client)):
+            asyncio.run(cancel_after_deadline())
+        client.beta.threads.runs.cancel.assert_awaited_once_with(thread_id="thread_1", run_id="run_1")
+
+class TestThreadRunLock(unittest.TestCase):
+    """ Tests for making runs on a thread one at a time. """
+    def run_with_redis(self, coroutine, env=None):
+        """ Run the coroutine against a fresh FakeRedis and return it. """
+        redis = FakeRedis()
+        with mock.patch.dict(os.environ, env or {}), mock.patch.object(run_utils, "get_redis", return_value=redis):
+            asyncio.run(coroutine(redis))
+        return redis
+
+    def test_busy_thread_queues_then_is_rejected(self):
+        """ A second request waits for the thread and gets ThreadBusyError if it is not freed. """
+        async def contend(redis):
+            first = await run_utils.ThreadRunLock("thread_1", "a").acquire()
+            with self.assertRaises(run_utils.ThreadBusyError):
+                await run_utils.ThreadRunLock("thread_1", "b").acquire()
+            await first.release()
+            second = await run_utils.ThreadRunLock("thread_1", "b").acquire()
+            self.assertEqual(json.loads(redis.values["thread_run:thread_1"])["token"], second.token)
+            await second.release()
+            self.assertEqual(redis.values, {})
+
+        self.run_with_redis(contend, {"RUN_QUEUE_TIMEOUT": "0.2"})
+
+    def test_repeated_request_shares_the_run(self):
+        """ A double submit of the request being answered is given its run instead of queueing. """
+        async def repeat(redis):
+            first = await run_utils.ThreadRunLock("thread_1", "a").acquire()
+            await first.set_run("run_1")
+            repeated = await run_utils.ThreadRunLock("thread_1", "a").acquire()
+            self.assertEqual(repeated.coalesced_run_id, "run_1")
+            await first.release()
+
+        self.run_with_redis(repeat)
+
+    def test_lock_is_renewed_while_held(self):
+        """ The holder keeps extending the lock until it releases it. """
+        async def hold(redis):
+            lock = await run_utils.ThreadRunLock("thread_1", "a").acquire()
+            await asyncio.sleep(0.5)
+            await lock.release()
+
+        redis = self.run_with_redis(hold, {"THREAD_LOCK_TTL": "1"})
+        self.assertIn("thread_run:thread_1", redis.expires)
+
+    def test_release_only_frees_its_own_lock(self):
+        """ A holder whose lock lapsed and was taken over does not free the new holder's lock. """
+        async def lapse(redis):
+            first = await run_utils.ThreadRunLock("thread_1", "a").acquire()
+            first.stop_renewal()
+            del redis.values["thread_run:thread_1"]
+            second = await run_utils.ThreadRunLock("thread_1", "b").acquire()
+            await first.release()
+            self.assertEqual(json.loads(redis.values["thread_run:thread_1"])["token"], second.token)
+            await second.release()
+
+        self.run_with_redis(lapse)
+
+if __name__ == "__main__":
+    unittest.main()
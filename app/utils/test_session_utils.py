@@ -0,0 +1,44 @@
+""" Tests for the session key helpers """
+import unittest
+from app.utils.session_utils import COMPRESSED_PREFIX, SessionCache, decode_message, encode_message
+
+class TestSessionUtils(unittest.TestCase):
+    """ Tests for the chat message encoding. """
+    def test_small_messages_are_plain_json(self):
+        """ Messages under the threshold are stored as they are. """
+        message = {"role": "user", "content": "Hello chef", "thread_id": None}
+        encoded = encode_message(message)
+        self.assertTrue(encoded.startswith(b"{"))
+        self.assertEqual(decode_message(encoded), message)
+
+    def test_large_messages_are_compressed(self):
+        """ Messages over the threshold are compressed and decode back unchanged. """
+        message = {"role": "ai", "content": "Whisk the eggs. " * 500, "thread_id": "thread_1"}
+        encoded = encode_message(message)
+        self.assertTrue(encoded.startswith(COMPRESSED_PREFIX))
+        self.assertLess(len(encoded), len(message["content"]))
+        self.assertEqual(decode_message(encoded), message)
+
+    def test_session_cache_is_bounded_lru(self):
+        """ The least recently used session is evicted once the cache is full. """
+        cache = SessionCache(max_entries=2, ttl=60)
+        cache.set("a", {"chef_type": "home_cook", "thread_id": None})
+        cache.set("b", {"chef_type": "pro_chef", "thread_id": "thread_b"})
+        cache.get("a")
+        cache.set("c", {"chef_type": "home_cook", "thread_id": "thread_c"})
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a")["chef_type"], "home_cook")
+        cache.invalidate("a")
+        self.assertIsNone(cache.get("a"))
+
+    def test_ttl_refresh_is_throttled(self):
+        """ A cached session is due a TTL refresh once per interval, for one caller. """
+        cache = SessionCache(max_entries=2, ttl=60)
+        cache.set("a", {"chef_type": "home_cook", "thread_id": None})
+        self.assertFalse(cache.refresh_due("a", 10))
+        self.assertTrue(cache.refresh_due("a", 0))
+        self.assertFalse(cache.refresh_due("a", 10))
+        self.assertFalse(cache.refresh_due("missing", 0))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+""" Tests for singleflight coalescing """
+import asyncio
+import unittest
+from unittest import mock
+from app.utils import singleflight_utils
+from app.utils.session_utils import WORKER_ID
+
+class TestSingleflightUtils(unittest.TestCase):
+    """ Tests for sharing one call between identical concurrent requests. """
+    def test_identical_calls_share_one_call(self):
+        """ Concurrent calls with the same normalized arguments make a single call. """
+        calls = []
+
+        @singleflight_utils.singleflight("prompt")
+        async def get_prompt(recipe: str):
+            calls.append(recipe)
+            await asyncio.sleep(0.01)
+            return f"a photo of {recipe}"
+
+        redis = mock.AsyncMock()
+        redis.get.side_effect = [None, WORKER_ID.encode()]
+        redis.set.return_value = True
+
+        async def run():
+            return await asyncio.gather(get_prompt("Apple Pie"), get_prompt("apple  pie!"))
+
+        with mock.patch.object(singleflight_utils, "get_redis", return_value=redis):
+            results = asyncio.run(run())
+        self.assertEqual(calls, ["Apple Pie"])
+        self.assertEqual(results, ["a photo of Apple Pie"] * 2)
+        self.assertEqual(singleflight_utils.flights.flights, {})
+
+    def test_follower_reads_the_remote_result(self):
+        """ A call led by another worker returns the result that worker publishes. """
+        @singleflight_utils.singleflight("verdict")
+        async def is_food(text: str):
+            raise AssertionError("the follower should not make the call")
+
+        redis = mock.AsyncMock()
+        redis.get.side_effect = [None, b"true"]
+        redis.set.return_value = False
+
+        with mock.patch.object(singleflight_utils, "get_redis", return_value=redis):
+            self.assertTrue(asyncio.run(is_food("pancakes")))
+
+    def test_failures_are_not_shared(self):
+        """ A failed result is neither published nor handed to the callers that joined it. """
+        calls = []
+
+        @singleflight_utils.singleflight("image", succeeded=lambda result: isinstance(result, str))
+        async def create_image(prompt: str):
+            calls.append(prompt)
+            await asyncio.sleep(0.01)
+            return {"error": "rate limited"} if len(calls) == 1 else "image"
+
+        redis = mock.AsyncMock()
+        redis.get.side_effect = [None, WORKER_ID.encode()]
+        redis.set.return_value = True
+
+        async def run():
+            return await asyncio.gather(create_image("pie"), create_image("pie"))
+
+        with mock.patch.object(singleflight_utils, "get_redis", return_value=redis):
+            results = asyncio.run(run())
+        self.assertEqual(results, [{"error": "rate limited"}, "image"])
+        self.assertEqual(calls, ["pie", "pie"])
+        redis.set.assert_awaited_once()
+
+    def test_fresh_calls_are_not_coalesced(self):
+        """ fresh=True skips the coalescing and is passed on to the function. """
+        @singleflight_utils.singleflight("recipe")
+        async def recipe(specifications: str, fresh: bool = False):
+            return fresh
+
+        with mock.patch.object(singleflight_utils, "get_redis") as get_redis:
+            self.assertTrue(asyncio.run(recipe("pie", fresh=True)))
+        get_redis.assert_not_called()
+
+if __name__ == "__main__":
+    unittest.main()
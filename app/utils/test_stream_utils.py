@@ -0,0 +1,54 @@
+import unittest
+from app.utils.stream_utils import IncrementalJSONParser
+
+class TestIncrementalJSONParser(unittest.TestCase):
+
+    def feed_in_chunks(self, text, size):
+        parser = IncrementalJSONParser()
+        events = []
+        for i in range(0, len(text), size):
+            events += parser.feed(text[i:i + size])
+        return parser, events
+
+    def test_reports_fields_and_items_in_order(self):
+        # Arrange
+        text = '{"recipe_name": "Pancakes", "ingredients": ["1 cup flour", "2 eggs"], "prep_time": 10}'
+
+        # Act
+        parser, events = self.feed_in_chunks(text, 3)
+
+        # Assert
+        self.assertTrue(parser.done)
+        self.assertEqual(events, [
+            ("field", "recipe_name", "Pancakes"),
+            ("item", "ingredients", "1 cup flour"),
+            ("item", "ingredients", "2 eggs"),
+            ("field", "ingredients", ["1 cup flour", "2 eggs"]),
+            ("field", "prep_time", 10),
+        ])
+
+    def test_tolerates_preamble_escapes_and_raw_newlines(self):
+        # Arrange
+        text = 'Here you go!\n{"recipe_name": "The \\"Best\\" Cake", "directions": ["Mix\nwell, then {bake}"]}'
+
+        # Act
+        parser, _ = self.feed_in_chunks(text, 1)
+
+        # Assert
+        self.assertEqual(parser.result, {
+            "recipe_name": 'The "Best" Cake', "directions": ["Mix\nwell, then {bake}"]
+        })
+
+    def test_incomplete_values_are_not_reported(self):
+        # Arrange
+        parser = IncrementalJSONParser()
+
+        # Act
+        events = parser.feed('{"recipe_name": "Pan')
+
+        # Assert
+        self.assertEqual(events, [])
+        self.assertFalse(parser.done)
+
+if __name__ == '__main__':
+    unittest.main()